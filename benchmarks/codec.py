@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the size of encoded messages and the time taken to encode and
+decode them using the original (field name keyed) and compact (positional)
+encodings for every message class.
+"""
+from drogulus.net.messages import (Error, Ping, Pong, Store, FindNode, Nodes,
+                                   FindValue, Value, to_msgpack, decode)
+from drogulus.constants import ERRORS
+from drogulus.version import get_version
+from uuid import uuid4
+import os
+import time
+import timeit
+
+
+def sample_messages():
+    """
+    Returns a list of representative instances of every message class.
+    """
+    uuid = str(uuid4())
+    node = os.urandom(64).encode('hex')
+    key = os.urandom(64).encode('hex')
+    version = get_version()
+    nodes = tuple((os.urandom(64).encode('hex'), '192.168.0.%d' % i, 1908,
+                   version) for i in range(20))
+    value = ('public_key' * 20, 'name', {'mime': 'text/plain'})
+    store = (uuid, node, key, 'value' * 20, time.time(), 0.0) + value + (
+        os.urandom(128), version)
+    return [
+        Error(uuid, node, 1, ERRORS[1], {'context': 'A reason.'}, version),
+        Ping(uuid, node, version),
+        Pong(uuid, node, version),
+        Store(*store),
+        FindNode(uuid, node, key, version),
+        Nodes(uuid, node, nodes, version),
+        FindValue(uuid, node, key, version),
+        Value(*store),
+    ]
+
+
+def best(function, number):
+    """
+    Returns the best time (in microseconds) taken to call the function from
+    three runs of number calls.
+    """
+    return min(timeit.repeat(function, repeat=3, number=number)) / number * 1e6
+
+
+def run(number=2000):
+    """
+    Prints a table of results.
+    """
+    print '%-10s %9s %9s %11s %11s %11s %11s' % (
+        'message', 'size', 'compact', 'encode (us)', 'compact',
+        'decode (us)', 'compact')
+    mix = []
+    for message in sample_messages():
+        raw = to_msgpack(message)
+        compact = to_msgpack(message, compact=True)
+        mix.append((raw, compact))
+        print '%-10s %9d %9d %11.2f %11.2f %11.2f %11.2f' % (
+            message.__class__.__name__, len(raw), len(compact),
+            best(lambda: to_msgpack(message), number),
+            best(lambda: to_msgpack(message, True), number),
+            best(lambda: decode(raw), number),
+            best(lambda: decode(compact), number))
+    print
+    print 'Decode throughput for a mix of every message class:'
+    for description, index in (('original', 0), ('compact', 1)):
+        payloads = [pair[index] for pair in mix]
+
+        def decode_mix():
+            for raw in payloads:
+                decode(raw)
+
+        per_mix = best(decode_mix, number / 10)
+        print '%-10s %9d messages/s' % (description,
+                                        len(payloads) / per_mix * 1e6)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Compares bytes sent down the wire against CPU time per message when
+compressing Store messages across a range of representative payloads.
+"""
+from drogulus.net.messages import Store, to_msgpack
+from drogulus.net.protocol import DHTProtocol
+from drogulus.constants import COMPRESSION_THRESHOLD
+from drogulus.version import get_version
+from uuid import uuid4
+import json
+import os
+import time
+import timeit
+
+
+def make_store(value):
+    """
+    Returns a Store message containing the given value.
+    """
+    return Store(str(uuid4()), os.urandom(64), os.urandom(64), value,
+                 time.time(), 0.0, 'public_key' * 20, 'name',
+                 {'mime': 'text/plain'}, os.urandom(128), get_version())
+
+
+def payloads():
+    """
+    Returns a list of (description, value) tuples of representative values.
+    """
+    record = {
+        'name': 'Nicholas Tollervey',
+        'url': 'http://drogulus.org/',
+        'tags': ['python', 'dht', 'kademlia'],
+        'score': 12345
+    }
+    prose = ('The drogulus is a federated, decentralised, openly writable ' +
+             'information store and computation platform. ')
+    return [
+        ('short string', 'hello world'),
+        ('1k text', (prose * 10)[:1024]),
+        ('10k text', (prose * 100)[:10240]),
+        ('50k text', (prose * 500)[:51200]),
+        ('json records', json.dumps([record] * 200)),
+        ('10k random', os.urandom(10240)),
+    ]
+
+
+def run(number=200):
+    """
+    Prints a table of results.
+    """
+    protocol = DHTProtocol()
+    protocol.peer_capabilities = frozenset(['zlib'])
+    print 'Compression threshold: %d bytes' % COMPRESSION_THRESHOLD
+    print '%-14s %9s %9s %7s %14s %14s' % (
+        'payload', 'raw', 'sent', 'ratio', 'pack (us)', 'compress (us)')
+    for description, value in payloads():
+        message = make_store(value)
+        raw = to_msgpack(message)
+        sent = protocol.compress(raw)
+        pack = timeit.timeit(lambda: to_msgpack(message),
+                             number=number) / number
+        compress = timeit.timeit(lambda: protocol.compress(raw),
+                                 number=number) / number
+        print '%-14s %9d %9d %7.2f %14.1f %14.1f' % (
+            description, len(raw), len(sent),
+            float(len(sent)) / len(raw), pack * 1e6, compress * 1e6)
+    print
+    print '%-14s %16s' % ('payload', 'decompress (us)')
+    for description, value in payloads():
+        sent = protocol.compress(to_msgpack(make_store(value)))
+        decompress = timeit.timeit(lambda: protocol.decompress(sent),
+                                   number=number) / number
+        print '%-14s %16.1f' % (description, decompress * 1e6)
+
+
+if __name__ == '__main__':
+    run()
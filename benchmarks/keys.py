@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Reports the hit rate of drogulus.crypto.KeyCache and the resulting number of
+signatures verified per second for realistic patterns of key reuse.
+
+Stored values come from a population of publishers whose popularity follows
+a Zipf distribution (a few publishers account for most values) so each
+pattern of requests is generated with a different exponent (0 is uniform)
+and replayed against caches of several sizes and against no cache at all
+(parsing the key for every signature, as drogulus used to).
+
+    PYTHONPATH=. python benchmarks/keys.py --publishers 64 --requests 5000
+"""
+from drogulus.crypto import KeyCache, construct_hash, generate_signature
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+import argparse
+import bisect
+import random
+import time
+
+
+def publishers(count, bits):
+    """
+    Returns a list of (public_key, signature) tuples for the given number of
+    publishers, each signing the same value with a new key of the given size.
+    """
+    result = []
+    for i in range(count):
+        key = RSA.generate(bits)
+        signature = generate_signature('value', 1.0, 0.0, 'name', {}, key)
+        result.append((key.publickey().exportKey(), signature))
+    return result
+
+
+def zipf(count, exponent, requests):
+    """
+    Returns a list of the given number of indexes into a population of count
+    items, chosen with probabilities that follow a Zipf distribution with the
+    given exponent.
+    """
+    weights = [1.0 / (rank ** exponent) for rank in range(1, count + 1)]
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return [bisect.bisect(cumulative, random.random() * total)
+            for i in range(requests)]
+
+
+def uncached(population, pattern, compound_hash):
+    """
+    Verifies the signatures in the order given by the pattern, parsing the
+    public key each time. Returns the elapsed time.
+    """
+    start = time.time()
+    for index in pattern:
+        public_key, signature = population[index]
+        verifier = PKCS1_v1_5.new(RSA.importKey(public_key))
+        assert verifier.verify(compound_hash, signature)
+    return time.time() - start
+
+
+def cached(population, pattern, compound_hash, cache):
+    """
+    Verifies the signatures in the order given by the pattern using the
+    cache. Returns the elapsed time.
+    """
+    start = time.time()
+    for index in pattern:
+        public_key, signature = population[index]
+        assert cache.get(public_key).verify(compound_hash, signature)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Key cache benchmarks.')
+    parser.add_argument('--publishers', type=int, default=64,
+                        help='the number of publishers (default 64)')
+    parser.add_argument('--requests', type=int, default=5000,
+                        help='the number of signatures to verify for each '
+                        'pattern (default 5000)')
+    parser.add_argument('--bits', type=int, default=2048,
+                        help='the size of each RSA key (default 2048)')
+    args = parser.parse_args()
+    random.seed(0)
+    print 'Generating %d %d bit keys...' % (args.publishers, args.bits)
+    population = publishers(args.publishers, args.bits)
+    compound_hash = construct_hash('value', 1.0, 0.0, 'name', {})
+    sizes = sorted(set([args.publishers / 8 or 1, args.publishers / 2 or 1,
+                        args.publishers]))
+    print '%-10s %-14s %10s %14s' % ('exponent', 'cache', 'hit rate',
+                                     'verifies/s')
+    for exponent in (0.0, 0.8, 1.2):
+        pattern = zipf(args.publishers, exponent, args.requests)
+        elapsed = uncached(population, pattern, compound_hash)
+        print '%-10.1f %-14s %10s %14.1f' % (exponent, 'none', '-',
+                                             args.requests / elapsed)
+        for size in sizes:
+            cache = KeyCache(size)
+            elapsed = cached(population, pattern, compound_hash, cache)
+            print '%-10.1f %-14s %9.1f%% %14.1f' % (
+                exponent, '%d keys' % size, cache.hit_rate * 100,
+                args.requests / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for drogulus.net.messages and drogulus.net.validators, the
+code every byte sent or received by a node passes through.
+
+A corpus of realistic messages of every type (including large values and
+Nodes messages containing K contacts) is used to time to_msgpack,
+from_msgpack, make_message and each validator both in isolation and end to
+end. For each benchmark the number of operations per second and the number
+of objects each operation leaves tracked by the garbage collector (see
+retained_objects) are reported.
+
+The number of operations per second can be saved and later used as a
+baseline to catch regressions:
+
+    PYTHONPATH=. python benchmarks/messages.py --save baseline.json
+    (make some changes)
+    PYTHONPATH=. python benchmarks/messages.py --compare baseline.json
+
+When comparing, the exit status is 1 if any benchmark is more than the
+tolerance (25% by default) slower than the baseline. Timings are only
+comparable when taken on the same machine. The retained objects are only
+reported: they are not a count of allocations (Python 2 has no way to count
+those) and aren't compared with the baseline.
+"""
+from drogulus.net.messages import (Error, Ping, Pong, Store, FindNode, Nodes,
+                                   FindValue, Value, Batch, BatchReply,
+                                   to_msgpack, from_msgpack, make_message,
+                                   compiled)
+from drogulus.net.validators import VALIDATORS
+from drogulus.net.packing import pack_nodes
+from drogulus.constants import ERRORS, K
+from drogulus.version import get_version
+from uuid import uuid4
+import argparse
+import gc
+import hashlib
+import json
+import msgpack
+import os
+import sys
+import time
+import timeit
+
+
+def corpus():
+    """
+    Returns a list of (name, message) tuples containing representative
+    instances of every message class. Value carrying messages are included
+    with small, medium and large values, Nodes messages with K contacts (both
+    as tuples and packed) and Batch messages with K Store requests.
+    """
+    uuid = str(uuid4())
+    node = hashlib.sha512(uuid).digest()
+    key = hashlib.sha512(os.urandom(8)).digest()
+    version = get_version()
+    public_key = ('-----BEGIN PUBLIC KEY-----\n' +
+                  os.urandom(162).encode('base64') +
+                  '-----END PUBLIC KEY-----')
+    contacts = tuple((hashlib.sha512(os.urandom(8)).digest(),
+                      '192.168.0.%d' % i, 1908 + i, version)
+                     for i in range(K))
+    meta = {'mime': 'text/plain', 'encoding': 'utf-8'}
+
+    def store(klass, size):
+        return klass(uuid, node, key, os.urandom(size), time.time(), 0.0,
+                     public_key, 'name', meta, os.urandom(128), version)
+
+    stores = tuple(to_msgpack(store(Store, 64), True) for i in range(K))
+    pongs = tuple(to_msgpack(Pong(str(uuid4()), node, version), True)
+                  for i in range(K))
+    return [
+        ('error', Error(uuid, node, 1, ERRORS[1], {'context': 'A reason.'},
+                        version)),
+        ('ping', Ping(uuid, node, version)),
+        ('pong', Pong(uuid, node, version)),
+        ('store-64', store(Store, 64)),
+        ('store-64k', store(Store, 64 * 1024)),
+        ('store-1m', store(Store, 1024 * 1024)),
+        ('findnode', FindNode(uuid, node, key, version)),
+        ('nodes-k', Nodes(uuid, node, contacts, version)),
+        ('nodes-k-packed', Nodes(uuid, node, pack_nodes(contacts), version)),
+        ('findvalue', FindValue(uuid, node, key, version)),
+        ('value-64', store(Value, 64)),
+        ('value-1m', store(Value, 1024 * 1024)),
+        ('batch-k', Batch(uuid, node, stores, version)),
+        ('batchreply-k', BatchReply(uuid, node, pongs, version)),
+    ]
+
+
+def benchmarks(messages):
+    """
+    Returns a list of (name, function) tuples for each benchmark to run
+    against the list of (name, message) tuples.
+    """
+    result = []
+    samples = {}
+    for name, message in messages:
+        raw = to_msgpack(message)
+        compact = to_msgpack(message, compact=True)
+        data = msgpack.unpackb(raw, use_list=False)
+        fields, getter, validator = compiled(message.__class__)
+        result.extend([
+            ('to_msgpack/%s' % name,
+             lambda message=message: to_msgpack(message)),
+            ('to_msgpack-compact/%s' % name,
+             lambda message=message: to_msgpack(message, True)),
+            ('from_msgpack/%s' % name,
+             lambda raw=raw: from_msgpack(raw)),
+            ('from_msgpack-compact/%s' % name,
+             lambda raw=compact: from_msgpack(raw)),
+            ('make_message/%s' % name,
+             lambda klass=message.__class__, data=data:
+             make_message(klass, data)),
+            ('validator/%s' % name,
+             lambda validator=validator, values=tuple(message):
+             validator(*values)),
+            ('round-trip/%s' % name,
+             lambda message=message: from_msgpack(to_msgpack(message))),
+        ])
+        for field, value in message._asdict().iteritems():
+            samples.setdefault(field, []).append((name, value))
+    # Each field's validator in isolation, using the first value of the field
+    # in the corpus (or every value for the nodes field, whose validation
+    # depends on how the contacts are encoded).
+    for field in sorted(VALIDATORS):
+        validator = VALIDATORS[field]
+        values = samples[field] if field == 'nodes' else samples[field][:1]
+        for name, value in values:
+            result.append(('validate-%s/%s' % (field, name),
+                           lambda validator=validator, value=value:
+                           validator(value)))
+    return result
+
+
+def measure(function, min_time):
+    """
+    Returns the best number of calls to the function per second from three
+    runs, each of which takes at least min_time seconds.
+    """
+    number = 1
+    while timeit.timeit(function, number=number) < min_time / 10:
+        number *= 10
+    best = min(timeit.repeat(function, repeat=3, number=number * 10))
+    return number * 10 / best
+
+
+def retained_objects(function, calls=100):
+    """
+    Returns the number of objects tracked by the garbage collector that each
+    call to the function leaves behind. Objects that are freed before the
+    function returns, and objects the collector doesn't track (such as
+    strings and numbers), aren't counted. These are either referenced by the
+    result (for example, the tuples and dictionaries that make up a decoded
+    message) or garbage in reference cycles that only the collector can
+    free.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        results = [function() for i in xrange(calls)]
+        # The results list is itself tracked.
+        retained = len(gc.get_objects()) - before - 1
+    finally:
+        gc.enable()
+    del results
+    return retained / float(calls)
+
+
+def run(min_time=0.2):
+    """
+    Prints a table of results and returns a dictionary that maps the name of
+    each benchmark to the number of operations per second.
+    """
+    results = {}
+    print '%-40s %14s %9s' % ('benchmark', 'ops/s', 'retained')
+    for name, function in benchmarks(corpus()):
+        results[name] = measure(function, min_time)
+        print '%-40s %14.1f %9.1f' % (name, results[name],
+                                      retained_objects(function))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the benchmarks in the results dictionary that are more than the
+    tolerance (a fraction) slower than in the baseline dictionary and returns
+    the number of such regressions.
+    """
+    regressions = 0
+    for name in sorted(baseline):
+        if name not in results:
+            continue
+        change = results[name] / baseline[name] - 1
+        if change < -tolerance:
+            regressions += 1
+            print 'REGRESSION %-40s %14.1f -> %.1f ops/s (%+.0f%%)' % (
+                name, baseline[name], results[name], change * 100)
+    if not regressions:
+        print 'No benchmark is more than %.0f%% slower than the baseline.' % (
+            tolerance * 100)
+    return regressions
+
+
+def main(argv):
+    """
+    Runs the benchmarks, saving or comparing the results as requested by the
+    command line arguments. Returns the exit status.
+    """
+    parser = argparse.ArgumentParser(description='Codec and validator '
+                                     'micro-benchmarks.')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the fraction by which a benchmark may be '
+                        'slower than the baseline (default 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='the minimum seconds for each timed run '
+                        '(default 0.2)')
+    args = parser.parse_args(argv)
+    results = run(args.min_time)
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+    if args.compare:
+        print
+        with open(args.compare) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Compares encoding and decoding Nodes messages (the most common response in
+any lookup) containing contact tuples against packed contacts.
+"""
+from drogulus.net.messages import Nodes, to_msgpack, decode
+from drogulus.net.packing import pack_nodes
+from drogulus.dht.contact import to_contacts
+from drogulus.constants import K
+from drogulus.version import get_version
+from uuid import uuid4
+import hashlib
+import os
+import timeit
+
+
+def sample_nodes(count):
+    """
+    Returns a list of count (id, address, port, version) tuples.
+    """
+    version = get_version()
+    return [(hashlib.sha512(os.urandom(8)).digest(), '192.168.0.%d' % i,
+             1908 + i, version) for i in range(count)]
+
+
+def run(number=2000):
+    """
+    Prints a table of results.
+    """
+    uuid = str(uuid4())
+    node = hashlib.sha512(uuid).digest()
+    version = get_version()
+    print '%-8s %6s %6s %12s %7s %12s %7s %13s %7s' % (
+        'contacts', 'size', 'packed', 'encode (us)', 'packed',
+        'decode (us)', 'packed', 'contacts (us)', 'packed')
+    for count in (1, 8, K):
+        nodes = sample_nodes(count)
+
+        def encode():
+            return to_msgpack(Nodes(uuid, node, nodes, version), True)
+
+        def encode_packed():
+            return to_msgpack(Nodes(uuid, node, pack_nodes(nodes), version),
+                              True)
+
+        raw = encode()
+        packed = encode_packed()
+        # Decoding includes validation of the nodes field.
+        decoders = [lambda raw=raw: decode(raw),
+                    lambda raw=packed: decode(raw)]
+        # Decoding then turning the nodes into Contact objects.
+        contacts = [lambda raw=raw: to_contacts(decode(raw)[0].nodes),
+                    lambda raw=packed: to_contacts(decode(raw)[0].nodes)]
+        results = [min(timeit.repeat(f, repeat=3, number=number)) / number *
+                   1e6 for f in [encode, encode_packed] + decoders + contacts]
+        print '%-8d %6d %6d %12.2f %7.2f %12.2f %7.2f %13.2f %7.2f' % tuple(
+            [count, len(raw), len(packed)] + results)
+
+
+if __name__ == '__main__':
+    run()
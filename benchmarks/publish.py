@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Reports the number of small values per second a node can publish (sign and
+wrap in a Store message) with its identity held in different ways:
+
+* parsed - the private key is passed as a string to send_store and parsed
+  for every value.
+* signer - the identity is loaded into a Signer once (see
+  Node.load_identity) and the values are published with publish_many.
+
+Messages are not sent anywhere so only the cost of publishing is measured.
+
+    PYTHONPATH=. python benchmarks/publish.py --values 5000
+"""
+from drogulus.dht.node import Node
+from drogulus.dht.verification import Verifier
+from Crypto.PublicKey import RSA
+import argparse
+import hashlib
+import os
+import time
+
+
+def measure(publish, values):
+    """
+    Returns the number of values per second published by the function.
+    """
+    start = time.time()
+    publish(values)
+    return len(values) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publishing benchmarks.')
+    parser.add_argument('--values', type=int, default=5000,
+                        help='the number of values to publish (default 5000)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='the size of each value in bytes (default 64)')
+    parser.add_argument('--bits', type=int, default=2048,
+                        help='the size of the RSA key (default 2048)')
+    args = parser.parse_args()
+    key = RSA.generate(args.bits)
+    private_key = key.exportKey()
+    public_key = key.publickey().exportKey()
+    node = Node(hashlib.sha512('node').digest(), verifier=Verifier())
+    # Don't send the messages anywhere.
+    node.send_replicate = lambda store: store
+    now = time.time()
+    values = [('name-%d' % i, os.urandom(args.size), now, 0.0, {})
+              for i in range(args.values)]
+
+    def parsed(values):
+        for name, value, timestamp, expires, meta in values:
+            node.send_store(private_key, public_key, name, value, timestamp,
+                            expires, meta)
+
+    print 'Publishing %d values of %d bytes with a %d bit key...' % (
+        args.values, args.size, args.bits)
+    print '%-10s %14s' % ('identity', 'values/s')
+    print '%-10s %14.1f' % ('parsed', measure(parsed, values))
+    node.load_identity(private_key, public_key)
+    print '%-10s %14.1f' % ('signer', measure(node.publish_many, values))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Reports the number of signatures per second generated and verified with each
+signature scheme in drogulus.schemes (RSA with several key sizes), along with
+the size of the public keys and signatures carried in every Store message.
+
+Keys are parsed once, as they are when the node's identity is loaded into a
+Signer and when publishers' keys are found in drogulus.crypto.PUBLIC_KEYS,
+so only signing and verifying are timed.
+
+    PYTHONPATH=. python benchmarks/signatures.py --signatures 500
+"""
+from drogulus.schemes import SCHEMES, RSAScheme
+from drogulus.crypto import construct_hash
+import argparse
+import os
+import time
+
+
+def measure(function, count):
+    """
+    Returns the number of calls to the function per second.
+    """
+    start = time.time()
+    for i in xrange(count):
+        function()
+    return count / (time.time() - start)
+
+
+def schemes(sizes):
+    """
+    Returns a list of (label, scheme) tuples for each registered scheme with
+    RSA keys of each of the given sizes.
+    """
+    result = [('rsa-%d' % bits, RSAScheme(bits)) for bits in sizes]
+    result.extend((name, scheme) for name, scheme in sorted(SCHEMES.items())
+                  if not isinstance(scheme, RSAScheme))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Signature scheme '
+                                     'benchmarks.')
+    parser.add_argument('--signatures', type=int, default=500,
+                        help='the number of signatures to generate and '
+                        'verify with each scheme (default 500)')
+    parser.add_argument('--bits', type=int, nargs='+',
+                        default=[1024, 2048, 4096],
+                        help='the sizes of RSA keys (default 1024 2048 4096)')
+    args = parser.parse_args()
+    compound_hash = construct_hash(os.urandom(64), time.time(), 0.0, 'name',
+                                   {})
+    print '%-12s %12s %12s %11s %10s' % ('scheme', 'signs/s', 'verifies/s',
+                                         'public key', 'signature')
+    for label, scheme in schemes(args.bits):
+        private_key = scheme.generate()
+        public_key = scheme.public_key(private_key)
+        signer = scheme.load_key(private_key)
+        verifier = scheme.load_key(public_key)
+        signature = signer.sign(compound_hash)
+        assert verifier.verify(compound_hash, signature)
+        signs = measure(lambda: signer.sign(compound_hash), args.signatures)
+        verifies = measure(lambda: verifier.verify(compound_hash, signature),
+                           args.signatures)
+        print '%-12s %12.1f %12.1f %11d %10d' % (label, signs, verifies,
+                                                 len(public_key),
+                                                 len(signature))
+
+
+if __name__ == '__main__':
+    main()
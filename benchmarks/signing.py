@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for drogulus.crypto, the code that signs every value published by
+a node and checks every value it stores.
+
+construct_hash, construct_key, generate_signature (which parses the
+private key every time), Signer.sign, validate_signature and
+validate_message are timed with values from a few bytes to megabytes and
+with keys of each signature scheme (RSA with several key sizes). For each
+benchmark the number of operations per second is reported. The number of
+cores needed to check a target number of Store messages per second is
+estimated from the validate_message results (see --target).
+
+As with messages.py the results can be saved as a baseline and compared
+against later to catch regressions:
+
+    PYTHONPATH=. python benchmarks/signing.py --save baseline.json
+    (make some changes)
+    PYTHONPATH=. python benchmarks/signing.py --compare baseline.json
+
+To see where the time goes each benchmark can also be profiled. --collapsed
+samples the stack while each benchmark runs and writes one line for each
+distinct stack ("benchmark;frame;frame... count"), the format read by
+flamegraph.pl (https://github.com/brendangregg/FlameGraph) and speedscope:
+
+    PYTHONPATH=. python benchmarks/signing.py --collapsed signing.folded
+    flamegraph.pl signing.folded > signing.svg
+
+--pstats writes cProfile statistics (for pstats, snakeviz or gprof2dot).
+"""
+from drogulus.crypto import (construct_hash, construct_key, Signer,
+                             generate_signature, validate_signature,
+                             validate_message, PUBLIC_KEY_HASHES,
+                             COMPOUND_KEYS)
+from drogulus.schemes import SCHEMES, RSAScheme
+from drogulus.net.messages import Store
+from drogulus.version import get_version
+from messages import measure, compare
+from collections import defaultdict
+import argparse
+import cProfile
+import json
+import os
+import signal
+import sys
+import time
+
+
+def schemes(sizes):
+    """
+    Returns a list of (label, private_key, public_key) tuples for a new key
+    of each registered signature scheme, with RSA keys of each of the given
+    sizes.
+    """
+    result = []
+    for bits in sizes:
+        private_key = RSAScheme(bits).generate()
+        result.append(('rsa-%d' % bits, private_key,
+                       SCHEMES['rsa'].public_key(private_key)))
+    for name, scheme in sorted(SCHEMES.items()):
+        if not isinstance(scheme, RSAScheme):
+            private_key = scheme.generate()
+            result.append((name, private_key, scheme.public_key(private_key)))
+    return result
+
+
+def label(size):
+    """
+    Returns a short label for a number of bytes.
+    """
+    for unit, suffix in ((1024 * 1024, 'm'), (1024, 'k')):
+        if size >= unit and size % unit == 0:
+            return '%d%s' % (size / unit, suffix)
+    return str(size)
+
+
+def uncached_key(public_key, name):
+    """
+    Calls construct_key without the benefit of the caches of digests.
+    """
+    PUBLIC_KEY_HASHES.clear()
+    COMPOUND_KEYS.clear()
+    return construct_key(public_key, name)
+
+
+def benchmarks(keys, sizes):
+    """
+    Returns a list of (name, function) tuples for each benchmark to run with
+    the list of (label, private_key, public_key) tuples and value sizes.
+    """
+    meta = {'mime': 'text/plain', 'encoding': 'utf-8'}
+    timestamp = time.time()
+    values = [(label(size), os.urandom(size)) for size in sizes]
+    result = []
+    for size, value in values:
+        result.append(('construct_hash/%s' % size,
+                       lambda value=value: construct_hash(
+                           value, timestamp, 0.0, 'name', meta)))
+    for key, private_key, public_key in keys:
+        result.extend([
+            ('construct_key/%s' % key,
+             lambda public_key=public_key: construct_key(public_key,
+                                                         'name')),
+            ('construct_key-uncached/%s' % key,
+             lambda public_key=public_key: uncached_key(public_key, 'name')),
+        ])
+        signer = Signer(private_key, public_key)
+        for size, value in values:
+            signature = signer.sign(value, timestamp, 0.0, 'name', meta)
+            message = Store('uuid', 'node', construct_key(public_key, 'name'),
+                            value, timestamp, 0.0, public_key, 'name', meta,
+                            signature, get_version())
+            assert validate_message(message) == (True, None)
+            result.extend([
+                ('generate_signature/%s/%s' % (key, size),
+                 lambda value=value, private_key=private_key:
+                 generate_signature(value, timestamp, 0.0, 'name', meta,
+                                    private_key)),
+                ('Signer.sign/%s/%s' % (key, size),
+                 lambda value=value, signer=signer:
+                 signer.sign(value, timestamp, 0.0, 'name', meta)),
+                ('validate_signature/%s/%s' % (key, size),
+                 lambda value=value, signature=signature,
+                 public_key=public_key:
+                 validate_signature(value, timestamp, 0.0, 'name', meta,
+                                    signature, public_key)),
+                ('validate_message/%s/%s' % (key, size),
+                 lambda message=message: validate_message(message)),
+            ])
+    return result
+
+
+def run(functions, min_time):
+    """
+    Prints a table of results and returns a dictionary that maps the name of
+    each benchmark to the number of operations per second.
+    """
+    results = {}
+    print '%-45s %14s' % ('benchmark', 'ops/s')
+    for name, function in functions:
+        results[name] = measure(function, min_time)
+        print '%-45s %14.1f' % (name, results[name])
+    return results
+
+
+def capacity(results, target):
+    """
+    Prints the number of cores needed to check the target number of Store
+    messages per second (on this machine) for each validate_message
+    benchmark.
+    """
+    print '%-45s %14s' % ('cores for %d Store/s' % target, 'cores')
+    for name in sorted(results):
+        if name.startswith('validate_message/'):
+            print '%-45s %14.1f' % (name, target / results[name])
+
+
+def repeat(function, seconds):
+    """
+    Calls the function again and again for the given number of seconds.
+    """
+    end = time.time() + seconds
+    while time.time() < end:
+        function()
+
+
+def collapsed(functions, seconds, interval=0.001):
+    """
+    Samples the stack every interval seconds of CPU time while each function
+    runs for the given number of seconds. Returns a dictionary that maps each
+    distinct stack (with the name of the benchmark as its root) to the number
+    of times it was sampled.
+    """
+    counts = defaultdict(int)
+    current = [None]
+
+    def sample(signum, frame):
+        stack = []
+        while frame is not None and frame.f_code is not repeat.func_code:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (code.co_name,
+                                         os.path.basename(code.co_filename),
+                                         code.co_firstlineno))
+            frame = frame.f_back
+        if frame is not None:
+            stack.append(current[0])
+            counts[';'.join(reversed(stack))] += 1
+
+    signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+    try:
+        for name, function in functions:
+            current[0] = name
+            repeat(function, seconds)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+    return counts
+
+
+def profile(functions, seconds):
+    """
+    Returns a cProfile.Profile of each function running for the given number
+    of seconds.
+    """
+    profiler = cProfile.Profile()
+    for name, function in functions:
+        profiler.runcall(repeat, function, seconds)
+    return profiler
+
+
+def main(argv):
+    """
+    Runs the benchmarks, saving, comparing or profiling as requested by the
+    command line arguments. Returns the exit status.
+    """
+    parser = argparse.ArgumentParser(description='Hashing and signing '
+                                     'benchmarks.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[16, 1024, 64 * 1024, 1024 * 1024],
+                        help='the sizes of values in bytes (default 16 1024 '
+                        '65536 1048576)')
+    parser.add_argument('--bits', type=int, nargs='+',
+                        default=[1024, 2048, 4096],
+                        help='the sizes of RSA keys (default 1024 2048 4096)')
+    parser.add_argument('--only', metavar='PREFIX',
+                        help='only run benchmarks whose names start with the '
+                        'prefix')
+    parser.add_argument('--target', type=int, default=1000,
+                        help='the Store messages per second to estimate the '
+                        'cores needed for (default 1000)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='the fraction by which a benchmark may be '
+                        'slower than the baseline (default 0.25)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='the minimum seconds for each timed run '
+                        '(default 0.2)')
+    parser.add_argument('--collapsed', metavar='FILE',
+                        help='write sampled stacks in the collapsed format '
+                        'used by flame graphs')
+    parser.add_argument('--pstats', metavar='FILE',
+                        help='write cProfile statistics')
+    parser.add_argument('--profile-time', type=float, default=1.0,
+                        help='the seconds to profile each benchmark for '
+                        '(default 1.0)')
+    args = parser.parse_args(argv)
+    print 'Generating keys...'
+    functions = benchmarks(schemes(args.bits), args.sizes)
+    if args.only:
+        functions = [(name, function) for name, function in functions
+                     if name.startswith(args.only)]
+    results = run(functions, args.min_time)
+    print
+    capacity(results, args.target)
+    if args.save:
+        with open(args.save, 'w') as baseline:
+            json.dump(results, baseline, indent=2, sort_keys=True)
+    if args.collapsed:
+        counts = collapsed(functions, args.profile_time)
+        with open(args.collapsed, 'w') as output:
+            for stack in sorted(counts):
+                output.write('%s %d\n' % (stack, counts[stack]))
+    if args.pstats:
+        profile(functions, args.profile_time).dump_stats(args.pstats)
+    if args.compare:
+        print
+        with open(args.compare) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Reports TLS handshake latency and CPU time with and without session
+resumption using a local loopback server.
+"""
+from drogulus.net.tls import TLSSessionCache
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.endpoints import SSL4ClientEndpoint
+from twisted.internet.ssl import CertificateOptions
+from OpenSSL import crypto
+import resource
+import time
+
+
+def self_signed():
+    """
+    Returns a private key and self signed certificate for the server.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return key, cert
+
+
+class Echo(protocol.Protocol):
+    """
+    Echoes data back to the client.
+    """
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+class Probe(protocol.Protocol):
+    """
+    Sends a byte and fires a deferred once it is echoed back (and so the
+    handshake has completed).
+    """
+
+    def __init__(self, finished):
+        self.finished = finished
+
+    def connectionMade(self):
+        self.transport.write('x')
+
+    def dataReceived(self, data):
+        self.transport.loseConnection()
+        self.finished.callback(None)
+
+
+def cpu_time():
+    """
+    Returns the user and system CPU time used by the process.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def measure(make_endpoint, number):
+    """
+    Connects number times using endpoints returned by make_endpoint and
+    returns the average latency and CPU time per handshake.
+    """
+    start_wall = time.time()
+    start_cpu = cpu_time()
+    for i in range(number):
+        finished = defer.Deferred()
+        factory = protocol.Factory.forProtocol(lambda: Probe(finished))
+        yield make_endpoint().connect(factory)
+        yield finished
+    wall = (time.time() - start_wall) / number
+    cpu = (cpu_time() - start_cpu) / number
+    defer.returnValue((wall, cpu))
+
+
+@defer.inlineCallbacks
+def run(number=200):
+    """
+    Prints a table of results.
+    """
+    key, cert = self_signed()
+    server_options = CertificateOptions(privateKey=key, certificate=cert,
+                                        enableSessionTickets=True)
+    port = reactor.listenSSL(0, protocol.Factory.forProtocol(Echo),
+                             server_options, interface='127.0.0.1')
+    address = port.getHost()
+    cache = TLSSessionCache()
+
+    def fresh():
+        # What happens with clientFromString: new options every time.
+        return SSL4ClientEndpoint(reactor, address.host, address.port,
+                                  CertificateOptions())
+
+    def resumed():
+        return cache.endpoint(reactor, address.host, address.port)
+
+    try:
+        print '%-22s %14s %14s' % ('client', 'latency (ms)', 'cpu (ms)')
+        for description, make_endpoint in (('full handshake', fresh),
+                                           ('session resumption', resumed)):
+            wall, cpu = yield measure(make_endpoint, number)
+            print '%-22s %14.3f %14.3f' % (description, wall * 1e3,
+                                           cpu * 1e3)
+        print
+        print 'Session cache hits: %d, misses: %d' % (cache.hits,
+                                                      cache.misses)
+    finally:
+        yield port.stopListening()
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(run)
+    reactor.run()
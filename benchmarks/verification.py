@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Reports the number of Store messages per second verified by each of the
+verifiers in drogulus.dht.verification with increasing numbers of workers.
+
+A burst of messages is verified as if it had just arrived during replication:
+the messages are signed by a handful of publishers and some of them are
+copies of the same value that arrived from different peers (see
+--duplicates).
+
+    PYTHONPATH=. python benchmarks/verification.py --messages 2000
+"""
+from drogulus.dht.verification import (Verifier, ThreadedVerifier,
+                                       ProcessVerifier, BatchingVerifier)
+from drogulus.crypto import construct_key, generate_signature
+from drogulus.net.messages import Store
+from drogulus.version import get_version
+from Crypto.PublicKey import RSA
+from twisted.internet import defer, task
+from uuid import uuid4
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+
+def burst(count, publishers, duplicates, bits):
+    """
+    Returns a list of count Store messages signed by the given number of
+    publishers with keys of the given size. The duplicates fraction of the
+    messages are copies of earlier messages.
+    """
+    keys = [RSA.generate(bits) for i in range(publishers)]
+    messages = []
+    for i in range(count):
+        if messages and random.random() < duplicates:
+            messages.append(random.choice(messages)._replace(
+                uuid=str(uuid4())))
+            continue
+        key = random.choice(keys)
+        public_key = key.publickey().exportKey()
+        value = os.urandom(256)
+        timestamp = time.time()
+        signature = generate_signature(value, timestamp, 0.0, 'name', {},
+                                       key)
+        messages.append(Store(str(uuid4()), 'node',
+                              construct_key(public_key, 'name'), value,
+                              timestamp, 0.0, public_key, 'name', {},
+                              signature, get_version()))
+    return messages
+
+
+@defer.inlineCallbacks
+def measure(verifier, messages):
+    """
+    Returns the number of messages per second verified by the verifier.
+    Starting the verifier's workers isn't included.
+    """
+    yield verifier.verify(messages[0])
+    if isinstance(verifier, BatchingVerifier):
+        verifier.flush()
+    start = time.time()
+    deferreds = [verifier.verify(message) for message in messages]
+    if isinstance(verifier, BatchingVerifier):
+        verifier.flush()
+    results = yield defer.gatherResults(deferreds)
+    elapsed = time.time() - start
+    verifier.stop()
+    assert all(is_valid for is_valid, error in results)
+    defer.returnValue(len(messages) / elapsed)
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description='Verification benchmarks.')
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='the number of messages (default 2000)')
+    parser.add_argument('--publishers', type=int, default=8,
+                        help='the number of publishers (default 8)')
+    parser.add_argument('--duplicates', type=float, default=0.25,
+                        help='the fraction of messages that are duplicates '
+                        '(default 0.25)')
+    parser.add_argument('--bits', type=int, default=2048,
+                        help='the size of each RSA key (default 2048)')
+    args = parser.parse_args()
+    random.seed(0)
+    print 'Signing %d messages...' % args.messages
+    messages = burst(args.messages, args.publishers, args.duplicates,
+                     args.bits)
+    max_queue = args.messages + 1
+    print '%-20s %8s %14s' % ('verifier', 'workers', 'messages/s')
+    rate = yield measure(Verifier(max_queue), messages)
+    print '%-20s %8s %14.1f' % ('Verifier', '-', rate)
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        for klass in (ThreadedVerifier, ProcessVerifier, BatchingVerifier):
+            rate = yield measure(klass(workers, max_queue), messages)
+            print '%-20s %8d %14.1f' % (klass.__name__, workers, rate)
+        workers *= 2
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -50,6 +50,134 @@ REFRESH_INTERVAL = REFRESH_TIMEOUT / 6  # Every 10 minutes.
 #: is equalled or exceeded then the contact is removed from the routing table.
 ALLOWED_RPC_FAILS = 5
 
+#: Optional features of the wire protocol understood by this node. These are
+#: advertised to peers in the 'caps' field of each outgoing message as an
+#: integer bitmask in which bit i is set for the ith capability, so new
+#: capabilities must only ever be appended. Peers that don't recognise the
+#: field simply ignore it.
+CAPABILITIES = ('zlib', 'chunked', 'compact', 'packed_nodes', 'stream',
+                'batch')
+
+#: The size (in bytes) above which an encoded message is compressed before
+#: being sent to a peer that has advertised the 'zlib' capability.
+COMPRESSION_THRESHOLD = 1024
+
+#: The maximum size (in bytes) of a message that doesn't carry a value (every
+#: type of message other than Store, Value, Batch and BatchReply). Larger
+#: messages of these types result in an error 4 (Request too big).
+MAX_SMALL_MESSAGE_SIZE = 1024 * 64  # 64k
+
+#: The size (in bytes) of the chunks used to send large values to peers that
+#: have advertised the 'chunked' capability. Values no larger than this are
+#: sent as part of a single message.
+CHUNK_SIZE = 1024 * 64  # 64k
+
+#: The maximum size (in bytes) of a single message (or chunk) that a node
+#: will accept from a peer: room for a chunk of a value plus the rest of the
+#: message. Larger messages result in an error 4 (Request too big) so larger
+#: values must be sent in chunks.
+MAX_MESSAGE_SIZE = CHUNK_SIZE + MAX_SMALL_MESSAGE_SIZE  # 128k
+
+#: The default maximum size (in bytes) of a value reassembled from chunks
+#: (see DHTProtocol.MAX_VALUE_SIZE). Larger values result in an error 4
+#: (Request too big).
+MAX_VALUE_SIZE = 1024 * 1024 * 16  # 16Mb
+
+#: The maximum number of messages that may be sent in a single Batch message
+#: to peers that have advertised the 'batch' capability.
+MAX_BATCH_SIZE = 100
+
+#: The maximum total size (in bytes) of the encoded messages carried by a
+#: single Batch or BatchReply message, leaving room for the rest of the
+#: message within MAX_MESSAGE_SIZE. Messages that don't fit are sent on their
+#: own.
+MAX_BATCH_PAYLOAD = MAX_MESSAGE_SIZE - MAX_SMALL_MESSAGE_SIZE
+
+#: The maximum total size (in bytes) of the strings (versions and the keys of
+#: metadata) shared between decoded messages. The least recently used strings
+#: are forgotten to make room for new ones.
+MAX_SHARED_STRING_BYTES = 1024 * 64  # 64k
+
+#: The maximum size (in bytes) of a string that is shared between decoded
+#: messages. Longer strings are never shared.
+MAX_SHARED_STRING_LENGTH = 64
+
+#: The maximum number of node IDs shared between the routing table and decoded
+#: messages. The routing table can't hold more contacts than this.
+MAX_SHARED_NODE_IDS = K * 512
+
+#: The maximum number of parsed public keys (of the publishers of values) that
+#: are cached so signatures can be verified without parsing the key again.
+MAX_CACHED_PUBLIC_KEYS = 1024
+
+#: The maximum number of digests of publishers' public keys and of compound
+#: keys (see drogulus.crypto.construct_key) that are cached.
+MAX_CACHED_KEY_HASHES = 4096
+MAX_CACHED_COMPOUND_KEYS = 16384
+
+#: The maximum sizes (in bytes) of the public keys and names whose digests are
+#: cached (large enough for a 4096 bit RSA public key). Digests of longer keys
+#: and names are worked out every time so peers can't fill the caches with
+#: large strings.
+MAX_CACHED_KEY_LENGTH = 1024
+MAX_CACHED_NAME_LENGTH = 256
+
+#: Values of at least this many bytes are hashed in the reactor's pool of
+#: threads before they are signed (see drogulus.crypto.prehash_value).
+PARALLEL_HASH_THRESHOLD = 1024 * 1024  # 1mb
+
+#: The maximum number of bytes that may be queued for a single slow peer. If
+#: this is exceeded the connection is dropped.
+MAX_CONNECTION_QUEUE = 1024 * 1024 * 32  # 32Mb
+
+#: The maximum number of bytes that may be queued for slow peers across all
+#: connections. If this is exceeded the connection attempting to queue more
+#: data is dropped.
+MAX_GLOBAL_QUEUE = 1024 * 1024 * 256  # 256Mb
+
+#: The sustained rate (requests per second) and burst size of cheap requests
+#: (Ping, FindNode and FindValue) accepted from a single peer.
+CHEAP_RPC_RATE = 10
+CHEAP_RPC_BURST = 50
+
+#: The sustained rate (requests per second) and burst size of expensive
+#: requests (Store) accepted from a single peer.
+EXPENSIVE_RPC_RATE = 1
+EXPENSIVE_RPC_BURST = 10
+
+#: The sustained rate (responses per second) and burst size of responses
+#: (Pong, Value and Nodes) accepted from a single peer. Lookups ask several
+#: peers at once so this is generous, but it stops a peer from flooding the
+#: local node with responses (Value messages are expensive to verify).
+RESPONSE_RATE = 50
+RESPONSE_BURST = 200
+
+#: The sustained rate (requests per second) and burst size of requests sent
+#: in Batch messages by a single peer. A Batch is charged once for all the
+#: requests it contains so the burst must allow for a full batch (see
+#: MAX_BATCH_SIZE).
+BATCHED_RPC_RATE = 10
+BATCHED_RPC_BURST = 2 * MAX_BATCH_SIZE
+
+#: The number of threads (or processes) used to verify the signatures of
+#: value carrying messages away from the reactor.
+VERIFICATION_WORKERS = 4
+
+#: The maximum number of messages that may await verification at once. Any
+#: more are shed with an error 9 (Too many requests).
+MAX_VERIFICATION_QUEUE = 1024
+
+#: The maximum number of messages verified together by a BatchingVerifier
+#: and the maximum time (in seconds) a message waits for others to arrive.
+VERIFICATION_BATCH_SIZE = 64
+VERIFICATION_BATCH_DELAY = 0.01
+
+#: The time (in seconds) a worker process has to verify a message (or a
+#: batch of messages) before the message fails with an error 3 (Internal
+#: error). multiprocessing doesn't report a worker that dies or a message
+#: that can't be sent to it.
+VERIFICATION_TIMEOUT = 30.0
+
 #: Defines the errors that can be reported between nodes in the DHT.
 ERRORS = {
     # The request simply didn't make any sense.
@@ -68,5 +196,7 @@ ERRORS = {
     # The key / value pair did not match together as expected.
     7: 'Key mismatch',
     # The value is superceded (a newer version is known to the node already).
-    8: 'Superceded value'
+    8: 'Superceded value',
+    # The peer has sent too many requests so this one has been shed.
+    9: 'Too many requests'
 }
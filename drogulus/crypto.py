@@ -18,10 +18,309 @@ Contains functions for cryptographically signing / verifying.
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA512
 from Crypto.Signature import PKCS1_v1_5
+from constants import (MAX_CACHED_PUBLIC_KEYS, MAX_CACHED_KEY_HASHES,
+                       MAX_CACHED_COMPOUND_KEYS, MAX_CACHED_KEY_LENGTH,
+                       MAX_CACHED_NAME_LENGTH, CHUNK_SIZE,
+                       PARALLEL_HASH_THRESHOLD)
+from schemes import scheme_for
+from twisted.internet import defer, threads
+from collections import OrderedDict
+import hashlib
 import msgpack
+import struct
+import threading
+
+
+class PrehashedValue(str):
+    """
+    A string value that carries the SHA512 digest of its msgpack encoding
+    (for example, computed incrementally as the value arrived from the network
+    in chunks). The construct_hash function uses the digest rather than
+    encoding and hashing the value all over again.
+    """
+
+    def __new__(cls, value, digest):
+        instance = str.__new__(cls, value)
+        instance.digest = digest
+        return instance
+
+    def __reduce__(self):
+        return (PrehashedValue, (str(self), self.digest))
+
+
+class LazyValue(object):
+    """
+    A value that is still msgpack encoded exactly as it arrived from the
+    network. The encoded bytes (usually a buffer referencing the received
+    message) are hashed directly by construct_hash and the value is only
+    unpacked if something asks for it. Nodes that only check the signature
+    of a value before storing and replicating it never need to unpack it.
+    """
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+        self._digest = None
+
+    @property
+    def digest(self):
+        """
+        The SHA512 digest of the encoded value.
+        """
+        if self._digest is None:
+            self._digest = SHA512.new(self.encoded).digest()
+        return self._digest
+
+    @property
+    def value(self):
+        """
+        The unpacked value.
+        """
+        return msgpack.unpackb(self.encoded, use_list=False)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyValue):
+            return str(self.encoded) == str(other.encoded)
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyValue(%r)' % str(self.encoded)
+
+    def __reduce__(self):
+        # Buffers can't be pickled so pickle a copy of the encoded value.
+        return (LazyValue, (str(self.encoded), ))
+
+
+class LRUCache(object):
+    """
+    A thread safe cache of the values returned by the create function for
+    each key. To bound memory use only the max_size most recently used keys
+    are remembered, except for keys that have been pinned (see pin), which
+    are never forgotten.
+    """
+
+    def __init__(self, max_size, create):
+        self.max_size = max_size
+        self.create = create
+        self._values = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+        # The number of keys found in the cache.
+        self.hits = 0
+        # The number of keys whose value had to be created.
+        self.misses = 0
+
+    def __len__(self):
+        """
+        Returns the number of keys currently cached.
+        """
+        return len(self._values) + len(self._pinned)
+
+    def __contains__(self, key):
+        return key in self._pinned or key in self._values
+
+    @property
+    def hit_rate(self):
+        """
+        The fraction of keys that were found in the cache.
+        """
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def get(self, key):
+        """
+        Returns the value for the key, creating it if it isn't already
+        cached. If create raises an exception nothing is cached.
+        """
+        with self._lock:
+            value = self._pinned.get(key)
+            if value is None:
+                value = self._values.pop(key, None)
+                if value is not None:
+                    self._values[key] = value
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+        # Create outside the lock so other threads aren't held up.
+        value = self.create(key)
+        with self._lock:
+            self._values.pop(key, None)
+            if len(self._values) >= self.max_size:
+                # Forget the least recently used key.
+                self._values.popitem(last=False)
+            self._values[key] = value
+        return value
+
+    def pin(self, key):
+        """
+        Creates (if necessary) and returns the value for the key, which is
+        never forgotten.
+        """
+        value = self.get(key)
+        with self._lock:
+            self._values.pop(key, None)
+            self._pinned[key] = value
+        return value
+
+    def clear(self):
+        """
+        Discards every cached (including pinned) key and resets the
+        statistics.
+        """
+        with self._lock:
+            self._values.clear()
+            self._pinned.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class KeyCache(LRUCache):
+    """
+    A thread safe cache of parsed keys (for RSA keys, PKCS#1 v1.5 signature
+    schemes) keyed by the string representation of the key. Parsing a PEM or
+    DER encoded key is a large part of the cost of checking a signature and
+    the same publishers' keys are seen again and again. The signature scheme
+    of each key is found with drogulus.schemes.scheme_for. Getting a
+    malformed key raises a ValueError.
+    """
+
+    def __init__(self, max_size):
+        super(KeyCache, self).__init__(
+            max_size, lambda key: scheme_for(key).load_key(key))
+
+
+#: Caches the parsed public keys used to verify signatures.
+PUBLIC_KEYS = KeyCache(MAX_CACHED_PUBLIC_KEYS)
+
+
+def raw_header(length):
+    """
+    Returns the msgpack header that precedes a raw string of the given length
+    when it is encoded. Makes it possible to hash the encoded string
+    incrementally.
+    """
+    if length < 32:
+        return chr(0xa0 | length)
+    elif length < 2 ** 16:
+        return struct.pack('>BH', 0xda, length)
+    else:
+        return struct.pack('>BI', 0xdb, length)
+
+
+def hash_stream(source, length=None, chunk_size=CHUNK_SIZE):
+    """
+    Returns the SHA512 digest of the msgpack encoding of the string read
+    from the source, which is either a file-like object (read chunk_size
+    bytes at a time) or an iterable of strings. The encoding is hashed as it
+    is read so the string is never held in memory.
+
+    The length (in bytes) of the string is needed up front since it is part
+    of the encoding. It must be given for an iterable. For a file-like
+    object it defaults to the number of bytes between the current position
+    and the end of the file, and only length bytes are read (so a value can
+    be part of a larger file). A ValueError is raised if the source holds
+    fewer than length bytes or an iterable yields more.
+    """
+    if hasattr(source, 'read'):
+        if length is None:
+            start = source.tell()
+            source.seek(0, 2)
+            length = source.tell() - start
+            source.seek(start)
+    elif length is None:
+        raise ValueError('The length of an iterable source must be given.')
+    hasher = SHA512.new(raw_header(length))
+    remaining = length
+    if hasattr(source, 'read'):
+        while remaining > 0:
+            chunk = source.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            hasher.update(chunk)
+    else:
+        for chunk in source:
+            remaining -= len(chunk)
+            if remaining < 0:
+                break
+            hasher.update(chunk)
+    if remaining:
+        raise ValueError('The source does not contain %d bytes.' % length)
+    return hasher.digest()
+
+
+class StreamedValue(object):
+    """
+    A string value read from a file-like object or an iterable of strings
+    (see hash_stream) rather than held in memory, so a large value (for
+    example, a file on disk) can be signed without loading it. The digest of
+    the value's msgpack encoding is worked out (reading the source) the first
+    time it is needed.
+    """
+
+    def __init__(self, source, length=None):
+        self.source = source
+        self.length = length
+        self._digest = None
+        # Where the value starts in a file-like source.
+        self._start = source.tell() if hasattr(source, 'read') else None
+
+    @property
+    def loadable(self):
+        """
+        Indicates if the value can be loaded into memory (see load).
+        """
+        return self._start is not None
+
+    @property
+    def digest(self):
+        """
+        The SHA512 digest of the encoded value.
+        """
+        if self._digest is None:
+            self._digest = hash_stream(self.source, self.length)
+        return self._digest
+
+    def load(self):
+        """
+        Returns the value read into memory as a PrehashedValue (so it is not
+        hashed again). Only values from file-like sources can be loaded since
+        an iterable can only be read once.
+        """
+        if not self.loadable:
+            raise TypeError('Only values from file-like sources can be '
+                            'loaded.')
+        digest = self.digest
+        self.source.seek(self._start)
+        if self.length is None:
+            value = self.source.read()
+        else:
+            value = self.source.read(self.length)
+        return PrehashedValue(value, digest)
+
+
+def value_digest(value):
+    """
+    Returns the SHA512 digest of the msgpack encoded value (see
+    construct_hash).
+
+    If the value is a PrehashedValue, LazyValue or StreamedValue its digest is
+    used. A plain string value is hashed without making an encoded copy of
+    it (and without holding the GIL, so other threads can run meanwhile).
+    """
+    if isinstance(value, (PrehashedValue, LazyValue, StreamedValue)):
+        return value.digest
+    elif type(value) is str:
+        hasher = hashlib.sha512(raw_header(len(value)))
+        hasher.update(value)
+        return hasher.digest()
+    else:
+        return SHA512.new(msgpack.packb(value)).digest()
 
 
 def construct_hash(value, timestamp, expires, name, meta):
@@ -32,9 +331,12 @@ def construct_hash(value, timestamp, expires, name, meta):
 
     It ensures that the 'value', 'timestamp', 'expires', 'name' and 'meta'
     fields have not been tampered with.
+
+    Large values should be hashed beforehand with prehash_value so the
+    caller isn't blocked.
     """
-    hashes = []
-    for item in (value, timestamp, expires, name, meta):
+    hashes = [value_digest(value)]
+    for item in (timestamp, expires, name, meta):
         packed = msgpack.packb(item)
         hashed = SHA512.new(packed).digest()
         hashes.append(hashed)
@@ -42,6 +344,45 @@ def construct_hash(value, timestamp, expires, name, meta):
     return SHA512.new(compound_hashes)
 
 
+def prehash_value(value):
+    """
+    Returns a deferred that fires with the value as a PrehashedValue, so that
+    construct_hash doesn't hash it again. String values of at least
+    PARALLEL_HASH_THRESHOLD bytes are hashed in the reactor's pool of
+    threads so the reactor isn't blocked. Other values are returned as they
+    are.
+    """
+    if type(value) is str and len(value) >= PARALLEL_HASH_THRESHOLD:
+        d = threads.deferToThread(value_digest, value)
+        d.addCallback(lambda digest: PrehashedValue(value, digest))
+        return d
+    return defer.succeed(value)
+
+
+def hash_public_key(public_key):
+    """
+    Returns the SHA512 digest of the (normalised) public key.
+    """
+    return SHA512.new(public_key).digest()
+
+
+def compound_key(key):
+    """
+    Given a tuple of the digest of a public key and a name returns the
+    digest of the SHA512 hash of the digests of both.
+    """
+    key_hash, name = key
+    return SHA512.new(key_hash + SHA512.new(name).digest()).digest()
+
+
+#: Caches the digests of the public keys of publishers.
+PUBLIC_KEY_HASHES = LRUCache(MAX_CACHED_KEY_HASHES, hash_public_key)
+
+#: Caches the compound keys for each combination of the digest of a public
+#: key and a name.
+COMPOUND_KEYS = LRUCache(MAX_CACHED_COMPOUND_KEYS, compound_key)
+
+
 def construct_key(public_key, name=''):
     """
     Given a string representation of a user's public key and the human
@@ -50,19 +391,39 @@ def construct_key(public_key, name=''):
 
     This ensures that the provenance (public key) and meaning of the key
     determine its value in the DHT.
+
+    The digests are cached in PUBLIC_KEY_HASHES and COMPOUND_KEYS since a
+    publisher's keys never change. Public keys longer than
+    MAX_CACHED_KEY_LENGTH and names longer than MAX_CACHED_NAME_LENGTH bytes
+    aren't cached.
     """
     # Simple normalisation: no spaces or newlines around the public key
-    key_hash = SHA512.new(public_key.strip())
+    public_key = public_key.strip()
+    if len(public_key) > MAX_CACHED_KEY_LENGTH:
+        key_hash = hash_public_key(public_key)
+    else:
+        key_hash = PUBLIC_KEY_HASHES.get(public_key)
     if name:
         # If the key has a meaningful name, create a compound key based upon
         # the SHA512 values of both the public_key and name.
-        name_hash = SHA512.new(name)
-        compound_key = key_hash.digest() + name_hash.digest()
-        compound_hash = SHA512.new(compound_key)
-        return compound_hash.digest()
+        if len(name) > MAX_CACHED_NAME_LENGTH:
+            return compound_key((key_hash, name))
+        return COMPOUND_KEYS.get((key_hash, name))
     else:
         # Not a compound key, so just return the hash of the public_key
-        return key_hash.digest()
+        return key_hash
+
+
+def precompute_keys(public_key, names=()):
+    """
+    Works out the keys for the public key and each of the names (see
+    construct_key) and pins them in the caches so they are never forgotten.
+    Used for the local node's own identity.
+    """
+    key_hash = PUBLIC_KEY_HASHES.pin(public_key.strip())
+    for name in names:
+        if name:
+            COMPOUND_KEYS.pin((key_hash, name))
 
 
 def generate_signature(value, timestamp, expires, name, meta, private_key):
@@ -78,13 +439,60 @@ def generate_signature(value, timestamp, expires, name, meta, private_key):
     The hash is created with the private key of the person storing the
     key/value pair. It is, in turn, based upon the SHA512 hash of the SHA512
     hashes of the 'value', 'timestamp', 'expires', 'name' and 'meta' fields.
+
+    The private key may be a string (which is parsed every time), an RSA key
+    object that has already been parsed or a Signer (which holds the parsed
+    key of an identity for as long as it is needed). The signature scheme of
+    a string is identified by its prefix (see drogulus.schemes).
     """
+    if isinstance(private_key, Signer):
+        return private_key.sign(value, timestamp, expires, name, meta)
     compound_hash = construct_hash(value, timestamp, expires, name, meta)
-    key = RSA.importKey(private_key)
-    signer = PKCS1_v1_5.new(key)
+    if isinstance(private_key, basestring):
+        signer = scheme_for(private_key).load_key(private_key)
+    else:
+        signer = PKCS1_v1_5.new(private_key)
     return signer.sign(compound_hash)
 
 
+class Signer(object):
+    """
+    Holds the parsed private key (of any signature scheme, see
+    drogulus.schemes) of an identity (usually that of the local node) so
+    that the values it publishes are signed without the key being parsed
+    each time. The public key defaults to
+    the one belonging to the private key and the keys derived from it are
+    precomputed (see precompute_keys).
+    """
+
+    def __init__(self, private_key, public_key=None):
+        if isinstance(private_key, basestring):
+            scheme = scheme_for(private_key)
+            if public_key is None:
+                public_key = scheme.public_key(private_key)
+            self._scheme = scheme.load_key(private_key)
+        else:
+            self._scheme = PKCS1_v1_5.new(private_key)
+            if public_key is None:
+                public_key = private_key.publickey().exportKey()
+        self.public_key = public_key
+        precompute_keys(public_key)
+
+    def sign(self, value, timestamp, expires, name, meta):
+        """
+        Returns the signature for the fields of a value carrying message (see
+        generate_signature).
+        """
+        compound_hash = construct_hash(value, timestamp, expires, name, meta)
+        return self._scheme.sign(compound_hash)
+
+    def key(self, name=''):
+        """
+        Returns the key in the DHT for the name (see construct_key).
+        """
+        return construct_key(self.public_key, name)
+
+
 def validate_signature(value, timestamp, expires, name, meta, signature,
                        public_key):
     """
@@ -93,12 +501,20 @@ def validate_signature(value, timestamp, expires, name, meta, signature,
     'meta' fields of a value carrying message.
     """
     generated_hash = construct_hash(value, timestamp, expires, name, meta)
+    return verify_hash(generated_hash, signature, public_key)
+
+
+def verify_hash(generated_hash, signature, public_key):
+    """
+    Uses the public key to validate the cryptographic signature of a hash
+    (as returned by construct_hash). Parsed public keys are cached in
+    PUBLIC_KEYS.
+    """
     try:
-        public_key = RSA.importKey(public_key.strip())
+        verifier = PUBLIC_KEYS.get(public_key.strip())
     except ValueError:
         # Catches malformed public keys.
         return False
-    verifier = PKCS1_v1_5.new(public_key)
     return verifier.verify(generated_hash, signature)
 
 
@@ -134,3 +550,34 @@ def validate_message(message):
         return (False, 7)
     # It checks out so return truthy.
     return (True, None)
+
+
+def validate_messages(messages):
+    """
+    Returns a list containing the (is_valid, error_number) tuple that
+    validate_message would return for each of the messages.
+
+    Each distinct combination of public key, signature and hash of the
+    signed fields is only checked once so this is much quicker than calling
+    validate_message for each message when the same value arrives from many
+    peers (for example, during replication).
+    """
+    checked = {}
+    results = []
+    for message in messages:
+        generated_hash = construct_hash(message.value, message.timestamp,
+                                        message.expires, message.name,
+                                        message.meta)
+        signed = (message.public_key, message.sig, generated_hash.digest())
+        is_valid = checked.get(signed)
+        if is_valid is None:
+            is_valid = verify_hash(generated_hash, message.sig,
+                                   message.public_key)
+            checked[signed] = is_valid
+        if not is_valid:
+            results.append((False, 6))
+        elif construct_key(message.public_key, message.name) != message.key:
+            results.append((False, 7))
+        else:
+            results.append((True, None))
+    return results
@@ -17,7 +17,9 @@ Defines a contact (another node) on the network.
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from drogulus.utils import long_to_hex
+from nodeid import to_node_id
+from drogulus.net.packing import unpack_nodes
+from drogulus.net.interning import SHARED_STRINGS, NODE_IDS
 
 
 class Contact(object):
@@ -30,13 +32,10 @@ class Contact(object):
         Initialises the contact object with its unique id within the DHT, IP
         address, port, the Drogulus version the contact is running and a
         timestamp when the last connection was made with the contact (defaults
-        to 0). The id, if passed in as a numeric value, will be converted into
-        a hexadecimal string.
+        to 0). The id, whether passed in as a string or a numeric value, is
+        converted into a NodeID.
         """
-        if isinstance(id, long) or isinstance(id, int):
-            self.id = long_to_hex(id)
-        else:
-            self.id = id
+        self.id = to_node_id(id)
         self.address = address
         self.port = port
         self.version = version
@@ -45,6 +44,9 @@ class Contact(object):
         # If this number reaches a threshold then it is evicted from the
         # kbucket and replaced with a contact that is more reliable.
         self.failed_RPCs = 0
+        # The optional protocol features the contact has advertised. Updated
+        # by the local node whenever a message arrives from the contact.
+        self.capabilities = frozenset()
 
     def __eq__(self, other):
         """
@@ -77,3 +79,19 @@ class Contact(object):
         useful.
         """
         return self.__repr__()
+
+
+def to_contacts(nodes):
+    """
+    Given the 'nodes' field of a Nodes message returns a list of Contact
+    objects representing the referenced nodes. The field may contain either
+    a tuple of (id, address, port, version) tuples or the packed string
+    representation of the nodes (in which case it is decoded straight into
+    Contact objects). The contacts share their IDs and versions with other
+    objects where possible (see drogulus.net.interning).
+    """
+    if isinstance(nodes, str):
+        nodes = unpack_nodes(nodes)
+    intern = SHARED_STRINGS.intern
+    return [Contact(NODE_IDS.get(id), address, port, intern(version))
+            for id, address, port, version in nodes]
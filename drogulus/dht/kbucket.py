@@ -19,6 +19,7 @@ Defines contact related storage (the so called k-buckets).
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from drogulus.constants import K
+from nodeid import key_value
 
 
 class KBucketFull(Exception):
@@ -132,9 +133,7 @@ class KBucket(object):
         a boolean to indicate if a certain key should be placed within this
         k-bucket.
         """
-        if isinstance(key, str):
-            key = long(key.encode('hex'), 16)
-        return self.range_min <= key < self.range_max
+        return self.range_min <= key_value(key) < self.range_max
 
     def __len__(self):
         """
@@ -21,20 +21,117 @@ Contains code that defines the behaviour of the local node in the DHT network.
 from twisted.python import log
 from twisted.internet import reactor, defer
 from twisted.internet.endpoints import clientFromString
+from twisted.python.failure import Failure
 import time
 from uuid import uuid4
 
 from drogulus import constants
 from drogulus.net.messages import (Error, Ping, Pong, Store, FindNode, Nodes,
-                                   FindValue, Value)
-from drogulus.net.protocol import DHTFactory
+                                   FindValue, Value, Batch, BatchReply,
+                                   to_msgpack, decode, share_strings)
+from drogulus.net.interning import SHARED_STRINGS, NODE_IDS
+from drogulus.net.protocol import DHTFactory, BackpressureStats
+from drogulus.net.tls import TLSSessionCache
+from drogulus.net.packing import pack_nodes
 from routingtable import RoutingTable
 from datastore import DictDataStore
 from contact import Contact
-from drogulus.crypto import validate_message, construct_key, generate_signature
+from nodeid import to_node_id
+from ratelimit import RateLimiter
+from verification import ThreadedVerifier
+from drogulus.crypto import (construct_key, generate_signature, StreamedValue,
+                             Signer, prehash_value)
 from drogulus.version import get_version
 
 
+#: The client string used to connect to other nodes unless otherwise specified.
+DEFAULT_CLIENT_STRING = 'ssl:%s:%d'
+
+
+#: Maps each type of message to a tuple containing the function that handles
+#: it and the budget used to rate limit it (None for no rate limit). Each
+#: function is called with the local node, the message, the protocol it
+#: arrived via and the Contact representing the sender and may return a
+#: deferred if handling the message continues asynchronously. Responses to
+#: requests made by the local node have a budget of their own. Errors are
+#: not rate limited (shedding them would only result in another error). See
+#: register_handler and message_cost.
+HANDLERS = {}
+
+
+def register_handler(klass, handler, budget=None):
+    """
+    Registers the function used to handle incoming messages of the referenced
+    class along with the budget ('cheap', 'expensive', 'response' or 'batch')
+    used to rate limit them. If budget is None such messages are not rate
+    limited.
+    """
+    HANDLERS[klass] = (handler, budget)
+
+
+register_handler(Ping, lambda node, message, protocol, sender:
+                 node.handle_ping(message, protocol), 'cheap')
+register_handler(Pong, lambda node, message, protocol, sender:
+                 node.handle_pong(message), 'response')
+register_handler(Store, lambda node, message, protocol, sender:
+                 node.handle_store(message, protocol, sender), 'expensive')
+register_handler(FindNode, lambda node, message, protocol, sender:
+                 node.handle_find_node(message, protocol), 'cheap')
+register_handler(FindValue, lambda node, message, protocol, sender:
+                 node.handle_find_value(message, protocol), 'cheap')
+register_handler(Error, lambda node, message, protocol, sender:
+                 node.handle_error(message, protocol, sender))
+register_handler(Value, lambda node, message, protocol, sender:
+                 node.handle_value(message, sender), 'response')
+register_handler(Nodes, lambda node, message, protocol, sender:
+                 node.handle_nodes(message), 'response')
+# Batches are charged once for all the requests (or replies) they contain.
+register_handler(Batch, lambda node, message, protocol, sender:
+                 node.handle_batch(message, protocol), 'batch')
+register_handler(BatchReply, lambda node, message, protocol, sender:
+                 node.handle_batch_reply(message, protocol), 'response')
+
+
+#: The types of request that may be sent in a Batch message.
+BATCHED_REQUESTS = (Store, FindValue)
+
+#: The types of reply that may be returned in a BatchReply message.
+BATCHED_REPLIES = (Pong, Value, Nodes, Error)
+
+
+def message_cost(message):
+    """
+    Returns the number of tokens the message costs against its budget: one
+    for each request (or reply) carried by a Batch (or BatchReply) message,
+    otherwise one.
+    """
+    if isinstance(message, Batch):
+        return max(len(message.messages), 1)
+    if isinstance(message, BatchReply):
+        return max(len(message.results), 1)
+    return 1
+
+
+class BatchedProtocol(object):
+    """
+    Stands in for the protocol when the requests in a Batch message are
+    handled. The replies that would have been sent to the peer are collected
+    instead so they can be returned together in a BatchReply.
+    """
+
+    def __init__(self, protocol):
+        self.transport = protocol.transport
+        self.peer_capabilities = protocol.peer_capabilities
+        self.except_to_error = protocol.except_to_error
+        self.replies = []
+
+    def sendMessage(self, msg, loseConnection=False):
+        """
+        Collects the reply (the connection is left to the real protocol).
+        """
+        self.replies.append(msg)
+
+
 def response_timeout(message, protocol, node):
     """
     Called when a pending message (identified with a uuid) awaiting a response
@@ -109,14 +206,18 @@ class Node(object):
     performed via this class (or a subclass).
     """
 
-    def __init__(self, id, client_string='ssl:%s:%d'):
+    def __init__(self, id, client_string=DEFAULT_CLIENT_STRING,
+                 verifier=None):
         """
-        Initialises the object representing the node with the given id.
+        Initialises the object representing the node with the given id. The
+        verifier checks the provenance of value carrying messages (see
+        drogulus.dht.verification) and defaults to a pool of
+        VERIFICATION_WORKERS threads.
         """
         # The node's ID within the distributed hash table.
-        self.id = id
+        self.id = to_node_id(id)
         # The routing table stores information about other nodes on the DHT.
-        self._routing_table = RoutingTable(id)
+        self._routing_table = RoutingTable(self.id)
         # The local key/value store containing data held by this node.
         self._data_store = DictDataStore()
         # A dictionary of IDs for messages pending a response and associated
@@ -125,10 +226,38 @@ class Node(object):
         # The template string to use when initiating a connection to another
         # node on the network.
         self._client_string = client_string
+        # Shares a TLS context between outgoing connections and remembers the
+        # sessions negotiated with peers so they can be resumed.
+        self._tls_sessions = TLSSessionCache()
         # The version of Drogulus that this node implements.
         self.version = get_version()
+        # Tracks data queued for slow peers across all connections.
+        self.backpressure = BackpressureStats()
+        # Limits the rate at which requests from each peer are handled.
+        self._rate_limiter = RateLimiter({
+            'cheap': (constants.CHEAP_RPC_RATE, constants.CHEAP_RPC_BURST),
+            'expensive': (constants.EXPENSIVE_RPC_RATE,
+                          constants.EXPENSIVE_RPC_BURST),
+            'response': (constants.RESPONSE_RATE, constants.RESPONSE_BURST),
+            'batch': (constants.BATCHED_RPC_RATE,
+                      constants.BATCHED_RPC_BURST),
+        })
+        # Verifies Store and Value messages away from the reactor.
+        if verifier is None:
+            verifier = ThreadedVerifier()
+        self._verifier = verifier
+        # Signs the values published by the local node (see load_identity).
+        self.signer = None
         log.msg('Initialised node with id: %r' % self.id)
 
+    def load_identity(self, private_key, public_key=None):
+        """
+        Loads the private key (and, optionally, the matching public key) of
+        the identity used to sign the values published by the local node.
+        The key is parsed once and kept for as long as the node runs.
+        """
+        self.signer = Signer(private_key, public_key)
+
     def join(self, seed_nodes=None):
         """
         Causes the Node to join the DHT network. This should be called before
@@ -140,32 +269,61 @@ class Node(object):
 
     def message_received(self, message, protocol):
         """
-        Handles incoming messages.
+        Handles incoming messages by passing them to the handler registered
+        for their type (see register_handler). Requests from peers that have
+        exceeded their rate limit are shed with an error 9 (Too many requests)
+        before any further work is done. Returns whatever the handler returns
+        (a deferred if handling the message continues asynchronously).
+        """
+        peer = protocol.transport.getPeer()
+        budget = HANDLERS.get(message.__class__, (None, None))[1]
+        if budget and not self._rate_limiter.allow(
+                budget, (message.node, peer.host),
+                cost=message_cost(message)):
+            log.msg('Rate limit exceeded by %s' % peer.host)
+            details = {
+                'context': 'Rate limit exceeded. Try again later.'
+            }
+            raise ValueError(9, constants.ERRORS[9], details, message.uuid)
+        return self.dispatch(message, protocol)
+
+    def dispatch(self, message, protocol):
+        """
+        Updates the routing table with the sender's details and passes the
+        message to the handler registered for its type without rate limiting
+        it. The requests (or replies) carried by a Batch (or BatchReply) are
+        dispatched like this since the sender has already been charged for
+        them (see message_cost). Returns whatever the handler returns.
         """
-        # Update the routing table.
         peer = protocol.transport.getPeer()
-        other_node = Contact(message.node, peer.host, peer.port,
-                             message.version, time.time())
+        handler = HANDLERS.get(message.__class__, (None, None))[0]
+        # Update the routing table.
+        # The contact shares the strings that repeat across messages (the
+        # peer's capabilities are already shared, see mask_to_capabilities).
+        other_node = Contact(NODE_IDS.get(message.node), peer.host,
+                             peer.port, SHARED_STRINGS.intern(message.version),
+                             time.time())
+        other_node.capabilities = protocol.peer_capabilities
         log.msg('Message received from %s' % other_node)
         log.msg(message)
         self._routing_table.add_contact(other_node)
-        # Sort on message type and pass to handler method. Explicit > implicit.
-        if isinstance(message, Ping):
-            self.handle_ping(message, protocol)
-        elif isinstance(message, Pong):
-            self.handle_pong(message)
-        elif isinstance(message, Store):
-            self.handle_store(message, protocol, other_node)
-        elif isinstance(message, FindNode):
-            self.handle_find_node(message, protocol)
-        elif isinstance(message, FindValue):
-            self.handle_find_value(message, protocol)
-        elif isinstance(message, Error):
-            self.handle_error(message, protocol, other_node)
-        elif isinstance(message, Value):
-            self.handle_value(message, other_node)
-        elif isinstance(message, Nodes):
-            self.handle_nodes(message)
+        # Pass the message to the handler registered for its type.
+        if handler:
+            return handler(self, message, protocol, other_node)
+
+    def client_endpoint(self, contact):
+        """
+        Returns the endpoint to use to connect to the specified contact. Plain
+        "ssl:" connections make use of the node's TLS session cache so that
+        reconnecting to a recently contacted peer results in an abbreviated
+        handshake. Otherwise, the endpoint is created from the node's client
+        string.
+        """
+        if self._client_string == DEFAULT_CLIENT_STRING:
+            return self._tls_sessions.endpoint(reactor, contact.address,
+                                               contact.port)
+        client_string = self._client_string % (contact.address, contact.port)
+        return clientFromString(reactor, client_string)
 
     def send_message(self, contact, message):
         """
@@ -175,8 +333,7 @@ class Node(object):
         """
         d = defer.Deferred()
         # open network call.
-        client_string = self._client_string % (contact.address, contact.port)
-        client = clientFromString(reactor, client_string)
+        client = self.client_endpoint(contact)
         connection = client.connect(DHTFactory(self))
         # Ensure the connection will potentially time out.
         connection_timeout = reactor.callLater(constants.RPC_TIMEOUT,
@@ -186,7 +343,9 @@ class Node(object):
             # Cancel pending connection_timeout if it's still active.
             if connection_timeout.active():
                 connection_timeout.cancel()
-            # Send the message and add a timeout for the response.
+            # Send the message (using the optional protocol features the
+            # contact is known to support) and add a timeout for the response.
+            protocol.peer_capabilities = contact.capabilities
             protocol.sendMessage(message)
             self._pending[message.uuid] = d
             reactor.callLater(constants.RESPONSE_TIMEOUT, response_timeout,
@@ -240,10 +399,22 @@ class Node(object):
         <= the message's expiry time.
 
         Sends a Pong message if successful otherwise replies with an
-        appropriate Error.
+        appropriate Error. The provenance of the message is checked by the
+        node's verifier so this returns a deferred that fires once the
+        message has been handled.
         """
         # Check provenance
-        is_valid, err_code = validate_message(message)
+        d = self._verifier.verify(message)
+        d.addCallback(self._store_verified, message, protocol, sender)
+        d.addErrback(self._send_error, protocol)
+        return d
+
+    def _store_verified(self, result, message, protocol, sender):
+        """
+        Called with the result of verifying a Store message (see
+        handle_store). Raises a ValueError if the message can't be stored.
+        """
+        is_valid, err_code = result
         if is_valid:
             # Ensure the node doesn't already have a more up-to-date version
             # of the value.
@@ -256,7 +427,9 @@ class Node(object):
                 }
                 raise ValueError(8, constants.ERRORS[8], details,
                                  message.uuid)
-            # Good to go, so store value.
+            # Good to go, so store value (sharing the strings it has in common
+            # with other messages).
+            message = share_strings(message)
             self._data_store.set_item(message.key, message)
             # Reply with a pong so the other end updates its routing table.
             pong = Pong(message.uuid, self.id, self.version)
@@ -277,17 +450,34 @@ class Node(object):
             raise ValueError(err_code, constants.ERRORS[err_code], details,
                              message.uuid)
 
+    def _send_error(self, failure, protocol):
+        """
+        Replies to the peer with an Error describing the failure (exactly as
+        DHTProtocol does for exceptions raised by a handler) and drops the
+        connection.
+        """
+        log.msg('***** ERROR *****')
+        log.msg(failure.value)
+        protocol.sendMessage(protocol.except_to_error(failure.value), True)
+
     def handle_find_node(self, message, protocol):
         """
         Handles an incoming FindNode message. Finds the details of up to K
         other nodes closer to the target key that *this* node knows about.
         Responds with a "Nodes" message containing the list of matching
-        nodes.
+        nodes (packed if the peer has advertised the 'packed_nodes'
+        capability).
         """
         target_key = message.key
         # List containing tuples of information about the matching contacts.
         other_nodes = [(n.id, n.address, n.port, n.version) for n in
                        self._routing_table.find_close_nodes(target_key)]
+        if 'packed_nodes' in protocol.peer_capabilities:
+            try:
+                other_nodes = pack_nodes(other_nodes)
+            except ValueError:
+                # Some contacts cannot be packed so send them as tuples.
+                pass
         result = Nodes(message.uuid, self.id, other_nodes, self.version)
         protocol.sendMessage(result, True)
 
@@ -323,14 +513,34 @@ class Node(object):
         """
         Handles an incoming Value message containing a value retrieved from
         another node on the DHT. Ensures the message is valid and calls the
-        referenced deferred to signal the arrival of the value.
+        referenced deferred to signal the arrival of the value. The provenance
+        of the message is checked by the node's verifier so this returns a
+        deferred that fires once the message has been handled.
+
+        Values that are not a response to a pending request are dropped
+        before any verification takes place. Otherwise the deferred awaiting
+        the value is removed from the _pending dictionary straight away so it
+        can't time out (or be answered again) while the message is verified.
+        """
+        deferred = self._pending.pop(message.uuid, None)
+        if deferred is None:
+            log.msg('Unsolicited Value from %s' % sender)
+            return None
+        # Check provenance
+        d = self._verifier.verify(message)
+        d.addCallbacks(self._value_verified, self._value_unverified,
+                       callbackArgs=(message, sender, deferred),
+                       errbackArgs=(message, deferred))
+        return d
 
-        TODO: How to handle invalid messages and errback the deferred.
+    def _value_verified(self, result, message, sender, deferred):
         """
-        # Check provenance
-        is_valid, err_code = validate_message(message)
+        Called with the result of verifying a Value message (see
+        handle_value).
+        """
+        is_valid, err_code = result
         if is_valid:
-            self.trigger_deferred(message)
+            deferred.callback(message)
         else:
             log.msg('Problem with incoming Value: %d - %s' %
                     (err_code, constants.ERRORS[err_code]))
@@ -338,7 +548,19 @@ class Node(object):
             # Remove the remote node from the routing table.
             self._routing_table.remove_contact(sender.id, True)
             error = ValueError(constants.ERRORS[err_code])
-            self.trigger_deferred(message, error)
+            error.message = message
+            deferred.errback(error)
+
+    def _value_unverified(self, failure, message, deferred):
+        """
+        Called if a Value message couldn't be verified at all (for example,
+        because too many messages are awaiting verification). The deferred
+        awaiting the value is errbacked with the reason.
+        """
+        log.msg('Unable to verify incoming Value: %s' % failure.value)
+        error = failure.value
+        error.message = message
+        deferred.errback(error)
 
     def handle_nodes(self, message):
         """
@@ -347,6 +569,91 @@ class Node(object):
         """
         self.trigger_deferred(message)
 
+    def handle_batch(self, message, protocol):
+        """
+        Handles an incoming Batch message. Each request in the batch is
+        handled as if it had arrived on its own (except that the sender was
+        charged for all of them when the batch arrived). The replies,
+        including an Error for each request that fails, are sent back in a
+        single BatchReply message once every request has been handled.
+        Replies that would take the BatchReply beyond MAX_BATCH_PAYLOAD bytes
+        (usually Values) are sent on their own just before it. Returns a
+        deferred that fires when the reply has been sent.
+        """
+        batched = BatchedProtocol(protocol)
+        handled = []
+        for raw in message.messages:
+            try:
+                request, capabilities = decode(raw)
+                if not isinstance(request, BATCHED_REQUESTS):
+                    details = {
+                        'context': '%s messages cannot be batched.' %
+                        request.__class__.__name__
+                    }
+                    raise ValueError(2, constants.ERRORS[2], details,
+                                     request.uuid)
+                result = self.dispatch(request, batched)
+                if isinstance(result, defer.Deferred):
+                    handled.append(result)
+            except Exception, ex:
+                batched.replies.append(protocol.except_to_error(ex))
+
+        def send_reply(ignored):
+            results = []
+            size = 0
+            for reply in batched.replies:
+                raw = protocol.encode(reply)
+                if size + len(raw) > constants.MAX_BATCH_PAYLOAD:
+                    # Send it on its own (in chunks if need be) ahead of the
+                    # BatchReply.
+                    protocol.sendMessage(reply)
+                else:
+                    results.append(raw)
+                    size += len(raw)
+            reply = BatchReply(message.uuid, self.id, tuple(results),
+                               self.version)
+            protocol.sendMessage(reply, True)
+
+        return defer.DeferredList(handled).addCallback(send_reply)
+
+    def handle_batch_reply(self, message, protocol):
+        """
+        Handles an incoming BatchReply message. The reply to each request in
+        the batch is handled as if it had arrived on its own, except that an
+        Error (or a reply that can't be handled) results in the errback of
+        the deferred for the request it relates to. Finally, once every reply
+        has been handled, the deferred for the batch itself is fired. Returns
+        a deferred that fires at the same time.
+        """
+        handled = []
+        for raw in message.results:
+            try:
+                result, capabilities = decode(raw)
+            except Exception, ex:
+                log.msg('Unable to decode reply in batch %s' % message.uuid)
+                log.msg(ex)
+                continue
+            if not isinstance(result, BATCHED_REPLIES):
+                log.msg('Unexpected reply in batch %s' % message.uuid)
+                log.msg(result)
+            elif isinstance(result, Error):
+                error = ValueError(result.code, result.title, result.details,
+                                   result.uuid)
+                self.trigger_deferred(result, error)
+            else:
+                try:
+                    d = self.dispatch(result, protocol)
+                except Exception, ex:
+                    log.msg('Unable to handle reply in batch %s' %
+                            message.uuid)
+                    log.msg(ex)
+                    self.trigger_deferred(result, ex)
+                    continue
+                if isinstance(d, defer.Deferred):
+                    handled.append(d)
+        return defer.DeferredList(handled).addCallback(
+            lambda ignored: self.trigger_deferred(message))
+
     def iterative_lookup(self, key, message_class):
         """
         A generic lookup function for finding nodes or values within the
@@ -373,15 +680,60 @@ class Node(object):
         the message is stored against a key derived from the public_key and
         name. Furthermore, the message is cryptographically signed using the
         value, timestamp, expires, name and meta values.
+
+        The value may be a StreamedValue (for example, wrapping a large file
+        on disk) in which case it is hashed as it is read and only loaded
+        into memory once signed. Since the value is read twice it must come
+        from a file-like source: a StreamedValue wrapping an iterable results
+        in a TypeError before anything is read.
+        """
+        new_store = self.make_store(private_key, public_key, name, value,
+                                    timestamp, expires, meta)
+        return self.send_replicate(new_store)
+
+    def make_store(self, private_key, public_key, name, value, timestamp,
+                   expires, meta):
+        """
+        Returns a new signed Store message from the local node (see
+        send_store). The private key may be a Signer.
         """
+        if isinstance(value, StreamedValue) and not value.loadable:
+            raise TypeError('Only values from file-like sources can be '
+                            'stored.')
         new_uuid = str(uuid4())
         signature = generate_signature(value, timestamp, expires, name, meta,
                                        private_key)
+        if isinstance(value, StreamedValue):
+            value = value.load()
         compound_key = construct_key(public_key, name)
-        new_store = Store(new_uuid, self.id, compound_key, value, timestamp,
-                          expires, public_key, name, meta, signature,
-                          self.version)
-        return self.send_replicate(new_store)
+        return Store(new_uuid, self.id, compound_key, value, timestamp,
+                     expires, public_key, name, meta, signature, self.version)
+
+    def publish(self, name, value, timestamp=None, expires=0.0, meta=None):
+        """
+        Publishes the value under the name using the identity loaded with
+        load_identity. The timestamp defaults to the current time. Returns a
+        deferred that fires with the result of send_store. Large values are
+        hashed away from the reactor first (see prehash_value). Raises a
+        ValueError if no identity has been loaded.
+        """
+        if self.signer is None:
+            raise ValueError('No identity has been loaded.')
+        if timestamp is None:
+            timestamp = time.time()
+        d = prehash_value(value)
+        d.addCallback(lambda value: self.send_store(
+            self.signer, self.signer.public_key, name, value, timestamp,
+            expires, meta or {}))
+        return d
+
+    def publish_many(self, values):
+        """
+        Publishes each (name, value, timestamp, expires, meta) tuple in the
+        values using the identity loaded with load_identity (see publish).
+        Returns a list of deferreds, one for each value.
+        """
+        return [self.publish(*value) for value in values]
 
     def send_replicate(self, store_message):
         """
@@ -400,6 +752,75 @@ class Node(object):
                       store_message.sig, self.version)
         return self.send_message(contact, store)"""
 
+    def send_batch(self, contact, messages):
+        """
+        Sends the Store and/or FindValue messages to the specified contact in
+        as few Batch messages as possible (each containing no more than
+        MAX_BATCH_SIZE requests and MAX_BATCH_PAYLOAD bytes of encoded
+        requests). Returns a list of deferreds, one for each message, that
+        behave as if the message had been sent on its own with send_message:
+        they are kept in the _pending dictionary under each message's uuid
+        until the corresponding reply arrives.
+
+        If the contact has not advertised the 'batch' capability each message
+        is simply sent on its own, as is any message too big to fit in a
+        batch.
+        """
+        if 'batch' not in contact.capabilities:
+            return [self.send_message(contact, message)
+                    for message in messages]
+        compact = 'compact' in contact.capabilities
+        deferreds = []
+        batch = []
+        size = 0
+        for message in messages:
+            raw = to_msgpack(message, compact)
+            if len(raw) > constants.MAX_BATCH_PAYLOAD:
+                deferreds.append(self.send_message(contact, message))
+                continue
+            if (len(batch) == constants.MAX_BATCH_SIZE or
+                    size + len(raw) > constants.MAX_BATCH_PAYLOAD):
+                self._send_batch(contact, batch)
+                batch = []
+                size = 0
+            d = defer.Deferred()
+            self._pending[message.uuid] = d
+            deferreds.append(d)
+            batch.append((message.uuid, d, raw))
+            size += len(raw)
+        if batch:
+            self._send_batch(contact, batch)
+        return deferreds
+
+    def _send_batch(self, contact, batch):
+        """
+        Sends a single Batch message to the specified contact given a list of
+        (uuid, deferred, encoded request) tuples for the requests it
+        contains (see send_batch).
+        """
+        pending = [(uuid, d) for uuid, d, raw in batch]
+        message = Batch(str(uuid4()), self.id,
+                        tuple(raw for uuid, d, raw in batch), self.version)
+        d = self.send_message(contact, message)
+        d.addBoth(self._settle_batch, pending)
+
+    def _settle_batch(self, result, pending):
+        """
+        Called when a batch sent with send_batch has been replied to (or has
+        failed). Errbacks the deferred of each request in the pending list of
+        (uuid, deferred) tuples that is still awaiting a reply with either
+        the failure or, if there was no reply to the request in the batch, a
+        ValueError.
+        """
+        for uuid, d in pending:
+            if self._pending.get(uuid) is d:
+                del self._pending[uuid]
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.errback(ValueError(1, constants.ERRORS[1], {
+                        'context': 'No reply to request in batch.'}, uuid))
+
     def send_find_node(self, contact, id):
         """
         Sends a FindNode message to the given contact with the intention of
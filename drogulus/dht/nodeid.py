@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the NodeID class used to represent the IDs of nodes (and the keys
+of values) within the DHT.
+
+IDs arrive from the network as strings of bytes but the routing table works
+with their numeric value: to find the k-bucket that covers an ID and to
+measure the distance between IDs. A NodeID is a string that also holds its
+numeric value, so the conversion happens once, when the ID enters the
+routing table (or is created locally), rather than every time it is used.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from drogulus.utils import long_to_hex, hex_to_long
+
+
+class NodeID(str):
+    """
+    An immutable ID (a string of bytes) that carries its numeric value. A
+    NodeID is equal to (and hashes the same as) the equivalent string so it
+    can be used wherever IDs are used as strings: in messages, as dictionary
+    keys and when comparing with contacts.
+    """
+
+    def __new__(cls, raw, value=None):
+        instance = str.__new__(cls, raw)
+        if value is None:
+            value = hex_to_long(raw) if raw else 0L
+        instance.value = value
+        return instance
+
+    @classmethod
+    def from_long(cls, value):
+        """
+        Returns the NodeID with the given numeric value. A TypeError is raised
+        if the value is negative.
+        """
+        return cls(long_to_hex(value), value)
+
+    def distance(self, other):
+        """
+        Returns the XOR distance between this ID and the other ID (or key).
+        """
+        return self.value ^ key_value(other)
+
+    def __reduce__(self):
+        return (NodeID, (str(self), self.value))
+
+
+def to_node_id(key):
+    """
+    Returns the key (a string or numeric value) as a NodeID. Keys that are
+    already NodeIDs are returned as they are.
+    """
+    if isinstance(key, NodeID):
+        return key
+    if isinstance(key, (int, long)):
+        return NodeID.from_long(key)
+    return NodeID(key)
+
+
+def key_value(key):
+    """
+    Returns the numeric value of the key (a NodeID, string or numeric value).
+    """
+    if isinstance(key, NodeID):
+        return key.value
+    if isinstance(key, (int, long)):
+        return key
+    return hex_to_long(key)
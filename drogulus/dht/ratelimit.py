@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Contains classes used to limit the rate at which the local node will handle
+requests from other nodes on the network.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import time
+
+
+class TokenBucket(object):
+    """
+    A bucket that fills with tokens at a fixed rate up to a maximum capacity.
+    Each request consumes a token. If there are no tokens left the request
+    is over budget.
+    """
+
+    def __init__(self, rate, capacity, now=None):
+        """
+        Initialises a full bucket that gains rate tokens per second up to
+        capacity tokens.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.last_updated = now if now is not None else time.time()
+
+    def refill(self, now):
+        """
+        Adds the tokens accumulated since the bucket was last updated.
+        """
+        elapsed = max(0, now - self.last_updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.last_updated = now
+
+
+class RateLimiter(object):
+    """
+    Keeps a token bucket for each combination of budget and peer. Peers are
+    identified by several keys (for example, their node ID and IP address)
+    and a request is only allowed if there is a token in the buckets for all
+    of them. This stops a peer from avoiding the limit by simply changing its
+    node ID.
+
+    To bound memory use, only the buckets for the max_size most recently seen
+    keys are remembered.
+    """
+
+    def __init__(self, budgets, max_size=4096):
+        """
+        The budgets argument is a dictionary that maps the name of a budget to
+        a tuple containing the rate (tokens per second) and capacity (burst
+        size) of the buckets for that budget.
+        """
+        self.budgets = budgets
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def _get_bucket(self, budget, key, now):
+        """
+        Returns the bucket for the given budget and key, creating it if
+        required. Marks the bucket as most recently used.
+        """
+        bucket_key = (budget, key)
+        bucket = self._buckets.pop(bucket_key, None)
+        if bucket is None:
+            rate, capacity = self.budgets[budget]
+            bucket = TokenBucket(rate, capacity, now)
+            if len(self._buckets) >= self.max_size:
+                # Forget the least recently used bucket.
+                self._buckets.popitem(last=False)
+        self._buckets[bucket_key] = bucket
+        return bucket
+
+    def allow(self, budget, keys, now=None, cost=1):
+        """
+        Returns a boolean to indicate if a request from the peer identified by
+        the given keys is within the referenced budget. If it is, cost tokens
+        (one unless the request carries several others) are consumed from
+        each of the peer's buckets.
+        """
+        if now is None:
+            now = time.time()
+        buckets = [self._get_bucket(budget, key, now) for key in keys]
+        for bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < cost:
+                return False
+        for bucket in buckets:
+            bucket.tokens -= cost
+        return True
+
+    def __len__(self):
+        """
+        Returns the number of buckets currently held by the rate limiter.
+        """
+        return len(self._buckets)
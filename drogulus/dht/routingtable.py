@@ -22,7 +22,8 @@ import time
 import random
 import kbucket
 from drogulus import constants
-from drogulus.utils import long_to_hex, hex_to_long
+from drogulus.net.interning import NODE_IDS
+from nodeid import NodeID, to_node_id, key_value
 
 
 class RoutingTable(object):
@@ -44,17 +45,16 @@ class RoutingTable(object):
         # Create the initial (single) k-bucket covering the range of the
         # entire 512-bit ID space
         self._buckets = [kbucket.KBucket(range_min=0, range_max=2 ** 512)]
-        self._parent_node_id = parent_node_id
+        self._parent_node_id = to_node_id(parent_node_id)
         # Cache containing nodes eligible to replace stale k-bucket entries
         self._replacement_cache = {}
 
     def _kbucket_index(self, key):
         """
         Returns the index of the k-bucket responsible for the specified key
-        string.
+        (a NodeID, string or numeric value).
         """
-        if isinstance(key, str):
-            key = hex_to_long(key)
+        key = key_value(key)
         # Bound check for key too small.
         if key < 0:
             raise ValueError('Key out of range')
@@ -71,7 +71,7 @@ class RoutingTable(object):
         # Get a random integer within the required range.
         keyValue = random.randrange(self._buckets[bucket_index].range_min,
                                     self._buckets[bucket_index].range_max)
-        return long_to_hex(keyValue)
+        return NodeID.from_long(keyValue)
 
     def _split_bucket(self, old_bucket_index):
         """
@@ -109,6 +109,8 @@ class RoutingTable(object):
         bucket_index = self._kbucket_index(contact.id)
         try:
             self._buckets[bucket_index].add_contact(contact)
+            # Incoming messages from the contact will share its ID.
+            NODE_IDS.add(contact.id)
         except kbucket.KBucketFull:
             # The bucket is full; see if it can be split (by checking if its
             # range includes the host node's id)
@@ -138,12 +140,10 @@ class RoutingTable(object):
 
     def distance(self, key_one, key_two):
         """
-        Calculate the XOR result between two string variables returned as a
-        long type value.
+        Calculate the XOR result between two keys (NodeIDs or strings)
+        returned as a long type value.
         """
-        val_key_one = hex_to_long(key_one)
-        val_key_two = hex_to_long(key_two)
-        return val_key_one ^ val_key_two
+        return to_node_id(key_one).distance(key_two)
 
     def find_close_nodes(self, key, rpc_node_id=None):
         """
@@ -243,12 +243,14 @@ class RoutingTable(object):
         contact.failed_RPCs += 1
         if forced or contact.failed_RPCs >= constants.ALLOWED_RPC_FAILS:
             self._buckets[bucket_index].remove_contact(contact_id)
+            NODE_IDS.discard(contact_id)
             # If possible, replace the stale contact with the most recent
             # contact stored in the replacement cache.
             if bucket_index in self._replacement_cache:
                 if len(self._replacement_cache[bucket_index]) > 0:
-                    self._buckets[bucket_index].add_contact(
-                        self._replacement_cache[bucket_index].pop())
+                    replacement = self._replacement_cache[bucket_index].pop()
+                    self._buckets[bucket_index].add_contact(replacement)
+                    NODE_IDS.add(replacement.id)
 
     def touch_kbucket(self, key):
         """
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Contains classes used to verify the provenance of value carrying messages
+(see drogulus.crypto.validate_message) without blocking the reactor.
+
+Checking an RSA signature takes long enough that a burst of Store messages
+verified on the reactor thread adds latency to every other message the node
+handles. Verifiers return a deferred that fires with the result of
+validate_message so the node can carry on handling other messages while the
+signature is checked in a pool of threads or processes. Each verifier limits
+the number of messages awaiting verification and sheds the rest with an
+error 9 (Too many requests).
+
+When many Store messages arrive in quick succession (for example, during
+replication) a BatchingVerifier gathers them into batches that are shared
+between worker processes, so throughput scales with the number of cores and
+each distinct signature in a batch is only checked once.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
+from twisted.python import log
+from drogulus import constants
+from drogulus.crypto import validate_message, validate_messages
+import multiprocessing
+import signal
+
+
+class Verifier(object):
+    """
+    Verifies messages on the reactor thread. The returned deferreds have
+    already fired so this is only suitable for tests and for nodes that
+    handle very few Store messages. Subclasses verify messages elsewhere by
+    overriding the submit method.
+    """
+
+    def __init__(self, max_queue=constants.MAX_VERIFICATION_QUEUE):
+        """
+        No more than max_queue messages may await verification at once.
+        """
+        self.max_queue = max_queue
+        # The number of messages currently awaiting verification.
+        self.queued = 0
+        # The number of messages shed because the queue was full.
+        self.shed = 0
+
+    def verify(self, message):
+        """
+        Returns a deferred that fires with the (is_valid, error_number) tuple
+        returned by validate_message for the message. If too many messages
+        are already awaiting verification the deferred fails with an error 9
+        (Too many requests) instead.
+        """
+        if self.queued >= self.max_queue:
+            self.shed += 1
+            details = {
+                'context': 'Too many messages awaiting verification.'
+            }
+            return defer.fail(ValueError(9, constants.ERRORS[9], details,
+                                         message.uuid))
+        self.queued += 1
+        d = self.submit(message)
+        d.addBoth(self._verified)
+        return d
+
+    def _verified(self, result):
+        """
+        Called once a message has been verified (or verification failed).
+        """
+        self.queued -= 1
+        return result
+
+    def submit(self, message):
+        """
+        Returns a deferred that fires with the result of validate_message for
+        the message.
+        """
+        return defer.maybeDeferred(validate_message, message)
+
+    def stop(self):
+        """
+        Stops any workers used to verify messages.
+        """
+        pass
+
+
+class ThreadedVerifier(Verifier):
+    """
+    Verifies messages in a pool of threads. The pool is started when the
+    first message is verified and stopped when the reactor shuts down.
+    """
+
+    def __init__(self, workers=constants.VERIFICATION_WORKERS,
+                 max_queue=constants.MAX_VERIFICATION_QUEUE):
+        super(ThreadedVerifier, self).__init__(max_queue)
+        self.workers = workers
+        self._pool = None
+
+    def submit(self, message):
+        if self._pool is None:
+            self._pool = ThreadPool(self.workers, self.workers,
+                                    'drogulus-verification')
+            self._pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        return threads.deferToThreadPool(reactor, self._pool,
+                                         validate_message, message)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+
+def start_worker():
+    """
+    Called in each new worker process. Worker processes are forked from the
+    node so they inherit the reactor's signal handlers, which would stop the
+    worker from ever being terminated. The default handler for SIGTERM is
+    restored and SIGINT is ignored (it is handled by the node).
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def verify_in_process(message):
+    """
+    Called in a worker process to verify the message. Returns a tuple
+    containing a flag to indicate success and either the result of
+    validate_message or the exception it raised.
+    """
+    try:
+        return True, validate_message(message)
+    except Exception, ex:
+        return False, ex
+
+
+class ProcessVerifier(Verifier):
+    """
+    Verifies messages in a pool of worker processes so that verification
+    makes use of every core rather than contending for the GIL. Messages
+    (and the results) are pickled to and from the workers, so this only pays
+    off for nodes that handle many Store messages. The pool is started when
+    the first message is verified and stopped when the reactor shuts down.
+
+    Messages that aren't verified within timeout seconds (because the worker
+    died or the message couldn't be sent to it) fail with an error 3
+    (Internal error).
+    """
+
+    def __init__(self, workers=constants.VERIFICATION_WORKERS,
+                 max_queue=constants.MAX_VERIFICATION_QUEUE,
+                 timeout=constants.VERIFICATION_TIMEOUT):
+        super(ProcessVerifier, self).__init__(max_queue)
+        self.workers = workers
+        self.timeout = timeout
+        # The number of messages that failed because they timed out.
+        self.timed_out = 0
+        self._pool = None
+
+    def submit(self, message):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, start_worker)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        d = defer.Deferred()
+        timeout = reactor.callLater(self.timeout, self._expire,
+                                    [(message, d)])
+        # The callback is called in one of the pool's threads.
+        self._pool.apply_async(verify_in_process, (message, ), callback=(
+            lambda result: reactor.callFromThread(self._deliver, d, result,
+                                                  timeout)))
+        return d
+
+    def _expire(self, pending):
+        """
+        Fails the deferred of each (message, deferred) tuple that is still
+        awaiting a result from a worker process.
+        """
+        for message, d in pending:
+            if not d.called:
+                self.timed_out += 1
+                log.msg('Verification of %s timed out.' % message.uuid)
+                details = {
+                    'context': 'Verification timed out.'
+                }
+                d.errback(ValueError(3, constants.ERRORS[3], details,
+                                     message.uuid))
+
+    def _deliver(self, d, result, timeout=None):
+        """
+        Fires the deferred with the result from a worker process (unless it
+        has already timed out).
+        """
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if d.called:
+            return
+        succeeded, value = result
+        if succeeded:
+            d.callback(value)
+        else:
+            d.errback(value)
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+
+def verify_batch_in_process(messages):
+    """
+    Called in a worker process to verify a list of messages. Returns a tuple
+    containing a flag to indicate success and either the list of results
+    returned by validate_messages or the exception it raised.
+    """
+    try:
+        return True, validate_messages(messages)
+    except Exception, ex:
+        return False, ex
+
+
+class BatchingVerifier(ProcessVerifier):
+    """
+    Gathers messages into batches (of up to batch_size messages, or however
+    many arrive within delay seconds of the first) that are verified in a
+    pool of worker processes. Each batch is split between the workers and
+    messages with the same public key and signature are always verified by
+    the same worker so that signatures are only checked once (see
+    validate_messages). Each worker keeps its own cache of parsed keys. If
+    a worker doesn't answer within timeout seconds every message in its part
+    of the batch fails with an error 3 (Internal error).
+    """
+
+    def __init__(self, workers=constants.VERIFICATION_WORKERS,
+                 max_queue=constants.MAX_VERIFICATION_QUEUE,
+                 batch_size=constants.VERIFICATION_BATCH_SIZE,
+                 delay=constants.VERIFICATION_BATCH_DELAY,
+                 timeout=constants.VERIFICATION_TIMEOUT):
+        super(BatchingVerifier, self).__init__(workers, max_queue, timeout)
+        self.batch_size = batch_size
+        self.delay = delay
+        # The (message, deferred) tuples awaiting the next flush.
+        self._batch = []
+        self._flush_call = None
+
+    def submit(self, message):
+        d = defer.Deferred()
+        self._batch.append((message, d))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = reactor.callLater(self.delay, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Sends the messages gathered so far to the worker processes.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.workers, start_worker)
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        # Messages with the same public key and signature go to the same
+        # worker.
+        groups = {}
+        for message, d in batch:
+            signed = (message.public_key, message.sig)
+            groups.setdefault(signed, []).append((message, d))
+        chunks = [[] for i in range(min(self.workers, len(groups)))]
+        for i, group in enumerate(groups.itervalues()):
+            chunks[i % len(chunks)].extend(group)
+        for chunk in chunks:
+            messages = [message for message, d in chunk]
+            deferreds = [d for message, d in chunk]
+            # If the chunk is lost every message in it fails.
+            timeout = reactor.callLater(self.timeout, self._expire, chunk)
+            self._pool.apply_async(
+                verify_batch_in_process, (messages, ),
+                callback=lambda result, deferreds=deferreds, timeout=timeout:
+                reactor.callFromThread(self._deliver_batch, deferreds,
+                                       result, timeout))
+
+    def _deliver_batch(self, deferreds, result, timeout=None):
+        """
+        Fires the deferreds with the results from a worker process (unless
+        they have already timed out).
+        """
+        if timeout is not None and timeout.active():
+            timeout.cancel()
+        if any(d.called for d in deferreds):
+            return
+        succeeded, value = result
+        if succeeded:
+            for d, result in zip(deferreds, value):
+                d.callback(result)
+        else:
+            for d in deferreds:
+                d.errback(value)
+
+    def stop(self):
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        super(BatchingVerifier, self).stop()
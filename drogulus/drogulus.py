@@ -19,6 +19,7 @@ Encapsulates a node in the Drogulus.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from dht import node
+from crypto import precompute_keys
 
 
 class Drogulus(node.Node):
@@ -27,11 +28,16 @@ class Drogulus(node.Node):
     class that should generally be instantiated.
     """
 
-    def __init__(self, alias=None):
+    def __init__(self, alias=None, public_key=None):
         if alias:
             self.alias = alias
         else:
             self.alias = {}
+        self.public_key = public_key
+        if public_key:
+            # The keys for the local identity are needed again and again so
+            # work them out once.
+            precompute_keys(public_key)
 
     def whois(self, public_key):
         """
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Contains bounded tables of strings that are shared between decoded messages.
+
+The same few versions and metadata keys (and the IDs of the nodes in the
+routing table) arrive in message after message. Replacing each newly decoded
+copy with the copy already held in a table means long lived objects, such as
+stored Store messages and Contact instances, share storage rather than each
+holding its own copy. The tables are bounded so a peer can't use them to
+exhaust the memory of the local node: IDs are only added by the routing
+table and peer supplied strings are short and forgotten when no longer
+used.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from drogulus.constants import (MAX_SHARED_STRING_BYTES,
+                                MAX_SHARED_STRING_LENGTH, MAX_SHARED_NODE_IDS)
+from collections import OrderedDict
+
+
+class InternTable(object):
+    """
+    Holds a single shared copy of up to max_size distinct (hashable) values.
+    Once the table is full new values are no longer added although existing
+    values continue to be shared.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._values = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, value):
+        return value in self._values
+
+    def get(self, value):
+        """
+        Returns the shared copy of the value if there is one, otherwise the
+        value itself.
+        """
+        return self._values.get(value, value)
+
+    def add(self, value):
+        """
+        Adds the value to the table if there is room and it isn't already
+        present.
+        """
+        if value not in self._values and len(self._values) < self.max_size:
+            self._values[value] = value
+
+    def intern(self, value):
+        """
+        Returns the shared copy of the value, adding the value to the table
+        (if there is room) if there isn't one yet.
+        """
+        shared = self._values.get(value)
+        if shared is None:
+            self.add(value)
+            return value
+        return shared
+
+    def discard(self, value):
+        """
+        Removes the value from the table if it is present.
+        """
+        self._values.pop(value, None)
+
+
+class StringTable(object):
+    """
+    Holds a single shared copy of the most recently used strings no longer
+    than max_length bytes, up to a total of max_bytes. The least recently
+    used strings are forgotten to make room for new ones. Longer strings (and
+    anything that isn't a string) are never shared.
+    """
+
+    def __init__(self, max_bytes, max_length):
+        self.max_bytes = max_bytes
+        self.max_length = max_length
+        # The total size of the strings in the table.
+        self.size = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, value):
+        return value in self._values
+
+    def _shareable(self, value):
+        """
+        Returns a boolean to indicate if the value may be held in the table.
+        """
+        return isinstance(value, str) and len(value) <= self.max_length
+
+    def get(self, value):
+        """
+        Returns the shared copy of the value if there is one, otherwise the
+        value itself.
+        """
+        if not self._shareable(value):
+            return value
+        return self._values.get(value, value)
+
+    def add(self, value):
+        """
+        Adds the value to the table (as the most recently used) if it can be
+        shared and isn't already present, forgetting the least recently used
+        strings if there isn't room.
+        """
+        if not self._shareable(value) or value in self._values:
+            return
+        self._values[value] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            forgotten = self._values.popitem(last=False)[0]
+            self.size -= len(forgotten)
+
+    def intern(self, value):
+        """
+        Returns the shared copy of the value (marking it as the most recently
+        used), adding the value to the table if there isn't one yet.
+        """
+        if not self._shareable(value):
+            return value
+        shared = self._values.pop(value, None)
+        if shared is None:
+            self.add(value)
+            return value
+        self._values[shared] = shared
+        return shared
+
+    def discard(self, value):
+        """
+        Removes the value from the table if it is present.
+        """
+        if self._shareable(value) and self._values.pop(value, None):
+            self.size -= len(value)
+
+
+#: Shares the strings that repeat across messages from all peers: versions
+#: and the keys of metadata.
+SHARED_STRINGS = StringTable(MAX_SHARED_STRING_BYTES, MAX_SHARED_STRING_LENGTH)
+
+#: Shares the IDs of the nodes in the routing table. IDs are only added (and
+#: removed) by the routing table so decoding a message never adds an ID.
+NODE_IDS = InternTable(MAX_SHARED_NODE_IDS)
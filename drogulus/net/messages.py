@@ -29,9 +29,13 @@ in the way that they are.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import namedtuple
+from operator import itemgetter
 import msgpack
-from validators import VALIDATORS
-from drogulus.constants import ERRORS
+from validators import VALIDATORS, compile_validator
+from drogulus.constants import (ERRORS, CAPABILITIES, MAX_MESSAGE_SIZE,
+                                MAX_SMALL_MESSAGE_SIZE)
+from drogulus.crypto import LazyValue
+from interning import SHARED_STRINGS, NODE_IDS
 
 
 class Error(namedtuple('Error',
@@ -147,6 +151,10 @@ class Nodes(namedtuple('Nodes', ['uuid', 'node', 'nodes', 'version'])):
     * uuid - the ID of the request that is causing the response.
     * node - the ID of the node sending the message.
     * nodes - a list of nodes on the DHT that are close to the requested key.
+              Either a tuple of (id, address, port, version) tuples or, for
+              peers that have advertised the 'packed_nodes' capability, a
+              string containing their packed representation (see
+              drogulus.net.packing).
     * version - the protocol version the message conforms to.
     """
     pass
@@ -200,15 +208,188 @@ class Value(namedtuple('Value', ['uuid', 'node', 'key', 'value', 'timestamp',
     pass
 
 
-def to_msgpack(message):
+class Batch(namedtuple('Batch', ['uuid', 'node', 'messages', 'version'])):
+    """
+    Carries many Store or FindValue requests to the same peer in a single
+    message. The recipient handles each request in turn and replies with a
+    BatchReply. Should only be sent to peers that have advertised the 'batch'
+    capability.
+
+    * uuid - the ID of the batch (generated by the requestee).
+    * node - the ID of the node sending the message.
+    * messages - a tuple of between one and MAX_BATCH_SIZE msgpack encoded
+                 requests, each with its own uuid.
+    * version - the protocol version the message conforms to.
+    """
+    pass
+
+
+class BatchReply(namedtuple('BatchReply', ['uuid', 'node', 'results',
+                                           'version'])):
+    """
+    A response to a Batch message containing the reply to each request in the
+    batch (so the status of each request can be checked individually).
+
+    * uuid - the ID of the Batch message that is causing the response.
+    * node - the ID of the node sending the message.
+    * results - a tuple of msgpack encoded replies (for example, Pong, Value,
+                Nodes or Error messages), each with the uuid of the request
+                in the batch it relates to. Replies too big to fit are sent
+                on their own before the BatchReply.
+    * version - the protocol version the message conforms to.
+    """
+    pass
+
+
+#: The version of the compact encoding of messages. It is the first item of
+#: every compactly encoded message.
+COMPACT_VERSION = 1
+
+
+class MessageType(namedtuple('MessageType', ['klass', 'name', 'tag',
+                                             'fields', 'getter',
+                                             'validator', 'max_size'])):
+    """
+    Describes a type of message that may be sent down the wire.
+
+    * klass - the namedtuple based class representing the message.
+    * name - the name of the message type in the 'message' field of the
+             original encoding.
+    * tag - the integer that identifies the message type in the compact
+            encoding.
+    * fields - the names of the message's fields in order.
+    * getter - a function that returns the values of the fields from a
+               dictionary.
+    * validator - the compiled validator for the fields (see
+                  compile_validator).
+    * max_size - the maximum size (in bytes) of an encoded message of this
+                 type that will be accepted from a peer.
+    """
+    pass
+
+
+#: Maps the name of each registered type of message to its MessageType.
+MESSAGE_NAMES = {}
+
+#: Maps the compact encoding tag of each registered type of message to its
+#: MessageType.
+MESSAGE_TAGS = {}
+
+#: Maps the class of each registered type of message to its MessageType.
+MESSAGE_CLASSES = {}
+
+
+def register_message(klass, tag, name=None, max_size=MAX_MESSAGE_SIZE):
+    """
+    Registers a new type of message so it can be encoded and decoded. The tag
+    identifies the message type in the compact encoding and the name (which
+    defaults to the lower case name of the class) identifies it in the
+    original encoding. Neither may already be in use by another type of
+    message. Larger compactly encoded messages of this type than max_size
+    bytes are rejected before they are unpacked (see peek). Returns the
+    resulting MessageType.
+    """
+    if name is None:
+        name = klass.__name__.lower()
+    for registry, key in ((MESSAGE_NAMES, name), (MESSAGE_TAGS, tag)):
+        existing = registry.get(key)
+        if existing and existing.klass is not klass:
+            raise ValueError('%r is already registered for %s.' %
+                             (key, existing.klass.__name__))
+    message_type = MessageType(klass, name, tag, *compiled(klass),
+                               max_size=max_size)
+    MESSAGE_NAMES[name] = message_type
+    MESSAGE_TAGS[tag] = message_type
+    MESSAGE_CLASSES[klass] = message_type
+    return message_type
+
+
+def capabilities_to_mask(capabilities):
+    """
+    Returns the integer bitmask used to advertise the capabilities (see
+    CAPABILITIES). Unknown capabilities are ignored.
+    """
+    return sum(1 << i for i, capability in enumerate(CAPABILITIES)
+               if capability in capabilities)
+
+
+#: The bitmask that advertises the capabilities of the local node.
+CAPABILITY_MASK = capabilities_to_mask(CAPABILITIES)
+
+#: Maps each bitmask advertised by peers to the frozenset of capabilities so
+#: peers advertising the same capabilities share the same frozenset.
+CAPABILITY_SETS = {}
+
+
+def mask_to_capabilities(mask):
+    """
+    Returns the frozenset of capabilities advertised by the bitmask. Bits for
+    capabilities the local node doesn't know about are ignored.
+    """
+    mask &= (1 << len(CAPABILITIES)) - 1
+    capabilities = CAPABILITY_SETS.get(mask)
+    if capabilities is None:
+        capabilities = frozenset(
+            capability for i, capability in enumerate(CAPABILITIES)
+            if mask & (1 << i))
+        CAPABILITY_SETS[mask] = capabilities
+    return capabilities
+
+
+def to_msgpack(message, compact=False, packer=None):
     """
     Returns a string representation of the message object encoded using
-    msgpack.
+    msgpack. The optional protocol features supported by the local node are
+    advertised (as a bitmask, see CAPABILITY_MASK) in the 'caps' field.
+
+    If compact is true the message is encoded as an array containing the
+    version of the compact encoding, the message's type tag, the advertised
+    capabilities and then the message's fields in order. This avoids sending
+    the field names and should only be used with peers that have advertised
+    the 'compact' capability.
+
+    If a msgpack Packer is given it is used to encode the message (so a long
+    lived Packer can be reused rather than one being created for each
+    message).
     """
-    name = message.__class__.__name__.lower()
+    pack = packer.pack if packer else msgpack.packb
+    message_type = MESSAGE_CLASSES[message.__class__]
+    if compact:
+        items = ((COMPACT_VERSION, message_type.tag, CAPABILITY_MASK) +
+                 tuple(message))
+        if isinstance(getattr(message, 'value', None), LazyValue):
+            return pack_lazily(items, packer)
+        return pack(items)
     data = message._asdict()
-    data['message'] = name
-    return msgpack.packb(data)
+    data['message'] = message_type.name
+    data['caps'] = CAPABILITY_MASK
+    if isinstance(data.get('value'), LazyValue):
+        return pack_lazily(data, packer)
+    return pack(data)
+
+
+def pack_lazily(data, packer=None):
+    """
+    Returns the msgpack encoding of the tuple or dictionary of data, some of
+    whose items are LazyValue instances. The existing encoding of each
+    LazyValue is copied into the result so values that arrived from the
+    network never need to be unpacked in order to be passed on.
+    """
+    packer = packer or msgpack.Packer()
+    if isinstance(data, tuple):
+        result = [packer.pack_array_header(len(data))]
+        items = data
+    else:
+        result = [packer.pack_map_header(len(data))]
+        items = []
+        for item in data.iteritems():
+            items.extend(item)
+    for item in items:
+        if isinstance(item, LazyValue):
+            result.append(str(item.encoded))
+        else:
+            result.append(packer.pack(item))
+    return ''.join(result)
 
 
 def from_msgpack(raw):
@@ -217,29 +398,227 @@ def from_msgpack(raw):
     data in the raw string. Encapsulates a variety of cleaning and checking of
     the raw message from the (potentially dangerous) external network.
     """
-    data = msgpack.unpackb(raw, use_list=False)
-    message = data['message']
-    # Explicit is better than implicit (Zen of Python).
-    if message == 'error':
-        return make_message(Error, data)
-    elif message == 'ping':
-        return make_message(Ping, data)
-    elif message == 'pong':
-        return make_message(Pong, data)
-    elif message == 'store':
-        return make_message(Store, data)
-    elif message == 'findnode':
-        return make_message(FindNode, data)
-    elif message == 'nodes':
-        return make_message(Nodes, data)
-    elif message == 'findvalue':
-        return make_message(FindValue, data)
-    elif message == 'value':
-        return make_message(Value, data)
+    message, capabilities = decode(raw)
+    return message
+
+
+def decode(raw, lazy=False):
+    """
+    Returns a tuple containing an instance of the correct message class given
+    the msgpack encoded data in the raw string and a frozenset of the optional
+    protocol features advertised by the sender. Messages from peers that do
+    not advertise any features result in an empty set. Both the original and
+    compact encodings are understood.
+
+    If lazy is true the value of a Store or Value message is left encoded as
+    a LazyValue (see unpack_lazily).
+    """
+    if lazy:
+        return from_unpacked(unpack_lazily(raw))
+    return from_unpacked(msgpack.unpackb(raw, use_list=False))
+
+
+#: The first bytes of msgpack encoded maps.
+MAP_HEADERS = frozenset([chr(i) for i in range(0x80, 0x90)] +
+                        ['\xde', '\xdf'])
+
+#: The first bytes of msgpack encoded arrays.
+ARRAY_HEADERS = frozenset([chr(i) for i in range(0x90, 0xa0)] +
+                          ['\xdc', '\xdd'])
+
+#: The number of bytes taken by the header of msgpack encoded arrays whose
+#: header isn't a single byte.
+ARRAY_HEADER_SIZES = {'\xdc': 3, '\xdd': 5}
+
+
+def peek(raw):
+    """
+    Returns a (version, tag) tuple read directly from the first bytes of a
+    compactly encoded message without unpacking it, or None if raw isn't a
+    compactly encoded message. Either item is None if it isn't encoded as a
+    positive fixint (as every version and the tag of every built in type of
+    message are). If the version isn't, the position of the tag is unknown so
+    both items are None.
+    """
+    header = raw[:1]
+    if header not in ARRAY_HEADERS:
+        return None
+    offset = ARRAY_HEADER_SIZES.get(header, 1)
+    version, tag = raw[offset:offset + 1], raw[offset + 1:offset + 2]
+    if not tag:
+        return None
+    if version >= '\x80':
+        return None, None
+    return ord(version), ord(tag) if tag < '\x80' else None
+
+
+def unpack_lazily(raw):
+    """
+    Returns the same result as msgpack.unpackb(raw, use_list=False) except
+    that the 'value' field of a message (in either encoding) is left msgpack
+    encoded as a LazyValue referencing the raw string rather than a copy of
+    it. The value is only unpacked if something asks for it.
+    """
+    header = raw[:1]
+    if header not in MAP_HEADERS and header not in ARRAY_HEADERS:
+        return msgpack.unpackb(raw, use_list=False)
+    unpacker = msgpack.Unpacker(use_list=False)
+    unpacker.feed(raw)
+
+    def lazy_value():
+        start = unpacker.tell()
+        unpacker.skip()
+        return LazyValue(buffer(raw, start, unpacker.tell() - start))
+
+    if header in MAP_HEADERS:
+        data = {}
+        for i in xrange(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'value':
+                data[key] = lazy_value()
+            else:
+                data[key] = unpacker.unpack()
     else:
+        items = []
+        position = None
+        for i in xrange(unpacker.read_array_header()):
+            if i == position:
+                items.append(lazy_value())
+                continue
+            items.append(unpacker.unpack())
+            if i == 1 and isinstance(items[1], int):
+                # The tag identifies the type of a compact message.
+                message_type = MESSAGE_TAGS.get(items[1])
+                if message_type and 'value' in message_type.fields:
+                    position = 3 + message_type.fields.index('value')
+        data = tuple(items)
+    if unpacker.tell() != len(raw):
+        raise msgpack.ExtraData(data, raw[unpacker.tell():])
+    return data
+
+
+def from_unpacked(data):
+    """
+    Returns a tuple containing an instance of the correct message class and a
+    frozenset of the advertised capabilities (as for decode) given a message
+    that has already been unpacked from msgpack (with use_list=False).
+    """
+    if isinstance(data, tuple):
+        message = from_compact(data)
+        capabilities = data[2]
+    else:
+        message = from_dict(data)
+        capabilities = data.get('caps', 0)
+    if isinstance(capabilities, (int, long)) and not isinstance(
+            capabilities, bool) and capabilities >= 0:
+        return message, mask_to_capabilities(capabilities)
+    if (isinstance(capabilities, tuple) and
+            all(isinstance(c, basestring) for c in capabilities)):
+        # Earlier versions advertised a tuple of capabilities.
+        return message, mask_to_capabilities(
+            capabilities_to_mask(capabilities))
+    # Malformed advertisement, so assume nothing about the sender.
+    return message, frozenset()
+
+
+def share_strings(message):
+    """
+    Returns the message with the strings that repeat across many messages
+    replaced by their shared copies (see drogulus.net.interning): the ID of
+    the sender (if it is in the routing table), the version and the keys of
+    any metadata. Used for messages that are kept for a long time (such as
+    stored Store messages) since decoding every message this way costs more
+    than it saves.
+    """
+    values = list(message)
+    values[1] = NODE_IDS.get(values[1])
+    values[-1] = SHARED_STRINGS.intern(values[-1])
+    meta = getattr(message, 'meta', None)
+    if meta:
+        intern = SHARED_STRINGS.intern
+        values[message._fields.index('meta')] = dict(
+            (intern(key), value) for key, value in meta.iteritems())
+    return tuple.__new__(message.__class__, values)
+
+
+def from_compact(data):
+    """
+    Returns an instance of the correct message class given a tuple of the
+    items of a compactly encoded message (as unpacked from msgpack). The
+    fields are validated in exactly the same way as for the original
+    encoding.
+    """
+    if len(data) < 3:
+        raise ValueError(2, ERRORS[2], {'context':
+                         'Unsupported compact message encoding.'})
+    if data[0] != COMPACT_VERSION:
+        raise ValueError(5, ERRORS[5], {'context':
+                         'Unsupported compact message encoding.'})
+    tag = data[1]
+    message_type = MESSAGE_TAGS.get(tag) if isinstance(tag, int) else None
+    if message_type is None:
         # Unknown request.
         raise ValueError(2, ERRORS[2], {'context':
-                         '%s is not a valid message type.' % message})
+                         '%r is not a valid message type.' % (tag, )})
+    klass, fields, validator = (message_type.klass, message_type.fields,
+                                message_type.validator)
+    values = data[3:3 + len(fields)]
+    if len(values) == len(fields) and validator(*values):
+        return tuple.__new__(klass, values)
+    errors = {}
+    # Work out what's wrong, reporting errors in exactly the same way as
+    # make_message.
+    for field, value in zip(fields, values):
+        if not VALIDATORS[field](value):
+            errors[field] = 'Invalid value.'
+    for field in fields[len(values):]:
+        errors[field] = 'Missing field.'
+    raise ValueError(2, ERRORS[2], errors)
+
+
+def from_dict(data):
+    """
+    Returns an instance of the correct message class given a dictionary of
+    the raw fields of a message (as unpacked from msgpack).
+    """
+    message = data['message']
+    try:
+        message_type = MESSAGE_NAMES.get(message)
+    except TypeError:
+        # Unhashable, so can't be the name of a message type.
+        message_type = None
+    if message_type is None:
+        # Unknown request.
+        raise ValueError(2, ERRORS[2], {'context':
+                         '%s is not a valid message type.' % (message, )})
+    return make_message(message_type.klass, data)
+
+
+#: Caches the compiled form of each message class. See compiled.
+COMPILED = {}
+
+
+def compiled(klass):
+    """
+    Returns a tuple containing the fields of the referenced message class, a
+    function that gets the values of the fields from a dictionary and a
+    compiled validator for the fields (see compile_validator). The result is
+    worked out once for each class.
+    """
+    result = COMPILED.get(klass)
+    if result is None:
+        fields = klass._fields
+        if len(fields) == 1:
+            # itemgetter only returns a tuple for more than one item.
+            field = fields[0]
+
+            def getter(data):
+                return (data[field], )
+        else:
+            getter = itemgetter(*fields)
+        result = (fields, getter, compile_validator(fields))
+        COMPILED[klass] = result
+    return result
 
 
 def make_message(klass, data):
@@ -248,7 +627,14 @@ def make_message(klass, data):
     created from the raw data. Data will be validated and an exception raised
     if this fails.
     """
-    fields = klass._fields
+    fields, getter, validator = compiled(klass)
+    try:
+        values = getter(data)
+    except KeyError:
+        values = None
+    if values is not None and validator(*values):
+        # Fast path for valid messages.
+        return tuple.__new__(klass, values)
     args = []
     errors = {}
     # Validate the values before adding them to the argument list. Store any
@@ -267,3 +653,16 @@ def make_message(klass, data):
         raise ValueError(2, ERRORS[2], errors)
     else:
         return klass(*args)
+
+
+# The tags used in the compact encoding must never be changed.
+register_message(Error, 0, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(Ping, 1, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(Pong, 2, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(Store, 3)
+register_message(FindNode, 4, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(Nodes, 5, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(FindValue, 6, max_size=MAX_SMALL_MESSAGE_SIZE)
+register_message(Value, 7)
+register_message(Batch, 8)
+register_message(BatchReply, 9)
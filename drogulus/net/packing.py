@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Contains functions for packing the details of other nodes on the network into
+a compact binary representation for use in the 'nodes' field of Nodes
+messages (and unpacking them again).
+
+A packed string starts with a table of the distinct version strings of the
+packed nodes: a single byte count followed by each version as a single byte
+length and the version itself. Each node then follows as a fixed width record
+of RECORD_LENGTH bytes:
+
+* The node's 64 byte ID.
+* A byte containing the index of the node's version in the version table.
+* The node's 16 byte IPv6 address (IPv4 addresses are IPv4-mapped).
+* The node's port as a two byte unsigned integer in network byte order.
+
+Since the records are of a fixed width all of them are packed and unpacked
+with a single call to struct.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import socket
+import struct
+
+
+#: The length in bytes of a node's ID.
+ID_LENGTH = 64
+
+#: The struct format of a single node's record.
+RECORD_FORMAT = '%dsB16sH' % ID_LENGTH
+
+#: The length in bytes of a single node's record.
+RECORD_LENGTH = struct.calcsize('>' + RECORD_FORMAT)
+
+#: The prefix of an IPv4 address mapped into the IPv6 address space.
+IPV4_MAPPED = '\x00' * 10 + '\xff\xff'
+
+#: The highest valid port number.
+MAX_PORT = 49151
+
+
+def pack_address(address):
+    """
+    Returns the given IPv4 or IPv6 address string as 16 packed bytes. IPv4
+    addresses are mapped into the IPv6 address space. Raises a ValueError if
+    the address is not a valid IP address.
+    """
+    try:
+        return IPV4_MAPPED + socket.inet_pton(socket.AF_INET, address)
+    except (socket.error, TypeError):
+        pass
+    try:
+        return socket.inet_pton(socket.AF_INET6, address)
+    except (socket.error, TypeError):
+        raise ValueError('Cannot pack address: %r' % address)
+
+
+def unpack_address(packed):
+    """
+    Returns the address string represented by the 16 packed bytes. IPv4-mapped
+    addresses are returned in their IPv4 form.
+    """
+    if packed[:12] == IPV4_MAPPED:
+        return socket.inet_ntoa(packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+
+def pack_nodes(nodes):
+    """
+    Given an iterable of (id, address, port, version) tuples describing other
+    nodes on the network returns a string containing their packed binary
+    representation. Raises a ValueError if any of the nodes cannot be packed
+    (for example, because its ID is not ID_LENGTH bytes long or its address
+    is a hostname rather than an IP address).
+    """
+    versions = {}
+    values = []
+    for id, address, port, version in nodes:
+        if not (isinstance(id, str) and len(id) == ID_LENGTH):
+            raise ValueError('Cannot pack node ID: %r' % id)
+        if not (isinstance(port, int) and 0 <= port <= MAX_PORT):
+            raise ValueError('Cannot pack port: %r' % port)
+        index = versions.get(version)
+        if index is None:
+            if not (isinstance(version, str) and len(version) < 256):
+                raise ValueError('Cannot pack version: %r' % version)
+            if len(versions) == 255:
+                raise ValueError('Too many distinct versions to pack.')
+            index = versions[version] = len(versions)
+        values.extend((id, index, pack_address(address), port))
+    table = [chr(len(versions))]
+    for version in sorted(versions, key=versions.get):
+        table.append(chr(len(version)) + version)
+    count = len(values) / 4
+    table.append(struct.pack('>' + RECORD_FORMAT * count, *values))
+    return ''.join(table)
+
+
+def unpack_records(raw):
+    """
+    Given a string containing packed nodes returns a tuple containing the list
+    of versions in the version table and a flat tuple of the (id, version
+    index, packed address, port) values of every record. Checks the string is
+    well formed without decoding the addresses (so is cheap enough to be used
+    for validation). Raises a ValueError if the string is malformed.
+    """
+    try:
+        offset = 1
+        versions = []
+        for i in xrange(ord(raw[0])):
+            length = ord(raw[offset])
+            versions.append(raw[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        count, remainder = divmod(len(raw) - offset, RECORD_LENGTH)
+        if count < 0 or remainder:
+            raise ValueError('Bad length.')
+        values = struct.unpack_from('>' + RECORD_FORMAT * count, raw, offset)
+    except (IndexError, TypeError, struct.error), ex:
+        raise ValueError('Malformed packed nodes: %s' % ex)
+    if count and (max(values[1::4]) >= len(versions) or
+                  max(values[3::4]) > MAX_PORT):
+        raise ValueError('Malformed packed nodes: bad version or port.')
+    return versions, values
+
+
+def unpack_nodes(raw):
+    """
+    Given a string containing packed nodes returns a tuple of (id, address,
+    port, version) tuples. Every node with the same version shares the same
+    version string. Raises a ValueError if the string is malformed.
+    """
+    versions, values = unpack_records(raw)
+    inet_ntoa = socket.inet_ntoa
+    inet_ntop = socket.inet_ntop
+    try:
+        # Equivalent to unpack_address but without the cost of a function
+        # call per node.
+        addresses = [inet_ntoa(a[12:]) if a[:12] == IPV4_MAPPED else
+                     inet_ntop(socket.AF_INET6, a) for a in values[2::4]]
+    except (socket.error, ValueError), ex:
+        raise ValueError('Malformed packed nodes: %s' % ex)
+    return tuple(zip(values[0::4], addresses, values[3::4],
+                     [versions[i] for i in values[1::4]]))
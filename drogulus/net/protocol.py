@@ -20,14 +20,110 @@ Drogulus.
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet import protocol
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
-from twisted.protocols.basic import NetstringReceiver
-from messages import Error, to_msgpack, from_msgpack
-from drogulus.constants import ERRORS
+from twisted.protocols.basic import NetstringReceiver, NetstringParseError
+from Crypto.Hash import SHA512
+from messages import (Error, Store, Value, to_msgpack, decode, peek,
+                      COMPACT_VERSION, MESSAGE_TAGS, MAP_HEADERS,
+                      ARRAY_HEADERS)
+from drogulus.constants import (ERRORS, COMPRESSION_THRESHOLD,
+                                MAX_MESSAGE_SIZE, MAX_VALUE_SIZE, CHUNK_SIZE,
+                                MAX_CONNECTION_QUEUE, MAX_GLOBAL_QUEUE)
+from drogulus.crypto import PrehashedValue, raw_header
 from drogulus.version import get_version
+from zope.interface import implementer
+from collections import deque
 from uuid import uuid4
+import msgpack
+import struct
+import zlib
 
 
+#: Prefix that marks a payload as zlib compressed msgpack. Uncompressed
+#: payloads are always msgpack maps so can never start with this byte.
+COMPRESSED_FRAME = 'z'
+
+#: Prefix that marks a payload as the header of a message whose value follows
+#: in chunks. The prefix is followed by the size of the value (a 4 byte
+#: unsigned integer) and the msgpack encoded message with an empty value.
+CHUNKED_FRAME = 'h'
+
+#: Prefix that marks a payload as a chunk of a value.
+CHUNK_FRAME = 'c'
+
+#: The characters that may start a netstring. Anything else at the start of
+#: a frame means the peer has switched to msgpack stream framing.
+NETSTRING_START = frozenset('0123456789')
+
+
+class ChunkedMessage(object):
+    """
+    Reassembles a value carrying message whose value arrives in chunks. The
+    value is hashed incrementally as each chunk arrives so the complete value
+    never needs to be encoded and hashed in one go.
+    """
+
+    def __init__(self, message, size):
+        """
+        The message is the header of the value carrying message (with an empty
+        value). The size is the expected size of the value in bytes.
+        """
+        self.message = message
+        self.size = size
+        self.received = 0
+        self._chunks = []
+        # The value is hashed as if it were msgpack encoded.
+        self._hasher = SHA512.new(raw_header(size))
+
+    def add_chunk(self, chunk):
+        """
+        Adds the next chunk of the value. Raises a ValueError if the chunk
+        results in more data than was expected.
+        """
+        self.received += len(chunk)
+        if self.received > self.size:
+            details = {
+                'context': 'Value larger than expected %d bytes.' % self.size
+            }
+            raise ValueError(1, ERRORS[1], details, self.message.uuid)
+        self._hasher.update(chunk)
+        self._chunks.append(chunk)
+
+    def is_complete(self):
+        """
+        Returns a boolean to indicate if the whole value has arrived.
+        """
+        return self.received == self.size
+
+    def assemble(self):
+        """
+        Returns the complete message. The value is a PrehashedValue so it
+        won't be hashed again when the message's provenance is checked.
+        """
+        value = PrehashedValue(''.join(self._chunks), self._hasher.digest())
+        self._chunks = []
+        return self.message._replace(value=value)
+
+
+class BackpressureStats(object):
+    """
+    Keeps track of the bytes queued for slow peers across all connections and
+    how often backpressure has been applied.
+    """
+
+    def __init__(self):
+        # The number of bytes currently queued across all connections.
+        self.queued_bytes = 0
+        # The largest number of bytes queued at any one time.
+        self.peak_queued_bytes = 0
+        # The number of times a connection's outbound buffer has filled up.
+        self.pauses = 0
+        # The number of connections dropped for exceeding a queue limit.
+        self.dropped = 0
+
+
+@implementer(IPushProducer)
 class DHTProtocol(NetstringReceiver):
     """
     The low level networking protocol.
@@ -41,8 +137,172 @@ class DHTProtocol(NetstringReceiver):
 
     To the external world messages come in, messages go out (and implementation
     details are hidden).
+
+    Payloads larger than COMPRESSION_THRESHOLD bytes are zlib compressed if
+    the peer has advertised the 'zlib' capability. String values larger than
+    CHUNK_SIZE are sent as a sequence of chunks (each in its own netstring) if
+    the peer has advertised the 'chunked' capability. No netstring (a message
+    or a chunk) may exceed MAX_LENGTH bytes and no value reassembled from
+    chunks may exceed MAX_VALUE_SIZE bytes.
+
+    The protocol is a streaming producer for its transport. When the
+    transport's outbound buffer is full the protocol stops reading from the
+    peer and queues outgoing netstrings until the buffer drains. If a queue
+    grows beyond MAX_CONNECTION_QUEUE bytes (or the queues for all connections
+    grow beyond MAX_GLOBAL_QUEUE bytes) the connection is dropped.
+
+    Once the peer has advertised the 'stream' capability, netstring framing
+    is dropped for outgoing messages in favour of msgpack's native framing:
+    encoded messages are written as-is and other payloads (compressed
+    messages and chunks) are written as msgpack strings. Since a netstring
+    always starts with a digit (which can never start a message) the switch
+    is detected at the start of the peer's next frame and the rest of the
+    connection is read with a long-lived msgpack Unpacker.
+
+    If lazy_values is set the values of incoming Store and Value messages are
+    left msgpack encoded (see LazyValue) so nodes that only check, store and
+    replicate values never unpack them.
     """
 
+    #: The maximum length of a netstring (or msgpack stream framed message).
+    MAX_LENGTH = MAX_MESSAGE_SIZE
+
+    #: The maximum size of a value reassembled from chunks.
+    MAX_VALUE_SIZE = MAX_VALUE_SIZE
+
+    #: The optional protocol features advertised by the remote peer.
+    peer_capabilities = frozenset()
+
+    #: The ChunkedMessage currently being received (if any).
+    chunked_message = None
+
+    #: Indicates if the transport's outbound buffer is full.
+    paused = False
+
+    #: The number of bytes queued for this connection.
+    queued_bytes = 0
+
+    #: Indicates if the values of incoming Store and Value messages are left
+    #: msgpack encoded until something asks for them.
+    lazy_values = False
+
+    def __init__(self):
+        # Reused to encode every message sent via this connection.
+        self._packer = msgpack.Packer()
+        # Reads the peer's messages once it has switched to msgpack stream
+        # framing.
+        self._unpacker = None
+        # The bytes fed to the Unpacker that have yet to be read and the
+        # position in the stream at which they start.
+        self._stream_data = []
+        self._stream_offset = 0
+
+    @property
+    def streaming(self):
+        """
+        Indicates if outgoing messages use msgpack stream framing.
+        """
+        return 'stream' in self.peer_capabilities
+
+    def connectionMade(self):
+        """
+        Registers the protocol as a producer so the transport can signal when
+        its outbound buffer is full.
+        """
+        self._queue = deque()
+        self._lose_connection = False
+        self.transport.registerProducer(self, True)
+
+    def connectionLost(self, reason):
+        """
+        Discards anything still queued for the peer.
+        """
+        self.discard_queue()
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its outbound buffer is full. Outgoing
+        netstrings are queued and no more data is read from the peer until
+        the buffer drains.
+        """
+        self.paused = True
+        self.factory.node.backpressure.pauses += 1
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        """
+        Called by the transport once its outbound buffer has drained. Writes
+        as much of the queue as possible and, if it is emptied, starts reading
+        from the peer again.
+        """
+        self.paused = False
+        while self._queue and not self.paused:
+            frame = self._queue.popleft()
+            self._release(len(frame))
+            # This may result in pauseProducing being called.
+            self.transport.write(frame)
+        if not self._queue:
+            self.transport.resumeProducing()
+            if self._lose_connection:
+                # TLS transports wait for the producer to be unregistered
+                # before closing the connection.
+                self.transport.unregisterProducer()
+                self.transport.loseConnection()
+
+    def stopProducing(self):
+        """
+        Called by the transport when it will no longer accept data.
+        """
+        self.discard_queue()
+
+    def _release(self, size):
+        """
+        Updates the queue accounting when size bytes leave the queue.
+        """
+        self.queued_bytes -= size
+        self.factory.node.backpressure.queued_bytes -= size
+
+    def discard_queue(self):
+        """
+        Throws away anything queued for the peer.
+        """
+        if self.queued_bytes:
+            self._release(self.queued_bytes)
+        self._queue = deque()
+
+    def sendString(self, string):
+        """
+        Sends the string as a netstring (or as a msgpack string if the peer
+        has switched to msgpack stream framing).
+        """
+        if self.streaming:
+            self.sendFrame(self._packer.pack(string))
+        else:
+            self.sendFrame('%d:%s,' % (len(string), string))
+
+    def sendFrame(self, frame):
+        """
+        Writes the framed data if there is space in the transport's outbound
+        buffer, otherwise adds it to the queue. Drops the connection if the
+        queue limits are exceeded.
+        """
+        if not (self.paused or self._queue):
+            return self.transport.write(frame)
+        size = len(frame)
+        stats = self.factory.node.backpressure
+        if (self.queued_bytes + size > MAX_CONNECTION_QUEUE or
+                stats.queued_bytes + size > MAX_GLOBAL_QUEUE):
+            log.msg('Outbound queue limit exceeded. Dropping connection.')
+            stats.dropped += 1
+            self.discard_queue()
+            self.transport.abortConnection()
+            return
+        self._queue.append(frame)
+        self.queued_bytes += size
+        stats.queued_bytes += size
+        stats.peak_queued_bytes = max(stats.peak_queued_bytes,
+                                      stats.queued_bytes)
+
     def except_to_error(self, exception):
         """
         Given a Python exception will return an appropriate Error message
@@ -62,6 +322,241 @@ class DHTProtocol(NetstringReceiver):
         return Error(uuid, self.factory.node.id, code, title, details,
                      get_version())
 
+    def encode(self, msg):
+        """
+        Returns the msgpack encoded message using the compact encoding if the
+        peer has advertised that it understands it.
+        """
+        return to_msgpack(msg, 'compact' in self.peer_capabilities,
+                          self._packer)
+
+    def compress(self, raw):
+        """
+        Given a msgpack encoded message returns the payload to be sent down
+        the wire. Only messages larger than COMPRESSION_THRESHOLD bytes are
+        compressed and only if the peer understands compressed payloads and
+        compression actually makes the payload smaller.
+        """
+        if ('zlib' in self.peer_capabilities and
+                len(raw) > COMPRESSION_THRESHOLD):
+            # Favour speed over ratio.
+            compressed = COMPRESSED_FRAME + zlib.compress(raw, 1)
+            if len(compressed) < len(raw):
+                return compressed
+        return raw
+
+    def decompress(self, raw):
+        """
+        Given a payload received from the wire returns the msgpack encoded
+        message. Compressed payloads may not expand beyond MAX_LENGTH bytes
+        (the limit for uncompressed payloads).
+        """
+        if raw[:1] != COMPRESSED_FRAME:
+            return raw
+        decompressor = zlib.decompressobj()
+        try:
+            result = decompressor.decompress(raw[1:], self.MAX_LENGTH)
+        except zlib.error:
+            raise ValueError(1, ERRORS[1], {'context':
+                             'Unable to decompress message.'},
+                             str(uuid4()))
+        if decompressor.unconsumed_tail:
+            raise ValueError(4, ERRORS[4], {'context':
+                             'Message exceeds %d bytes.' % self.MAX_LENGTH},
+                             str(uuid4()))
+        return result
+
+    def _extractLength(self, length_as_string):
+        """
+        Extends the netstring length check so the peer is sent an error 4
+        (Request too big) before the connection is dropped.
+        """
+        try:
+            return NetstringReceiver._extractLength(self, length_as_string)
+        except NetstringParseError:
+            details = {
+                'context': 'Message exceeds %d bytes.' % self.MAX_LENGTH
+            }
+            error = ValueError(4, ERRORS[4], details, str(uuid4()))
+            self.sendMessage(self.except_to_error(error))
+            raise
+
+    def size_limit(self, raw):
+        """
+        Returns the maximum size of the msgpack encoded message that starts
+        with the bytes in raw: the maximum size for its type (see
+        register_message) if it is compactly encoded, otherwise MAX_LENGTH.
+        """
+        peeked = peek(raw)
+        if peeked is not None:
+            message_type = MESSAGE_TAGS.get(peeked[1])
+            if message_type is not None:
+                return min(message_type.max_size, self.MAX_LENGTH)
+        return self.MAX_LENGTH
+
+    def check_payload(self, raw):
+        """
+        Cheaply checks the msgpack encoded message in raw before it is
+        unpacked so that garbage and messages of an unknown type, of an
+        unsupported version or that are too big for their type (see
+        register_message) are rejected without any allocation heavy work.
+        Returns raw if it passes the checks.
+
+        Only the header and size of a message in the original encoding can be
+        checked since the position of its 'message' field isn't fixed.
+        """
+        header = raw[:1]
+        if header not in MAP_HEADERS and header not in ARRAY_HEADERS:
+            raise ValueError(1, ERRORS[1], {'context': 'Not a message.'},
+                             str(uuid4()))
+        peeked = peek(raw)
+        if peeked is not None:
+            version, tag = peeked
+            if version != COMPACT_VERSION:
+                raise ValueError(5, ERRORS[5], {'context':
+                                 'Unsupported compact message encoding.'},
+                                 str(uuid4()))
+            if tag is not None and tag not in MESSAGE_TAGS:
+                raise ValueError(2, ERRORS[2], {'context':
+                                 '%r is not a valid message type.' % (tag, )},
+                                 str(uuid4()))
+        limit = self.size_limit(raw)
+        if len(raw) > limit:
+            raise ValueError(4, ERRORS[4], {'context':
+                             'Message exceeds %d bytes.' % limit},
+                             str(uuid4()))
+        return raw
+
+    def chunk_received(self, raw):
+        """
+        Handles a payload that is expected to be the next chunk of the value
+        of the message currently being received. Returns the complete message
+        once the final chunk has arrived, otherwise None.
+        """
+        chunked_message = self.chunked_message
+        if raw[:1] != CHUNK_FRAME:
+            self.chunked_message = None
+            raise ValueError(1, ERRORS[1], {'context': 'Expected a chunk.'},
+                             chunked_message.message.uuid)
+        chunked_message.add_chunk(raw[1:])
+        if chunked_message.is_complete():
+            self.chunked_message = None
+            return chunked_message.assemble()
+
+    def header_received(self, raw):
+        """
+        Handles the header of a message whose value will arrive in chunks.
+        """
+        size = struct.unpack('>I', raw[1:5])[0]
+        message, capabilities = decode(self.check_payload(
+            self.decompress(raw[5:])))
+        self.peer_capabilities = capabilities
+        if (not isinstance(message, (Store, Value)) or
+                message.value != '' or size == 0):
+            raise ValueError(1, ERRORS[1], {'context':
+                             'Invalid chunked message.'}, message.uuid)
+        if size > self.MAX_VALUE_SIZE:
+            raise ValueError(4, ERRORS[4], {'context':
+                             'Value exceeds %d bytes.' % self.MAX_VALUE_SIZE},
+                             message.uuid)
+        self.chunked_message = ChunkedMessage(message, size)
+
+    def dataReceived(self, data):
+        """
+        Reads netstrings until the peer switches to msgpack stream framing.
+        """
+        if self._unpacker is None:
+            NetstringReceiver.dataReceived(self, data)
+        else:
+            self.stream_received(data)
+
+    def _consumeData(self):
+        """
+        Extends the netstring parser to switch to msgpack stream framing if
+        the next frame is not a netstring.
+        """
+        if (self._state == self._PARSING_LENGTH and
+                self._remainingData[:1] not in NETSTRING_START):
+            data = self._remainingData
+            self._remainingData = ''
+            self._unpacker = msgpack.Unpacker(use_list=False,
+                                              max_buffer_size=self.MAX_LENGTH)
+            self.stream_received(data)
+        else:
+            NetstringReceiver._consumeData(self)
+
+    def stream_received(self, data):
+        """
+        Handles data from a peer that uses msgpack stream framing. The
+        Unpacker only skips over each object in the stream: its bytes are
+        then handled as if they had arrived in a netstring (see
+        frame_received) so they pass the same checks before anything is
+        unpacked. A message is rejected as soon as more of it has arrived
+        than the maximum size for its type.
+        """
+        try:
+            self._unpacker.feed(data)
+        except msgpack.BufferFull:
+            error = ValueError(4, ERRORS[4], {'context': 'Message exceeds %d '
+                               'bytes.' % self.MAX_LENGTH}, str(uuid4()))
+            self.sendMessage(self.except_to_error(error), True)
+            return
+        self._stream_data.append(data)
+        try:
+            for raw in self.stream_objects():
+                self.receive(self.frame_received, raw)
+        except msgpack.UnpackValueError:
+            # The stream is corrupt so it can't be read any further.
+            error = ValueError(1, ERRORS[1], {'context':
+                               'Unable to unpack message.'}, str(uuid4()))
+            self.sendMessage(self.except_to_error(error), True)
+        except ValueError, ex:
+            self.sendMessage(self.except_to_error(ex), True)
+
+    def stream_objects(self):
+        """
+        Yields the bytes of each complete object read from the stream. Raises
+        a ValueError if the incomplete object that follows is already too
+        big for its type of message (see size_limit).
+        """
+        while True:
+            try:
+                self._unpacker.skip()
+            except msgpack.OutOfData:
+                break
+            end = self._unpacker.tell()
+            size = end - self._stream_offset
+            data = ''.join(self._stream_data)
+            self._stream_data = [data[size:]]
+            self._stream_offset = end
+            yield data[:size]
+        buffered = sum(len(data) for data in self._stream_data)
+        if buffered:
+            head = self._stream_data[0]
+            if len(head) < 8:
+                # Enough to peek at the header of the message.
+                head = ''.join(self._stream_data)[:8]
+            limit = self.size_limit(head)
+            if buffered > limit:
+                raise ValueError(4, ERRORS[4], {'context':
+                                 'Message exceeds %d bytes.' % limit},
+                                 str(uuid4()))
+
+    def frame_received(self, raw):
+        """
+        Returns the message contained in the msgpack encoded object read from
+        the stream (see payload_received). An encoded message needs no
+        further unframing, anything else must be a string containing a
+        payload.
+        """
+        header = raw[:1]
+        if header not in MAP_HEADERS and header not in ARRAY_HEADERS:
+            raw = msgpack.unpackb(raw)
+            if not isinstance(raw, str):
+                raise ValueError(1, ERRORS[1], {'context': 'Not a message.'},
+                                 str(uuid4()))
+        return self.payload_received(raw)
+
     def stringReceived(self, raw):
         """
         Handles incoming requests by unpacking them and instantiating the
@@ -69,24 +564,75 @@ class DHTProtocol(NetstringReceiver):
         further processing. If the message cannot be unpacked or is invalid
         an appropriate error message is returned to the originating caller.
         """
+        self.receive(self.payload_received, raw)
+
+    def receive(self, handler, data):
+        """
+        Passes the message returned by calling the handler with the data (if
+        any) to the Node instance. Any exception results in an appropriate
+        error message being returned to the originating caller.
+        """
         try:
-            message = from_msgpack(raw)
-            self.factory.node.message_received(message, self)
+            message = handler(data)
+            if message:
+                self.factory.node.message_received(message, self)
         except Exception, ex:
             # Catch all for anything unexpected
             log.msg('***** ERROR *****')
             log.msg(ex)
             self.sendMessage(self.except_to_error(ex), True)
 
+    def payload_received(self, raw):
+        """
+        Returns the message contained in the payload of a frame or None if
+        the payload is part of a message that has yet to arrive in full.
+        """
+        if self.chunked_message:
+            return self.chunk_received(raw)
+        elif raw[:1] == CHUNKED_FRAME:
+            self.header_received(raw)
+        else:
+            message, capabilities = decode(self.check_payload(
+                self.decompress(raw)), self.lazy_values)
+            self.peer_capabilities = capabilities
+            return message
+
     def sendMessage(self, msg, loseConnection=False):
         """
         Sends the referenced message to the connected peer on the network. If
         loseConnection is set to true the connection will be dropped once the
-        message has been sent.
+        message (and anything queued before it) has been sent.
         """
-        self.sendString(to_msgpack(msg))
+        if ('chunked' in self.peer_capabilities and
+                isinstance(msg, (Store, Value)) and
+                isinstance(msg.value, str) and len(msg.value) > CHUNK_SIZE):
+            self.sendChunked(msg)
+        else:
+            payload = self.compress(self.encode(msg))
+            if self.streaming and payload[:1] != COMPRESSED_FRAME:
+                # An encoded message needs no further framing.
+                self.sendFrame(payload)
+            else:
+                self.sendString(payload)
         if loseConnection:
-            self.transport.loseConnection()
+            if self._queue:
+                # Wait for the queue to drain.
+                self._lose_connection = True
+            else:
+                self.transport.unregisterProducer()
+                self.transport.loseConnection()
+
+    def sendChunked(self, msg):
+        """
+        Sends the referenced value carrying message to the connected peer as
+        a header followed by the value split into chunks of CHUNK_SIZE bytes.
+        """
+        value = msg.value
+        header = self.compress(self.encode(msg._replace(value='')))
+        self.sendString(CHUNKED_FRAME + struct.pack('>I', len(value)) +
+                        header)
+        for i in xrange(0, len(value), CHUNK_SIZE):
+            self.sendString(CHUNK_FRAME + value[i:i + CHUNK_SIZE])
 
 
 class DHTFactory(protocol.Factory):
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Contains classes that allow TLS connections to other nodes on the network to
+share a single context and resume previously negotiated sessions (resulting
+in an abbreviated handshake when reconnecting to a peer).
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet.ssl import CertificateOptions
+from twisted.internet.endpoints import SSL4ClientEndpoint
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from zope.interface import implementer
+from OpenSSL import SSL
+from OpenSSL._util import lib as _lib
+from collections import OrderedDict
+import weakref
+
+
+def session_reused(connection):
+    """
+    Returns a boolean to indicate if the handshake of the OpenSSL connection
+    resumed a session. pyOpenSSL has no API for this so OpenSSL's
+    SSL_session_reused is called directly.
+    """
+    return bool(_lib.SSL_session_reused(connection._ssl))
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class PeerConnectionCreator(object):
+    """
+    Creates the OpenSSL connections used to talk to a specific peer. Passed
+    to Twisted's TLS machinery in place of a context factory.
+    """
+
+    def __init__(self, cache, peer):
+        """
+        The cache is the TLSSessionCache that creates the connections and the
+        peer is a tuple of the peer's address and port.
+        """
+        self.cache = cache
+        self.peer = peer
+
+    def clientConnectionForTLS(self, tls_protocol):
+        """
+        Returns a new OpenSSL connection for the TLS protocol instance.
+        """
+        return self.cache.connection_for(self.peer, tls_protocol)
+
+
+class TLSSessionCache(object):
+    """
+    Builds a TLS client context once and remembers the session negotiated
+    with each peer so that subsequent connections to the same peer can
+    resume it rather than perform a full handshake.
+
+    To bound memory use only the sessions for the max_size most recently
+    contacted peers are remembered.
+    """
+
+    def __init__(self, options=None, max_size=1024):
+        """
+        The options (if given) must provide a getContext method that returns
+        an OpenSSL context (for example, an instance of Twisted's
+        CertificateOptions). By default, the same options are used as for
+        Twisted's "ssl:" client strings but with session tickets enabled.
+        """
+        if options is None:
+            options = CertificateOptions(enableSessionTickets=True)
+        self.context = options.getContext()
+        self.context.set_session_cache_mode(SSL.SESS_CACHE_CLIENT)
+        self.context.set_info_callback(self._info_callback)
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        # Maps live connections to the peer they connect to.
+        self._connections = weakref.WeakKeyDictionary()
+        # Live connections that have completed their handshake.
+        self._established = weakref.WeakKeyDictionary()
+        # The number of handshakes that resumed a cached session.
+        self.hits = 0
+        # The number of handshakes that were not abbreviated (because there
+        # was no cached session or the peer didn't accept it).
+        self.misses = 0
+
+    def _info_callback(self, connection, where, ret):
+        """
+        Called by OpenSSL as the state of a connection changes. Remembers the
+        session once a handshake is complete. With TLS 1.3 the resumable
+        session ticket only arrives after the handshake is done so the cached
+        session is also refreshed as the connection continues to process
+        handshake messages. Each completed handshake is counted as a hit or
+        a miss depending on whether it resumed a session.
+        """
+        peer = self._connections.get(connection)
+        if not peer:
+            return
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            if connection not in self._established:
+                self._established[connection] = True
+                if session_reused(connection):
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        elif not (where & SSL.SSL_CB_LOOP and
+                  connection in self._established):
+            return
+        session = connection.get_session()
+        if session:
+            self._sessions.pop(peer, None)
+            if len(self._sessions) >= self.max_size:
+                # Forget the least recently used session.
+                self._sessions.popitem(last=False)
+            self._sessions[peer] = session
+
+    def connection_for(self, peer, tls_protocol):
+        """
+        Returns a new OpenSSL connection to the peer (a tuple of address and
+        port) that will attempt to resume the peer's cached session.
+        """
+        connection = SSL.Connection(self.context, None)
+        connection.set_app_data(tls_protocol)
+        self._connections[connection] = peer
+        session = self._sessions.get(peer)
+        if session:
+            connection.set_session(session)
+        return connection
+
+    def forget(self, peer):
+        """
+        Discards the cached session for the peer (a tuple of address and
+        port), if there is one.
+        """
+        self._sessions.pop(peer, None)
+
+    def endpoint(self, reactor, address, port):
+        """
+        Returns a client endpoint for a TLS connection to the given address
+        and port that makes use of this cache.
+        """
+        peer = (address, port)
+        return SSL4ClientEndpoint(reactor, address, port,
+                                  PeerConnectionCreator(self, peer))
+
+    def __len__(self):
+        """
+        Returns the number of sessions currently cached.
+        """
+        return len(self._sessions)
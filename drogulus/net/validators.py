@@ -19,7 +19,8 @@ in messages sent between nodes in the DHT.
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from drogulus.constants import ERRORS
+from drogulus.constants import ERRORS, MAX_BATCH_SIZE
+from packing import unpack_records
 
 
 def validate_timestamp(val):
@@ -35,7 +36,11 @@ def validate_code(val):
     """
     Returns a boolean indication that an error code is valid.
     """
-    return val in ERRORS.keys()
+    try:
+        return val in ERRORS
+    except TypeError:
+        # Unhashable values can't be error codes.
+        return False
 
 
 def validate_string(val):
@@ -87,11 +92,26 @@ def validate_node(val):
 def validate_nodes(val):
     """
     Returns a boolean to indicate that a field is a tuple that may contain
-    information about nodes.
+    information about nodes or a string containing the packed representation
+    of such information (see drogulus.net.packing).
     """
-    if isinstance(val, tuple):
+    if isinstance(val, str):
+        try:
+            unpack_records(val)
+        except ValueError:
+            return False
+    elif isinstance(val, tuple):
+        # Equivalent to calling validate_node for each node but without the
+        # cost of a function call per node (Nodes messages are the most
+        # common response on the network).
         for node in val:
-            if not validate_node(node):
+            if not (isinstance(node, tuple) and len(node) == 4):
+                return False
+            id, address, port, version = node
+            if not (isinstance(id, basestring) and
+                    isinstance(address, basestring) and
+                    isinstance(version, basestring) and
+                    isinstance(port, int) and 0 <= port <= 49151):
                 return False
     else:
         return False
@@ -106,6 +126,29 @@ def validate_value(val):
     """
     return True
 
+
+def validate_batch(val):
+    """
+    Returns a boolean to indicate that a field is a tuple of between one and
+    MAX_BATCH_SIZE msgpack encoded messages (as found in Batch messages).
+    """
+    if isinstance(val, tuple) and 0 < len(val) <= MAX_BATCH_SIZE:
+        for item in val:
+            if not isinstance(item, str):
+                return False
+        return True
+    return False
+
+
+def validate_batch_results(val):
+    """
+    Returns a boolean to indicate that a field is a tuple of no more than
+    MAX_BATCH_SIZE msgpack encoded messages (as found in BatchReply messages).
+    Replies too big to fit in a BatchReply are sent on their own so there may
+    be none left.
+    """
+    return val == () or validate_batch(val)
+
 """
 Lookup for the correct validation function for each type of field a message
 may contain. Explicit is better than implicit (Zen of Python).
@@ -125,5 +168,29 @@ VALIDATORS = {
     'name': validate_string,
     'meta': validate_meta,
     'sig': validate_string,
-    'nodes': validate_nodes
+    'nodes': validate_nodes,
+    'messages': validate_batch,
+    'results': validate_batch_results
 }
+
+
+def compile_validator(fields):
+    """
+    Returns a function that takes the values of the referenced fields as
+    positional arguments (in the same order as the fields) and returns a
+    boolean to indicate if they are all valid. The function is generated once
+    so that checking a message involves a single call containing one
+    expression rather than a loop with a lookup into VALIDATORS for each
+    field.
+    """
+    namespace = {}
+    args = []
+    checks = []
+    for i, field in enumerate(fields):
+        namespace['validate_%d' % i] = VALIDATORS[field]
+        args.append('value_%d' % i)
+        checks.append('validate_%d(value_%d)' % (i, i))
+    source = 'def validate(%s):\n    return bool(%s)\n' % (
+        ', '.join(args), ' and '.join(checks) or 'True')
+    exec source in namespace
+    return namespace['validate']
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Contains the signature schemes used to sign and verify value carrying
+messages.
+
+The scheme used by a key is identified by a prefix of its string
+representation so messages don't need an extra field. RSA keys (PKCS#1 v1.5
+signatures with SHA512 digests) are PEM or DER encoded and have no prefix:
+every key that doesn't start with the prefix of another registered scheme is
+an RSA key, so existing keys and signatures remain valid.
+
+Ed25519 signs much faster (and verifies faster) than RSA with keys and
+signatures that are a fraction of the size. It is available when the
+cryptography package (a dependency of pyOpenSSL) supports it.
+"""
+
+# Copyright (C) 2012-2013 Nicholas H.Tollervey.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from abc import ABCMeta, abstractmethod
+import base64
+import warnings
+
+try:
+    with warnings.catch_warnings():
+        # Recent versions of cryptography warn that Python 2 is deprecated.
+        warnings.simplefilter('ignore')
+        from cryptography.exceptions import InvalidSignature
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from cryptography.hazmat.primitives import serialization
+except ImportError:
+    ed25519 = None
+
+
+class SignatureScheme(object):
+    """
+    Abstract base class for signature schemes. The load_key method returns an
+    object with a verify(hash, signature) method (and, for private keys, a
+    sign(hash) method) where hash is a SHA512 hash object (see
+    drogulus.crypto.construct_hash).
+    """
+
+    __metaclass__ = ABCMeta
+
+    #: The name of the scheme.
+    name = None
+    #: The prefix of the string representations of the scheme's keys.
+    prefix = ''
+
+    @abstractmethod
+    def load_key(self, key):
+        """
+        Parses the string representation of a public or private key. Raises
+        a ValueError if the key is malformed.
+        """
+
+    @abstractmethod
+    def public_key(self, private_key):
+        """
+        Returns the string representation of the public key that belongs to
+        the private key.
+        """
+
+    @abstractmethod
+    def generate(self):
+        """
+        Returns the string representation of a new private key.
+        """
+
+
+class RSAScheme(SignatureScheme):
+    """
+    RSA keys with PKCS#1 v1.5 signatures, the original (and default) scheme.
+    """
+
+    name = 'rsa'
+
+    def __init__(self, bits=2048):
+        # The size of generated keys.
+        self.bits = bits
+
+    def load_key(self, key):
+        return PKCS1_v1_5.new(RSA.importKey(key))
+
+    def public_key(self, private_key):
+        return RSA.importKey(private_key).publickey().exportKey()
+
+    def generate(self):
+        return RSA.generate(self.bits).exportKey()
+
+
+class Ed25519Key(object):
+    """
+    A parsed Ed25519 public or private key. The digest of the hash is
+    signed.
+    """
+
+    def __init__(self, public_key, private_key=None):
+        self._public_key = public_key
+        self._private_key = private_key
+
+    def sign(self, hash):
+        if self._private_key is None:
+            raise TypeError('A private key is required to sign.')
+        return self._private_key.sign(hash.digest())
+
+    def verify(self, hash, signature):
+        try:
+            self._public_key.verify(signature, hash.digest())
+        except InvalidSignature:
+            return False
+        return True
+
+
+class Ed25519Scheme(SignatureScheme):
+    """
+    Ed25519 keys. A public key is the prefix followed by the base64 encoded
+    32 byte public key. A private key is the prefix followed by the base64
+    encoded 32 byte seed and 32 byte public key.
+    """
+
+    name = 'ed25519'
+    prefix = 'ed25519:'
+
+    def _decode(self, key):
+        """
+        Returns the raw bytes of the key.
+        """
+        try:
+            raw = base64.b64decode(key[len(self.prefix):])
+        except TypeError:
+            raise ValueError('Malformed Ed25519 key.')
+        if len(raw) not in (32, 64):
+            raise ValueError('Malformed Ed25519 key.')
+        return raw
+
+    def load_key(self, key):
+        raw = self._decode(key)
+        if len(raw) == 32:
+            return Ed25519Key(
+                ed25519.Ed25519PublicKey.from_public_bytes(raw))
+        private_key = ed25519.Ed25519PrivateKey.from_private_bytes(raw[:32])
+        return Ed25519Key(private_key.public_key(), private_key)
+
+    def public_key(self, private_key):
+        raw = self._decode(private_key)
+        if len(raw) != 64:
+            raise ValueError('Not an Ed25519 private key.')
+        public_key = ed25519.Ed25519PrivateKey.from_private_bytes(
+            raw[:32]).public_key()
+        return self.prefix + base64.b64encode(public_key.public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw))
+
+    def generate(self):
+        private_key = ed25519.Ed25519PrivateKey.generate()
+        seed = private_key.private_bytes(serialization.Encoding.Raw,
+                                         serialization.PrivateFormat.Raw,
+                                         serialization.NoEncryption())
+        public_key = private_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        return self.prefix + base64.b64encode(seed + public_key)
+
+
+#: Maps the name of each registered signature scheme to the scheme.
+SCHEMES = {}
+
+#: The scheme used by keys without the prefix of any other scheme.
+DEFAULT_SCHEME = RSAScheme()
+
+
+def register_scheme(scheme):
+    """
+    Registers a signature scheme so its keys can be used to sign and verify
+    messages. The prefix of its keys may not already be in use by another
+    scheme.
+    """
+    for existing in SCHEMES.itervalues():
+        if existing.name != scheme.name and existing.prefix == scheme.prefix:
+            raise ValueError('%r is already used by %s.' %
+                             (scheme.prefix, existing.name))
+    SCHEMES[scheme.name] = scheme
+    return scheme
+
+
+def scheme_for(key):
+    """
+    Returns the signature scheme used by the string representation of the
+    key.
+    """
+    for scheme in SCHEMES.itervalues():
+        if scheme.prefix and key.startswith(scheme.prefix):
+            return scheme
+    return DEFAULT_SCHEME
+
+
+register_scheme(DEFAULT_SCHEME)
+if ed25519 is not None and default_backend().ed25519_supported():
+    register_scheme(Ed25519Scheme())
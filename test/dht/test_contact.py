@@ -3,7 +3,10 @@
 Ensures details of contacts (other nodes on the network) are represented
 correctly.
 """
-from drogulus.dht.contact import Contact
+from drogulus.dht.contact import Contact, to_contacts
+from drogulus.dht.nodeid import NodeID
+from drogulus.net.packing import pack_nodes
+from drogulus.net.interning import SHARED_STRINGS, NODE_IDS
 from drogulus.version import get_version
 import unittest
 
@@ -24,11 +27,13 @@ class TestContact(unittest.TestCase):
         last_seen = 123
         contact = Contact(id, address, port, version, last_seen)
         self.assertEqual(id, contact.id)
+        self.assertIsInstance(contact.id, NodeID)
         self.assertEqual(address, contact.address)
         self.assertEqual(port, contact.port)
         self.assertEqual(version, contact.version)
         self.assertEqual(last_seen, contact.last_seen)
         self.assertEqual(0, contact.failed_RPCs)
+        self.assertEqual(frozenset(), contact.capabilities)
 
     def test_init_with_long_id(self):
         """
@@ -44,6 +49,7 @@ class TestContact(unittest.TestCase):
         expected = '09'
         self.assertEqual(expected, contact.id)
         self.assertEqual(12345L, long(contact.id.encode('hex'), 16))
+        self.assertEqual(12345L, contact.id.value)
 
     def test_init_with_int_id(self):
         """
@@ -98,3 +104,58 @@ class TestContact(unittest.TestCase):
         contact = Contact(id, address, port, version, last_seen)
         expected = "('12345', '192.168.0.1', 9999, '%s')" % version
         self.assertEqual(expected, str(contact))
+
+
+class TestToContacts(unittest.TestCase):
+    """
+    Ensures the to_contacts function works as expected.
+    """
+
+    def setUp(self):
+        self.version = get_version()
+        self.nodes = (('a' * 64, '192.168.0.1', 1908, self.version),
+                      ('b' * 64, '::1', 1909, self.version))
+
+    def check(self, contacts):
+        """
+        Ensures the contacts match the nodes set up for the test.
+        """
+        self.assertEqual(2, len(contacts))
+        for contact, node in zip(contacts, self.nodes):
+            self.assertIsInstance(contact, Contact)
+            self.assertEqual(node, (contact.id, contact.address, contact.port,
+                                    contact.version))
+
+    def test_tuples(self):
+        """
+        Ensures a tuple of node tuples results in the correct contacts.
+        """
+        self.check(to_contacts(self.nodes))
+
+    def test_packed(self):
+        """
+        Ensures packed nodes are decoded into the correct contacts.
+        """
+        self.check(to_contacts(pack_nodes(self.nodes)))
+
+    def test_shared_strings(self):
+        """
+        Ensures the contacts share the IDs of nodes in the routing table and
+        their versions.
+        """
+        node_id = NodeID('c' * 64)
+        NODE_IDS.add(node_id)
+        self.addCleanup(NODE_IDS.discard, node_id)
+        version = SHARED_STRINGS.intern(self.version)
+        nodes = ((''.join(['c'] * 64), '::1', 1908,
+                  ''.join(list(self.version))), )
+        for contacts in (to_contacts(nodes), to_contacts(pack_nodes(nodes))):
+            self.assertTrue(contacts[0].id is node_id)
+            self.assertTrue(contacts[0].version is version)
+
+    def test_packed_malformed(self):
+        """
+        Ensures malformed packed nodes result in a ValueError.
+        """
+        packed = pack_nodes(self.nodes)
+        self.assertRaises(ValueError, to_contacts, packed[:-3])
@@ -3,15 +3,24 @@
 Ensures code that represents a local node in the DHT network works as
 expected
 """
-from drogulus.dht.node import response_timeout, Lookup, Node
+from drogulus.dht.node import (response_timeout, Lookup, Node, HANDLERS,
+                               register_handler, message_cost)
 from drogulus.constants import (ERRORS, RPC_TIMEOUT, RESPONSE_TIMEOUT,
-                                REPLICATE_INTERVAL)
+                                REPLICATE_INTERVAL, EXPENSIVE_RPC_BURST,
+                                RESPONSE_BURST, MAX_BATCH_SIZE,
+                                BATCHED_RPC_BURST)
 from drogulus.dht.contact import Contact
+from drogulus.dht.nodeid import NodeID
+from drogulus.dht.verification import Verifier, ThreadedVerifier
 from drogulus.version import get_version
 from drogulus.net.protocol import DHTFactory
 from drogulus.net.messages import (Error, Ping, Pong, Store, FindNode, Nodes,
-                                   FindValue, Value)
-from drogulus.crypto import construct_key
+                                   FindValue, Value, Batch, BatchReply,
+                                   to_msgpack, from_msgpack)
+from drogulus.crypto import (construct_key, StreamedValue, PrehashedValue,
+                             Signer, validate_message)
+from drogulus.net.packing import pack_nodes
+from drogulus.net.interning import SHARED_STRINGS, NODE_IDS
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 from twisted.python import log
@@ -19,6 +28,7 @@ from twisted.internet import defer, task, reactor
 from twisted.python.failure import Failure
 from mock import MagicMock, patch
 from uuid import uuid4
+from StringIO import StringIO
 import time
 
 
@@ -267,7 +277,9 @@ class TestNode(unittest.TestCase):
         http://twistedmatrix.com/documents/current/core/howto/trial.html
         """
         self.node_id = '1234567890abc'
-        self.node = Node(self.node_id)
+        # Connections are made via the (mocked) clientFromString and messages
+        # are verified on the reactor thread.
+        self.node = Node(self.node_id, 'tcp:%s:%d', Verifier())
         self.factory = DHTFactory(self.node)
         self.protocol = self.factory.buildProtocol(('127.0.0.1', 0))
         self.transport = proto_helpers.StringTransport()
@@ -298,12 +310,15 @@ class TestNode(unittest.TestCase):
         Ensures the class is instantiated correctly.
         """
         node = Node(123)
-        self.assertEqual(123, node.id)
+        self.assertIsInstance(node.id, NodeID)
+        self.assertEqual(123, node.id.value)
+        self.assertTrue(node._routing_table._parent_node_id is node.id)
         self.assertTrue(node._routing_table)
         self.assertEqual({}, node._data_store)
         self.assertEqual({}, node._pending)
         self.assertEqual('ssl:%s:%d', node._client_string)
         self.assertEqual(get_version(), node.version)
+        self.assertEqual(0, node.backpressure.pauses)
 
     def test_message_received_calls_routing_table(self):
         """
@@ -327,6 +342,158 @@ class TestNode(unittest.TestCase):
         self.assertEqual(msg.version, arg1.version)
         self.assertTrue(isinstance(arg1.last_seen, float))
 
+    def test_message_received_records_capabilities(self):
+        """
+        Ensures the contact added to the routing table carries the
+        capabilities advertised by the remote peer.
+        """
+        self.node._routing_table.add_contact = MagicMock()
+        self.protocol.peer_capabilities = frozenset(['zlib'])
+        msg = Ping(str(uuid4()), self.node_id, get_version())
+        self.node.message_received(msg, self.protocol)
+        arg1 = self.node._routing_table.add_contact.call_args[0][0]
+        self.assertEqual(frozenset(['zlib']), arg1.capabilities)
+
+    def test_message_received_rate_limited(self):
+        """
+        Ensures a request from a peer that has exceeded its budget is shed
+        with an error 9 before the routing table or handlers are touched.
+        """
+        self.node._routing_table.add_contact = MagicMock()
+        self.node.handle_store = MagicMock()
+        self.node._rate_limiter.allow = MagicMock(return_value=False)
+        msg = Store(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, self.version)
+        with self.assertRaises(ValueError) as cm:
+            self.node.message_received(msg, self.protocol)
+        ex = cm.exception
+        self.assertEqual(9, ex.args[0])
+        self.assertEqual(ERRORS[9], ex.args[1])
+        self.assertEqual(self.uuid, ex.args[3])
+        peer = self.protocol.transport.getPeer()
+        self.node._rate_limiter.allow.assert_called_once_with(
+            'expensive', (msg.node, peer.host), cost=1)
+        self.assertEqual(0, self.node._routing_table.add_contact.call_count)
+        self.assertEqual(0, self.node.handle_store.call_count)
+
+    def test_message_received_cheap_budget(self):
+        """
+        Ensures Ping, FindNode and FindValue requests use the cheap budget.
+        """
+        self.node.handle_ping = MagicMock()
+        self.node.handle_find_node = MagicMock()
+        self.node.handle_find_value = MagicMock()
+        self.node._rate_limiter.allow = MagicMock(return_value=True)
+        for msg in (Ping(self.uuid, self.node_id, self.version),
+                    FindNode(self.uuid, self.node_id, self.key, self.version),
+                    FindValue(self.uuid, self.node_id, self.key,
+                              self.version)):
+            self.node.message_received(msg, self.protocol)
+            self.assertEqual('cheap',
+                             self.node._rate_limiter.allow.call_args[0][0])
+        self.assertEqual(3, self.node._rate_limiter.allow.call_count)
+
+    def test_message_received_responses_budget(self):
+        """
+        Ensures Pong, Value and Nodes responses use the response budget and
+        that errors are not rate limited.
+        """
+        self.node.handle_pong = MagicMock()
+        self.node.handle_value = MagicMock()
+        self.node.handle_nodes = MagicMock()
+        self.node.handle_error = MagicMock()
+        self.node._rate_limiter.allow = MagicMock(return_value=True)
+        for msg in (Pong(self.uuid, self.node_id, self.version),
+                    Value(self.uuid, self.node_id, self.key, self.value,
+                          self.timestamp, self.expires, PUBLIC_KEY,
+                          self.name, self.meta, self.signature,
+                          self.version),
+                    Nodes(self.uuid, self.node_id, (), self.version)):
+            self.node.message_received(msg, self.protocol)
+            self.assertEqual('response',
+                             self.node._rate_limiter.allow.call_args[0][0])
+        self.assertEqual(3, self.node._rate_limiter.allow.call_count)
+        msg = Error(self.uuid, self.node_id, 1, ERRORS[1], {}, self.version)
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual(3, self.node._rate_limiter.allow.call_count)
+        self.assertEqual(1, self.node.handle_error.call_count)
+
+    def test_message_received_batches_budget(self):
+        """
+        Ensures Batch and BatchReply messages are charged once, for each
+        request (or reply) they contain, against the batch and response
+        budgets.
+        """
+        self.node.handle_batch = MagicMock()
+        self.node.handle_batch_reply = MagicMock()
+        self.node._rate_limiter.allow = MagicMock(return_value=True)
+        batch = Batch(self.uuid, self.node_id, ('a', 'b', 'c'), self.version)
+        self.node.message_received(batch, self.protocol)
+        self.assertEqual('batch',
+                         self.node._rate_limiter.allow.call_args[0][0])
+        self.assertEqual(3,
+                         self.node._rate_limiter.allow.call_args[1]['cost'])
+        reply = BatchReply(self.uuid, self.node_id, ('a', 'b'), self.version)
+        self.node.message_received(reply, self.protocol)
+        self.assertEqual('response',
+                         self.node._rate_limiter.allow.call_args[0][0])
+        self.assertEqual(2,
+                         self.node._rate_limiter.allow.call_args[1]['cost'])
+
+    def test_message_cost(self):
+        """
+        Ensures a Batch (or BatchReply) costs a token for each request (or
+        reply) it contains and at least one. Other messages cost one.
+        """
+        self.assertEqual(1, message_cost(Ping(self.uuid, self.node_id,
+                                              self.version)))
+        self.assertEqual(3, message_cost(Batch(self.uuid, self.node_id,
+                                               ('a', 'b', 'c'),
+                                               self.version)))
+        self.assertEqual(2, message_cost(BatchReply(self.uuid, self.node_id,
+                                                    ('a', 'b'),
+                                                    self.version)))
+        self.assertEqual(1, message_cost(BatchReply(self.uuid, self.node_id,
+                                                    (), self.version)))
+
+    def test_message_received_response_flood(self):
+        """
+        Ensures a flood of responses larger than the budget results in the
+        excess being shed.
+        """
+        self.node.handle_pong = MagicMock()
+        msg = Pong(self.uuid, self.node_id, self.version)
+        # Stop the clock so no tokens are added during the flood.
+        with patch('drogulus.dht.ratelimit.time') as mock_time:
+            mock_time.time.return_value = 1.0
+            for i in range(RESPONSE_BURST):
+                self.node.message_received(msg, self.protocol)
+            with self.assertRaises(ValueError) as cm:
+                self.node.message_received(msg, self.protocol)
+        self.assertEqual(9, cm.exception.args[0])
+        self.assertEqual(RESPONSE_BURST, self.node.handle_pong.call_count)
+
+    def test_message_received_burst_exceeded(self):
+        """
+        Ensures a burst of Store requests larger than the budget results in
+        the excess being shed.
+        """
+        self.node.handle_store = MagicMock()
+        msg = Store(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, self.version)
+        # Stop the clock so no tokens are added during the burst.
+        with patch('drogulus.dht.ratelimit.time') as mock_time:
+            mock_time.time.return_value = 1.0
+            for i in range(EXPENSIVE_RPC_BURST):
+                self.node.message_received(msg, self.protocol)
+            with self.assertRaises(ValueError) as cm:
+                self.node.message_received(msg, self.protocol)
+        self.assertEqual(9, cm.exception.args[0])
+        self.assertEqual(EXPENSIVE_RPC_BURST,
+                         self.node.handle_store.call_count)
+
     def test_message_received_ping(self):
         """
         Ensures a Ping message is handled correctly.
@@ -341,6 +508,74 @@ class TestNode(unittest.TestCase):
         # Check it results in a call to the node's handle_ping method.
         self.node.handle_ping.assert_called_once_with(msg, self.protocol)
 
+    def test_message_received_shares_strings(self):
+        """
+        Ensures the contact created for the sender of a message shares the
+        ID held in the routing table, the version and the capabilities.
+        """
+        node_id = NodeID('shared')
+        NODE_IDS.add(node_id)
+        self.addCleanup(NODE_IDS.discard, node_id)
+        self.node._routing_table.add_contact = MagicMock()
+        capabilities = frozenset(['zlib'])
+        self.protocol.peer_capabilities = capabilities
+        msg = Ping(self.uuid, ''.join(list(node_id)),
+                   ''.join(list(self.version)))
+        self.node.message_received(msg, self.protocol)
+        contact = self.node._routing_table.add_contact.call_args[0][0]
+        self.assertTrue(contact.id is node_id)
+        self.assertTrue(contact.version is
+                        SHARED_STRINGS.intern(self.version))
+        self.assertTrue(contact.capabilities is capabilities)
+
+    def test_message_received_registered_handler(self):
+        """
+        Ensures messages are passed to the handler registered for their type
+        along with the node, protocol and sender.
+        """
+        class Probe(Ping):
+            pass
+        handler = MagicMock()
+        register_handler(Probe, handler)
+        self.addCleanup(HANDLERS.pop, Probe)
+        msg = Probe(str(uuid4()), self.node_id, get_version())
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual(1, handler.call_count)
+        node, message, protocol, sender = handler.call_args[0]
+        self.assertEqual(self.node, node)
+        self.assertEqual(msg, message)
+        self.assertEqual(self.protocol, protocol)
+        self.assertEqual(self.node_id, sender.id)
+
+    def test_message_received_registered_budget(self):
+        """
+        Ensures messages are rate limited using the budget registered for
+        their type.
+        """
+        class Probe(Ping):
+            pass
+        handler = MagicMock()
+        register_handler(Probe, handler, 'expensive')
+        self.addCleanup(HANDLERS.pop, Probe)
+        self.node._rate_limiter.allow = MagicMock(return_value=False)
+        msg = Probe(str(uuid4()), self.node_id, get_version())
+        self.assertRaises(ValueError, self.node.message_received, msg,
+                          self.protocol)
+        self.assertEqual('expensive',
+                         self.node._rate_limiter.allow.call_args[0][0])
+        self.assertEqual(0, handler.call_count)
+
+    def test_message_received_unregistered_type(self):
+        """
+        Ensures messages of a type without a handler are ignored.
+        """
+        class Probe(Ping):
+            pass
+        msg = Probe(str(uuid4()), self.node_id, get_version())
+        self.node.handle_ping = MagicMock()
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual(0, self.node.handle_ping.call_count)
+
     def test_message_received_pong(self):
         """
         Ensures a Pong message is handled correctly.
@@ -485,7 +720,7 @@ class TestNode(unittest.TestCase):
         # Ensure the loseConnection method was also called.
         self.protocol.transport.loseConnection.assert_called_once_with()
 
-    @patch('drogulus.dht.node.validate_message')
+    @patch('drogulus.dht.verification.validate_message')
     def test_handle_store_checks_with_validate_message(self, mock_validator):
         """
         Ensure that the validate_message function is called as part of
@@ -527,6 +762,23 @@ class TestNode(unittest.TestCase):
         result = Pong(self.uuid, self.node.id, self.version)
         self.protocol.sendMessage.assert_called_once_with(result, True)
 
+    @patch('drogulus.dht.node.reactor.callLater')
+    def test_handle_store_shares_strings(self, mock_call_later):
+        """
+        Ensures the stored message shares the strings it has in common with
+        other messages.
+        """
+        self.protocol.sendMessage = MagicMock()
+        msg = Store(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, ''.join(list(self.version)))
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        self.node.handle_store(msg, self.protocol, other_node)
+        stored = self.node._data_store[self.key]
+        self.assertEqual(msg, stored)
+        self.assertTrue(stored.version is SHARED_STRINGS.intern(self.version))
+
     def test_handle_store_old_value(self):
         """
         Ensures that a Store message containing an out-of-date version of a
@@ -556,16 +808,18 @@ class TestNode(unittest.TestCase):
                         self.meta, old_sig, self.version)
         other_node = Contact(self.node.id, '127.0.0.1', 1908,
                              self.version, time.time())
-        # Check for the expected exception.
-        ex = self.assertRaises(ValueError, self.node.handle_store, old_msg,
-                               self.protocol, other_node)
+        # Check for the expected error.
+        self.protocol.sendMessage = MagicMock()
+        self.node.handle_store(old_msg, self.protocol, other_node)
         details = {
             'new_timestamp': '%d' % self.timestamp
         }
-        self.assertEqual(ex.args[0], 8)
-        self.assertEqual(ex.args[1], ERRORS[8])
-        self.assertEqual(ex.args[2], details)
-        self.assertEqual(ex.args[3], self.uuid)
+        error, lose_connection = self.protocol.sendMessage.call_args[0]
+        self.assertTrue(lose_connection)
+        self.assertEqual(error.code, 8)
+        self.assertEqual(error.title, ERRORS[8])
+        self.assertEqual(error.details, details)
+        self.assertEqual(error.uuid, self.uuid)
         # Ensure the original message is in local storage.
         self.assertIn(self.key, self.node._data_store)
         self.assertEqual(newer_msg, self.node._data_store[self.key])
@@ -623,16 +877,18 @@ class TestNode(unittest.TestCase):
         # Sanity check for expected routing table start state.
         self.assertEqual(1, len(self.node._routing_table._buckets[0]))
         # Handle faulty message.
-        ex = self.assertRaises(ValueError, self.node.handle_store, msg,
-                               self.protocol, other_node)
-        # Check the exception
-        self.assertEqual(ex.args[0], 6)
-        self.assertEqual(ex.args[1], ERRORS[6])
+        self.protocol.sendMessage = MagicMock()
+        self.node.handle_store(msg, self.protocol, other_node)
+        # Check the error
+        error, lose_connection = self.protocol.sendMessage.call_args[0]
+        self.assertTrue(lose_connection)
+        self.assertEqual(error.code, 6)
+        self.assertEqual(error.title, ERRORS[6])
         details = {
             'message': 'You have been removed from remote routing table.'
         }
-        self.assertEqual(ex.args[2], details)
-        self.assertEqual(ex.args[3], self.uuid)
+        self.assertEqual(error.details, details)
+        self.assertEqual(error.uuid, self.uuid)
         # Ensure the message is not in local storage.
         self.assertNotIn(self.key, self.node._data_store)
         # Ensure the contact is not in the routing table
@@ -655,6 +911,52 @@ class TestNode(unittest.TestCase):
         # Ensure the loseConnection method was also called.
         self.protocol.transport.loseConnection.assert_called_once_with()
 
+    def test_handle_store_asynchronous(self):
+        """
+        Ensures the Store message is only stored (and replied to) once the
+        verifier has checked it.
+        """
+        self.protocol.sendMessage = MagicMock()
+        verified = defer.Deferred()
+        self.node._verifier.submit = MagicMock(return_value=verified)
+        msg = Store(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, self.version)
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        self.node.handle_store(msg, self.protocol, other_node)
+        self.assertNotIn(self.key, self.node._data_store)
+        self.assertEqual(0, self.protocol.sendMessage.call_count)
+        verified.callback((True, None))
+        self.assertIn(self.key, self.node._data_store)
+        result = Pong(self.uuid, self.node.id, self.version)
+        self.protocol.sendMessage.assert_called_once_with(result, True)
+
+    def test_handle_store_verifier_full(self):
+        """
+        Ensures a Store message is shed with an error 9 (Too many requests)
+        if too many messages are awaiting verification.
+        """
+        self.protocol.sendMessage = MagicMock()
+        self.node._verifier.queued = self.node._verifier.max_queue
+        msg = Store(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, self.version)
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        self.node.handle_store(msg, self.protocol, other_node)
+        self.assertNotIn(self.key, self.node._data_store)
+        error, lose_connection = self.protocol.sendMessage.call_args[0]
+        self.assertEqual(9, error.code)
+        self.assertEqual(self.uuid, error.uuid)
+
+    def test_default_verifier(self):
+        """
+        Ensures nodes verify messages in a pool of threads by default.
+        """
+        node = Node(self.node_id)
+        self.assertIsInstance(node._verifier, ThreadedVerifier)
+
     def test_handle_find_nodes(self):
         """
         Ensure a valid FindNodes message is handled correctly.
@@ -674,6 +976,40 @@ class TestNode(unittest.TestCase):
         result = Nodes(msg.uuid, self.node.id, other_nodes, self.version)
         self.protocol.sendMessage.assert_called_once_with(result, True)
 
+    def test_handle_find_nodes_packed(self):
+        """
+        Ensure the nodes are packed if the peer has advertised the
+        'packed_nodes' capability.
+        """
+        self.protocol.sendMessage = MagicMock()
+        self.protocol.peer_capabilities = frozenset(['packed_nodes'])
+        for i in range(20):
+            contact = Contact(chr(i) * 64, "192.168.0.%d" % i, 1908,
+                              self.version)
+            self.node._routing_table.add_contact(contact)
+        msg = FindNode(self.uuid, self.node.id, self.key, self.version)
+        self.node.handle_find_node(msg, self.protocol)
+        other_nodes = [(n.id, n.address, n.port, n.version) for n in
+                       self.node._routing_table.find_close_nodes(self.key)]
+        result = Nodes(msg.uuid, self.node.id, pack_nodes(other_nodes),
+                       self.version)
+        self.protocol.sendMessage.assert_called_once_with(result, True)
+
+    def test_handle_find_nodes_unpackable(self):
+        """
+        Ensure the nodes are sent as tuples if they cannot be packed.
+        """
+        self.protocol.sendMessage = MagicMock()
+        self.protocol.peer_capabilities = frozenset(['packed_nodes'])
+        contact = Contact('short id', "192.168.0.1", 1908, self.version)
+        self.node._routing_table.add_contact(contact)
+        msg = FindNode(self.uuid, self.node.id, self.key, self.version)
+        self.node.handle_find_node(msg, self.protocol)
+        result = Nodes(msg.uuid, self.node.id,
+                       [('short id', "192.168.0.1", 1908, self.version)],
+                       self.version)
+        self.protocol.sendMessage.assert_called_once_with(result, True)
+
     def test_handle_find_nodes_loses_connection(self):
         """
         Ensures the handle_find_nodes method loses the connection after
@@ -765,7 +1101,21 @@ class TestNode(unittest.TestCase):
         # an error has happened, the other the actual error message).
         self.assertEqual(2, log.msg.call_count)
 
-    @patch('drogulus.dht.node.validate_message')
+    def _pending_value(self, value=None):
+        """
+        Returns a Value message (with the referenced value) that is a response
+        to a pending request along with the deferred awaiting it.
+        """
+        if value is None:
+            value = self.value
+        msg = Value(self.uuid, self.node.id, self.key, value, self.timestamp,
+                    self.expires, PUBLIC_KEY, self.name, self.meta,
+                    self.signature, self.node.version)
+        deferred = defer.Deferred()
+        self.node._pending[self.uuid] = deferred
+        return msg, deferred
+
+    @patch('drogulus.dht.verification.validate_message')
     def test_handle_value_checks_with_validate_message(self, mock_validator):
         """
         Ensure that the validate_message function is called as part of
@@ -775,47 +1125,39 @@ class TestNode(unittest.TestCase):
         # Create a fake contact and valid message.
         other_node = Contact(self.node.id, '127.0.0.1', 1908,
                              self.version, time.time())
-        msg = Value(self.uuid, self.node.id, self.key, self.value,
-                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
-                    self.meta, self.signature, self.node.version)
+        msg, deferred = self._pending_value()
         # Handle it.
         self.node.handle_value(msg, other_node)
         mock_validator.assert_called_once_with(msg)
 
     def test_handle_value_with_valid_message(self):
         """
-        Ensure a valid Value is checked and results in the expected call to
-        trigger_deferred.
+        Ensure a valid Value is checked and results in the deferred awaiting
+        it being called with the message.
         """
-        # Mock
-        self.node.trigger_deferred = MagicMock()
         # Create a fake contact and valid message.
         other_node = Contact(self.node.id, '127.0.0.1', 1908,
                              self.version, time.time())
-        msg = Value(self.uuid, self.node.id, self.key, self.value,
-                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
-                    self.meta, self.signature, self.node.version)
+        msg, deferred = self._pending_value()
         # Handle it.
         self.node.handle_value(msg, other_node)
-        self.node.trigger_deferred.assert_called_once_with(msg)
+        self.assertEqual(msg, self.successResultOf(deferred))
+        self.assertEqual({}, self.node._pending)
 
     def test_handle_value_with_bad_message(self):
         """
-        Ensure a bad message results in an error sent to trigger_deferred along
-        with expected logging and removal or the other node from the local
-        node's routing table.
+        Ensure a bad message results in an error sent to the deferred awaiting
+        it along with expected logging and removal or the other node from the
+        local node's routing table.
         """
         # Mocks
         self.node._routing_table.remove_contact = MagicMock()
-        self.node.trigger_deferred = MagicMock()
         patcher = patch('drogulus.dht.node.log.msg')
         mockLog = patcher.start()
         # Create a fake contact and valid message.
         other_node = Contact(self.node.id, '127.0.0.1', 1908,
                              self.version, time.time())
-        msg = Value(self.uuid, self.node.id, self.key, 'bad_value',
-                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
-                    self.meta, self.signature, self.node.version)
+        msg, deferred = self._pending_value('bad_value')
         # Handle it.
         self.node.handle_value(msg, other_node)
         # Logger was called twice.
@@ -823,14 +1165,67 @@ class TestNode(unittest.TestCase):
         # other node was removed from the routing table.
         self.node._routing_table.remove_contact.\
             assert_called_once_with(other_node.id, True)
-        # trigger_deferred called as expected.
-        self.assertEqual(1, self.node.trigger_deferred.call_count)
-        self.assertEqual(self.node.trigger_deferred.call_args[0][0], msg)
-        self.assertIsInstance(self.node.trigger_deferred.call_args[0][1],
-                              ValueError)
+        # The deferred was errbacked as expected.
+        failure = self.failureResultOf(deferred, ValueError)
+        self.assertEqual(msg, failure.value.message)
+        self.assertEqual({}, self.node._pending)
         # Tidy up.
         patcher.stop()
 
+    def test_handle_value_verifier_full(self):
+        """
+        Ensure the deferred awaiting a Value is errbacked if the message
+        cannot be verified because too many messages are awaiting
+        verification.
+        """
+        patcher = patch('drogulus.dht.node.log.msg')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node._verifier.queued = self.node._verifier.max_queue
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        msg, deferred = self._pending_value()
+        self.node.handle_value(msg, other_node)
+        error = self.failureResultOf(deferred, ValueError).value
+        self.assertEqual(9, error.args[0])
+        self.assertEqual(msg, error.message)
+
+    def test_handle_value_unsolicited(self):
+        """
+        Ensure a Value that isn't a response to a pending request is dropped
+        without being verified.
+        """
+        patcher = patch('drogulus.dht.node.log.msg')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node._verifier.verify = MagicMock()
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        msg = Value(self.uuid, self.node.id, self.key, self.value,
+                    self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                    self.meta, self.signature, self.node.version)
+        self.assertEqual(None, self.node.handle_value(msg, other_node))
+        self.assertEqual(0, self.node._verifier.verify.call_count)
+
+    def test_handle_value_claims_deferred(self):
+        """
+        Ensure the deferred awaiting a Value is removed from the _pending
+        dictionary while the message is verified so it can't time out (or be
+        answered by another message) in the meantime.
+        """
+        verified = defer.Deferred()
+        self.node._verifier.verify = MagicMock(return_value=verified)
+        other_node = Contact(self.node.id, '127.0.0.1', 1908,
+                             self.version, time.time())
+        msg, deferred = self._pending_value()
+        self.node.handle_value(msg, other_node)
+        self.assertEqual({}, self.node._pending)
+        self.assertEqual(None, self.node.handle_value(msg, other_node))
+        self.assertEqual(1, self.node._verifier.verify.call_count)
+        self.assertNoResult(deferred)
+        verified.callback((True, None))
+        self.assertEqual(msg, self.successResultOf(deferred))
+
     def test_handle_nodes(self):
         """
         Ensure a Nodes message merely results in the expected call to
@@ -843,6 +1238,215 @@ class TestNode(unittest.TestCase):
         self.node.handle_nodes(msg)
         self.node.trigger_deferred.assert_called_once_with(msg)
 
+    def _batched_store(self):
+        """
+        Returns a valid Store message with a new uuid.
+        """
+        return Store(str(uuid4()), self.node.id, self.key, self.value,
+                     self.timestamp, self.expires, PUBLIC_KEY, self.name,
+                     self.meta, self.signature, self.version)
+
+    def test_handle_batch(self):
+        """
+        Ensure each request in a Batch message is handled as if it arrived on
+        its own and the replies (including an Error for each request that
+        can't be batched) are sent back in a single BatchReply.
+        """
+        self.protocol.sendMessage = MagicMock()
+        store = self._batched_store()
+        find_value = FindValue(str(uuid4()), self.node.id, 'x' * 64,
+                               self.version)
+        ping = Ping(str(uuid4()), self.node.id, self.version)
+        msg = Batch(self.uuid, self.node.id,
+                    tuple(to_msgpack(m) for m in (store, find_value, ping)),
+                    self.version)
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual(store, self.node._data_store[self.key])
+        self.assertEqual(1, self.protocol.sendMessage.call_count)
+        reply, lose_connection = self.protocol.sendMessage.call_args[0]
+        self.assertTrue(lose_connection)
+        self.assertIsInstance(reply, BatchReply)
+        self.assertEqual(self.uuid, reply.uuid)
+        results = [from_msgpack(raw) for raw in reply.results]
+        self.assertEqual(Pong(store.uuid, self.node.id, self.version),
+                         results[0])
+        self.assertIsInstance(results[1], Nodes)
+        self.assertEqual(find_value.uuid, results[1].uuid)
+        self.assertIsInstance(results[2], Error)
+        self.assertEqual(ping.uuid, results[2].uuid)
+        self.assertEqual(2, results[2].code)
+
+    def test_handle_batch_asynchronous(self):
+        """
+        Ensure the BatchReply is only sent once every request in the Batch
+        has been verified and handled.
+        """
+        self.protocol.sendMessage = MagicMock()
+        verified = defer.Deferred()
+        self.node._verifier.submit = MagicMock(return_value=verified)
+        store = self._batched_store()
+        msg = Batch(self.uuid, self.node.id, (to_msgpack(store), ),
+                    self.version)
+        self.node.handle_batch(msg, self.protocol)
+        self.assertEqual(0, self.protocol.sendMessage.call_count)
+        verified.callback((True, None))
+        reply = self.protocol.sendMessage.call_args[0][0]
+        self.assertEqual([Pong(store.uuid, self.node.id, self.version)],
+                         [from_msgpack(raw) for raw in reply.results])
+
+    def test_handle_batch_rate_limited(self):
+        """
+        Ensure a full Batch of Store messages (more than the expensive budget
+        allows on their own) is handled in its entirety since the sender is
+        charged once for the whole batch. Batches beyond the sender's batch
+        budget are shed with an error 9.
+        """
+        self.assertTrue(MAX_BATCH_SIZE > EXPENSIVE_RPC_BURST)
+        self.protocol.sendMessage = MagicMock()
+        stores = [self._batched_store() for i in range(MAX_BATCH_SIZE)]
+        msg = Batch(self.uuid, self.node.id,
+                    tuple(to_msgpack(m) for m in stores), self.version)
+        # Stop the clock so no tokens are added while the batches are handled.
+        with patch('drogulus.dht.ratelimit.time') as mock_time:
+            mock_time.time.return_value = 1.0
+            for i in range(BATCHED_RPC_BURST / MAX_BATCH_SIZE):
+                self.node.message_received(msg, self.protocol)
+                reply = self.protocol.sendMessage.call_args[0][0]
+                results = [from_msgpack(raw) for raw in reply.results]
+                self.assertEqual([Pong(store.uuid, self.node.id,
+                                       self.version) for store in stores],
+                                 results)
+            with self.assertRaises(ValueError) as cm:
+                self.node.message_received(msg, self.protocol)
+        self.assertEqual(9, cm.exception.args[0])
+        self.assertEqual(self.uuid, cm.exception.args[3])
+
+    def test_handle_batch_large_replies(self):
+        """
+        Ensure replies that would make the BatchReply too big are sent on
+        their own ahead of it.
+        """
+        self.protocol.sendMessage = MagicMock()
+        stores = [self._batched_store() for i in range(3)]
+        msg = Batch(self.uuid, self.node.id,
+                    tuple(to_msgpack(m) for m in stores), self.version)
+        pong = Pong(stores[0].uuid, self.node.id, self.version)
+        limit = len(self.protocol.encode(pong)) * 2
+        with patch('drogulus.dht.node.constants.MAX_BATCH_PAYLOAD', limit):
+            self.node.handle_batch(msg, self.protocol)
+        calls = [call[0] for call in self.protocol.sendMessage.call_args_list]
+        self.assertEqual(2, len(calls))
+        self.assertEqual((Pong(stores[2].uuid, self.node.id, self.version), ),
+                         calls[0])
+        reply, lose_connection = calls[1]
+        self.assertTrue(lose_connection)
+        self.assertEqual([Pong(store.uuid, self.node.id, self.version)
+                          for store in stores[:2]],
+                         [from_msgpack(raw) for raw in reply.results])
+
+    def test_handle_batch_reply_empty(self):
+        """
+        Ensure a BatchReply without any results (because every reply was sent
+        on its own) is valid and fires the deferred for the batch.
+        """
+        msg = BatchReply(self.uuid, self.node.id, (), self.version)
+        msg = from_msgpack(to_msgpack(msg))
+        d = defer.Deferred()
+        self.node._pending[self.uuid] = d
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual(msg, self.successResultOf(d))
+
+    def test_handle_batch_reply(self):
+        """
+        Ensure the reply to each request in a BatchReply fires the deferred
+        for that request (with an errback for an Error) before the deferred
+        for the batch itself is fired.
+        """
+        pong = Pong(str(uuid4()), self.node.id, self.version)
+        error = Error(str(uuid4()), self.node.id, 9, ERRORS[9], {},
+                      self.version)
+        msg = BatchReply(self.uuid, self.node.id,
+                         (to_msgpack(pong), to_msgpack(error)), self.version)
+        fired = []
+        for uuid in (pong.uuid, error.uuid, msg.uuid):
+            d = defer.Deferred()
+            d.addBoth(fired.append)
+            self.node._pending[uuid] = d
+        self.node.message_received(msg, self.protocol)
+        self.assertEqual({}, self.node._pending)
+        self.assertEqual(pong, fired[0])
+        self.assertEqual(9, fired[1].value.args[0])
+        self.assertEqual(error, fired[1].value.message)
+        self.assertEqual(msg, fired[2])
+
+    def test_handle_batch_reply_failed_item(self):
+        """
+        Ensure a reply in a BatchReply that can't be handled errbacks the
+        deferred for its request without affecting the other replies or the
+        deferred for the batch.
+        """
+        first = Pong(str(uuid4()), self.node.id, self.version)
+        second = Pong(str(uuid4()), self.node.id, self.version)
+        msg = BatchReply(self.uuid, self.node.id,
+                         (to_msgpack(first), to_msgpack(second)),
+                         self.version)
+        self.node.handle_pong = MagicMock(
+            side_effect=[ValueError(3, ERRORS[3], {}, first.uuid), None])
+        fired = []
+        for uuid in (first.uuid, msg.uuid):
+            d = defer.Deferred()
+            d.addBoth(fired.append)
+            self.node._pending[uuid] = d
+        patcher = patch('drogulus.dht.node.log.msg')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node.handle_batch_reply(msg, self.protocol)
+        self.assertEqual(2, self.node.handle_pong.call_count)
+        self.assertEqual({}, self.node._pending)
+        self.assertEqual(3, fired[0].value.args[0])
+        self.assertEqual(first, fired[0].value.message)
+        self.assertEqual(msg, fired[1])
+
+    def test_handle_batch_reply_unexpected(self):
+        """
+        Ensure requests and undecodable data in a BatchReply are ignored.
+        """
+        self.node.handle_store = MagicMock()
+        store = self._batched_store()
+        msg = BatchReply(self.uuid, self.node.id,
+                         (to_msgpack(store), 'rubbish'), self.version)
+        patcher = patch('drogulus.dht.node.log.msg')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.node.handle_batch_reply(msg, self.protocol)
+        self.assertEqual(0, self.node.handle_store.call_count)
+
+    def test_client_endpoint_uses_tls_session_cache(self):
+        """
+        Ensure that plain "ssl:" connections are made with an endpoint from
+        the node's TLS session cache.
+        """
+        node = Node(self.node_id)
+        node._tls_sessions.endpoint = MagicMock(return_value='endpoint')
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        result = node.client_endpoint(contact)
+        self.assertEqual('endpoint', result)
+        node._tls_sessions.endpoint.assert_called_once_with(reactor,
+                                                            '127.0.0.1',
+                                                            54321)
+
+    @patch('drogulus.dht.node.clientFromString')
+    def test_client_endpoint_from_client_string(self, mock_client):
+        """
+        Ensure that other client strings are used to create the endpoint
+        with clientFromString.
+        """
+        mock_client.return_value = 'endpoint'
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        result = self.node.client_endpoint(contact)
+        self.assertEqual('endpoint', result)
+        mock_client.assert_called_once_with(reactor, 'tcp:127.0.0.1:54321')
+
     @patch('drogulus.dht.node.clientFromString')
     def test_send_message(self, mock_client):
         """
@@ -976,6 +1580,21 @@ class TestNode(unittest.TestCase):
         # Tidy up.
         self.clock.advance(RPC_TIMEOUT)
 
+    @patch('drogulus.dht.node.clientFromString')
+    def test_send_message_uses_contact_capabilities(self, mock_client):
+        """
+        Ensure the protocol used to send the message knows about the
+        capabilities of the recipient.
+        """
+        mock_client.return_value = FakeClient(self.protocol)
+        msg = Ping(str(uuid4()), self.node_id, get_version())
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        contact.capabilities = frozenset(['zlib'])
+        self.node.send_message(contact, msg)
+        self.assertEqual(frozenset(['zlib']), self.protocol.peer_capabilities)
+        # Tidy up.
+        self.clock.advance(RPC_TIMEOUT)
+
     @patch('drogulus.dht.node.clientFromString')
     def test_send_message_fires_errback_in_case_of_errors(self, mock_client):
         """
@@ -1193,3 +1812,222 @@ class TestNode(unittest.TestCase):
         self.assertEqual(message_to_send.meta, self.meta)
         self.assertEqual(message_to_send.sig, self.signature)
         self.assertEqual(message_to_send.version, self.node.version)
+
+    def test_send_store_streamed_value(self):
+        """
+        Ensure a StreamedValue is signed as it is read and the Store message
+        contains the value read into memory.
+        """
+        self.node.send_replicate = MagicMock()
+        value = StreamedValue(StringIO(self.value))
+        self.node.send_store(PRIVATE_KEY, PUBLIC_KEY, self.name, value,
+                             self.timestamp, self.expires, self.meta)
+        message_to_send = self.node.send_replicate.call_args[0][0]
+        self.assertIsInstance(message_to_send.value, PrehashedValue)
+        self.assertEqual(self.value, message_to_send.value)
+        self.assertEqual(self.signature, message_to_send.sig)
+
+    def test_send_store_streamed_iterable(self):
+        """
+        Ensure a StreamedValue from an iterable (which can only be read once)
+        is rejected before it is read.
+        """
+        self.node.send_replicate = MagicMock()
+        chunks = MagicMock()
+        value = StreamedValue(chunks, 5)
+        self.assertRaises(TypeError, self.node.send_store, PRIVATE_KEY,
+                          PUBLIC_KEY, self.name, value, self.timestamp,
+                          self.expires, self.meta)
+        self.assertEqual(0, chunks.__iter__.call_count)
+        self.assertEqual(0, self.node.send_replicate.call_count)
+
+    def test_load_identity(self):
+        """
+        Ensure the node's identity is loaded into a Signer.
+        """
+        self.assertEqual(None, self.node.signer)
+        self.node.load_identity(PRIVATE_KEY, PUBLIC_KEY)
+        self.assertIsInstance(self.node.signer, Signer)
+        self.assertEqual(PUBLIC_KEY, self.node.signer.public_key)
+
+    def test_publish(self):
+        """
+        Ensure a value is published in a Store message signed with the
+        node's identity.
+        """
+        self.node.send_replicate = MagicMock(return_value='sent')
+        self.node.load_identity(PRIVATE_KEY, PUBLIC_KEY)
+        d = self.node.publish(self.name, self.value, self.timestamp,
+                              self.expires, self.meta)
+        self.assertEqual('sent', self.successResultOf(d))
+        message_to_send = self.node.send_replicate.call_args[0][0]
+        self.assertIsInstance(message_to_send, Store)
+        self.assertEqual(self.key, message_to_send.key)
+        self.assertEqual(PUBLIC_KEY, message_to_send.public_key)
+        self.assertEqual(self.signature, message_to_send.sig)
+
+    def test_publish_defaults(self):
+        """
+        Ensure the timestamp defaults to now and the meta to an empty
+        dictionary.
+        """
+        self.node.send_replicate = MagicMock()
+        self.node.load_identity(PRIVATE_KEY, PUBLIC_KEY)
+        before = time.time()
+        self.node.publish(self.name, self.value)
+        message_to_send = self.node.send_replicate.call_args[0][0]
+        self.assertTrue(message_to_send.timestamp >= before)
+        self.assertEqual(0.0, message_to_send.expires)
+        self.assertEqual({}, message_to_send.meta)
+
+    @patch('drogulus.crypto.PARALLEL_HASH_THRESHOLD', 4)
+    def test_publish_large_value(self):
+        """
+        Ensure large values are hashed in a thread before the Store message
+        is signed.
+        """
+        self.node.send_replicate = MagicMock(side_effect=lambda store: store)
+        self.node.load_identity(PRIVATE_KEY, PUBLIC_KEY)
+        d = self.node.publish(self.name, self.value, self.timestamp,
+                              self.expires, self.meta)
+
+        def check(message_to_send):
+            self.assertIsInstance(message_to_send.value, PrehashedValue)
+            self.assertEqual(self.value, message_to_send.value)
+            self.assertEqual(self.signature, message_to_send.sig)
+
+        d.addCallback(check)
+        return d
+
+    def test_publish_without_identity(self):
+        """
+        Ensure a ValueError is raised if no identity has been loaded.
+        """
+        self.assertRaises(ValueError, self.node.publish, self.name,
+                          self.value)
+
+    def test_publish_many(self):
+        """
+        Ensure each value is published and the results are returned.
+        """
+        self.node.send_replicate = MagicMock(side_effect=lambda store: store)
+        self.node.load_identity(PRIVATE_KEY, PUBLIC_KEY)
+        values = [(self.name, self.value, self.timestamp, self.expires,
+                   self.meta), ('other', 'value', 1.0, 0.0, None)]
+        deferreds = self.node.publish_many(values)
+        result = [self.successResultOf(d) for d in deferreds]
+        self.assertEqual(2, len(result))
+        self.assertEqual(self.signature, result[0].sig)
+        self.assertEqual(construct_key(PUBLIC_KEY, 'other'), result[1].key)
+        self.assertEqual({}, result[1].meta)
+        self.assertTrue(validate_message(result[1])[0])
+
+    @patch('drogulus.dht.node.clientFromString')
+    def test_send_batch(self, mock_client):
+        """
+        Ensure send_batch sends the messages in a single Batch message and
+        returns a deferred for each message that fires with its reply.
+        Messages without a reply in the BatchReply result in an errback.
+        """
+        mock_client.return_value = FakeClient(self.protocol)
+        self.protocol.sendMessage = MagicMock()
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        contact.capabilities = frozenset(['batch', 'compact'])
+        stores = [self._batched_store() for i in range(3)]
+        deferreds = self.node.send_batch(contact, stores)
+        self.assertEqual(3, len(deferreds))
+        for store, d in zip(stores, deferreds):
+            self.assertEqual(d, self.node._pending[store.uuid])
+        batch = self.protocol.sendMessage.call_args[0][0]
+        self.assertIsInstance(batch, Batch)
+        self.assertIn(batch.uuid, self.node._pending)
+        self.assertEqual([to_msgpack(store, True) for store in stores],
+                         list(batch.messages))
+        results = []
+        for d in deferreds:
+            d.addBoth(results.append)
+        pongs = [Pong(store.uuid, self.node.id, self.version)
+                 for store in stores[:2]]
+        reply = BatchReply(batch.uuid, self.node.id,
+                           tuple(to_msgpack(pong) for pong in pongs),
+                           self.version)
+        self.node.message_received(reply, self.protocol)
+        self.assertEqual(pongs, results[:2])
+        self.assertIsInstance(results[2], Failure)
+        self.assertEqual(1, results[2].value.args[0])
+        self.assertEqual({}, self.node._pending)
+        # Tidy up.
+        self.clock.advance(RPC_TIMEOUT)
+
+    @patch('drogulus.dht.node.clientFromString')
+    def test_send_batch_fails(self, mock_client):
+        """
+        Ensure the deferred for every message errbacks if the batch can't be
+        sent.
+        """
+        mock_client.return_value = FakeClient(self.protocol, success=False)
+        patcher = patch('drogulus.dht.node.log.msg')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        contact.capabilities = frozenset(['batch'])
+        stores = [self._batched_store() for i in range(2)]
+        errback = MagicMock()
+        for d in self.node.send_batch(contact, stores):
+            d.addErrback(errback)
+        self.assertEqual(2, errback.call_count)
+        self.assertEqual({}, self.node._pending)
+        # Tidy up.
+        self.clock.advance(RPC_TIMEOUT)
+
+    def test_send_batch_splits(self):
+        """
+        Ensure no more than MAX_BATCH_SIZE messages are sent in each batch.
+        """
+        self.node.send_message = MagicMock(return_value=defer.Deferred())
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        contact.capabilities = frozenset(['batch'])
+        stores = [self._batched_store() for i in range(3)]
+        with patch('drogulus.dht.node.constants.MAX_BATCH_SIZE', 2):
+            deferreds = self.node.send_batch(contact, stores)
+        self.assertEqual(3, len(deferreds))
+        batches = [call[0][1] for call in
+                   self.node.send_message.call_args_list]
+        self.assertEqual([2, 1], [len(batch.messages) for batch in batches])
+
+    def test_send_batch_splits_by_size(self):
+        """
+        Ensure no more than MAX_BATCH_PAYLOAD bytes of requests are sent in
+        each batch and that requests too big to fit in a batch are sent on
+        their own.
+        """
+        self.node.send_message = MagicMock(return_value=defer.Deferred())
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        contact.capabilities = frozenset(['batch'])
+        stores = [self._batched_store() for i in range(3)]
+        limit = len(to_msgpack(stores[0])) * 2
+        large = self._batched_store()._replace(value='x' * limit)
+        with patch('drogulus.dht.node.constants.MAX_BATCH_PAYLOAD', limit):
+            deferreds = self.node.send_batch(contact, stores[:2] + [large] +
+                                             stores[2:])
+        self.assertEqual(4, len(deferreds))
+        sent = [call[0][1] for call in self.node.send_message.call_args_list]
+        self.assertEqual(large, sent[0])
+        self.assertEqual([2, 1], [len(batch.messages) for batch in sent[1:]])
+        self.assertNotIn(large.uuid, self.node._pending)
+        for store, d in zip(stores[:2], deferreds):
+            self.assertEqual(d, self.node._pending[store.uuid])
+        self.assertEqual(deferreds[3], self.node._pending[stores[2].uuid])
+
+    def test_send_batch_without_capability(self):
+        """
+        Ensure each message is sent on its own to peers that haven't
+        advertised the 'batch' capability.
+        """
+        self.node.send_message = MagicMock(return_value='deferred')
+        contact = Contact(self.node.id, '127.0.0.1', 54321, self.version)
+        stores = [self._batched_store() for i in range(2)]
+        result = self.node.send_batch(contact, stores)
+        self.assertEqual(['deferred', 'deferred'], result)
+        self.assertEqual([((contact, store), {}) for store in stores],
+                         self.node.send_message.call_args_list)
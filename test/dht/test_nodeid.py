@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures the NodeID class works as expected.
+"""
+from drogulus.dht.nodeid import NodeID, to_node_id, key_value
+from drogulus.utils import long_to_hex
+from mock import patch
+import hashlib
+import msgpack
+import pickle
+import unittest
+
+
+class TestNodeID(unittest.TestCase):
+    """
+    Ensures IDs hold both their string and numeric values.
+    """
+
+    def setUp(self):
+        self.raw = hashlib.sha512('node').digest()
+        self.value = long(self.raw.encode('hex'), 16)
+
+    def test_init(self):
+        """
+        The numeric value is worked out when the ID is created and the ID is
+        interchangeable with the string.
+        """
+        node_id = NodeID(self.raw)
+        self.assertEqual(self.value, node_id.value)
+        self.assertEqual(self.raw, node_id)
+        self.assertEqual(hash(self.raw), hash(node_id))
+        self.assertEqual({self.raw: 1}[node_id], 1)
+        self.assertEqual(self.raw, msgpack.unpackb(msgpack.packb(node_id)))
+
+    def test_init_with_value(self):
+        """
+        A value that is already known isn't worked out again.
+        """
+        with patch('drogulus.dht.nodeid.hex_to_long') as mock_convert:
+            node_id = NodeID(self.raw, self.value)
+        self.assertEqual(0, mock_convert.call_count)
+        self.assertEqual(self.value, node_id.value)
+
+    def test_empty(self):
+        """
+        An empty ID has the value zero.
+        """
+        self.assertEqual(0, NodeID('').value)
+
+    def test_from_long(self):
+        """
+        An ID created from a numeric value has the same string representation
+        as long_to_hex returns.
+        """
+        node_id = NodeID.from_long(12345L)
+        self.assertEqual(long_to_hex(12345L), node_id)
+        self.assertEqual(12345L, node_id.value)
+        self.assertRaises(TypeError, NodeID.from_long, -1)
+
+    def test_distance(self):
+        """
+        The distance is the XOR of the numeric values of both IDs (or keys).
+        """
+        node_id = NodeID('abc')
+        self.assertEqual(1645337L, node_id.distance(NodeID('xyz')))
+        self.assertEqual(1645337L, node_id.distance('xyz'))
+        self.assertEqual(0, node_id.distance(node_id))
+
+    def test_pickle(self):
+        """
+        IDs can be pickled (for example, in messages sent to worker
+        processes).
+        """
+        node_id = NodeID(self.raw)
+        unpickled = pickle.loads(pickle.dumps(node_id))
+        self.assertIsInstance(unpickled, NodeID)
+        self.assertEqual(node_id, unpickled)
+        self.assertEqual(self.value, unpickled.value)
+
+
+class TestConversions(unittest.TestCase):
+    """
+    Ensures keys are converted to NodeIDs and numeric values as expected.
+    """
+
+    def test_to_node_id(self):
+        """
+        Strings and numeric values are converted. NodeIDs are returned as
+        they are.
+        """
+        node_id = NodeID('abc')
+        self.assertTrue(to_node_id(node_id) is node_id)
+        self.assertIsInstance(to_node_id('abc'), NodeID)
+        self.assertEqual(node_id, to_node_id('abc'))
+        self.assertEqual(node_id, to_node_id(node_id.value))
+        self.assertEqual(node_id, to_node_id(int(node_id.value)))
+
+    def test_key_value(self):
+        """
+        The numeric value of a NodeID isn't worked out again.
+        """
+        node_id = NodeID('abc')
+        with patch('drogulus.dht.nodeid.hex_to_long') as mock_convert:
+            self.assertEqual(node_id.value, key_value(node_id))
+            self.assertEqual(123, key_value(123))
+        self.assertEqual(0, mock_convert.call_count)
+        self.assertEqual(node_id.value, key_value('abc'))
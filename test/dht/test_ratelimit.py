@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures the rate limiting of requests from other nodes works as expected.
+"""
+from drogulus.dht.ratelimit import TokenBucket, RateLimiter
+import unittest
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Ensures the TokenBucket class works as expected.
+    """
+
+    def test_init(self):
+        """
+        Ensures a new bucket is full.
+        """
+        bucket = TokenBucket(1, 10, 123.0)
+        self.assertEqual(1, bucket.rate)
+        self.assertEqual(10, bucket.capacity)
+        self.assertEqual(10, bucket.tokens)
+        self.assertEqual(123.0, bucket.last_updated)
+
+    def test_refill(self):
+        """
+        Ensures tokens accumulate at the expected rate.
+        """
+        bucket = TokenBucket(2, 10, 0.0)
+        bucket.tokens = 0
+        bucket.refill(1.5)
+        self.assertEqual(3, bucket.tokens)
+        self.assertEqual(1.5, bucket.last_updated)
+
+    def test_refill_capped(self):
+        """
+        Ensures the bucket never holds more than its capacity.
+        """
+        bucket = TokenBucket(2, 10, 0.0)
+        bucket.refill(100.0)
+        self.assertEqual(10, bucket.tokens)
+
+    def test_refill_clock_goes_backwards(self):
+        """
+        Ensures a clock that jumps backwards doesn't remove tokens.
+        """
+        bucket = TokenBucket(2, 10, 100.0)
+        bucket.refill(50.0)
+        self.assertEqual(10, bucket.tokens)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """
+    Ensures the RateLimiter class works as expected.
+    """
+
+    def setUp(self):
+        self.limiter = RateLimiter({'cheap': (10, 5), 'expensive': (1, 2)})
+
+    def test_allow_within_budget(self):
+        """
+        Requests are allowed until the burst size is used up.
+        """
+        for i in range(5):
+            self.assertTrue(self.limiter.allow('cheap', ('node', 'host'), 0))
+        self.assertFalse(self.limiter.allow('cheap', ('node', 'host'), 0))
+
+    def test_allow_after_refill(self):
+        """
+        Requests are allowed again once the budget has been replenished.
+        """
+        for i in range(2):
+            self.limiter.allow('expensive', ('node', 'host'), 0)
+        self.assertFalse(self.limiter.allow('expensive', ('node', 'host'), 0))
+        self.assertTrue(self.limiter.allow('expensive', ('node', 'host'), 1))
+
+    def test_budgets_are_separate(self):
+        """
+        Using up one budget doesn't affect another.
+        """
+        for i in range(2):
+            self.limiter.allow('expensive', ('node', 'host'), 0)
+        self.assertFalse(self.limiter.allow('expensive', ('node', 'host'), 0))
+        self.assertTrue(self.limiter.allow('cheap', ('node', 'host'), 0))
+
+    def test_peers_are_separate(self):
+        """
+        One noisy peer doesn't affect another.
+        """
+        for i in range(2):
+            self.limiter.allow('expensive', ('node', 'host'), 0)
+        self.assertFalse(self.limiter.allow('expensive', ('node', 'host'), 0))
+        self.assertTrue(self.limiter.allow('expensive', ('other', 'host2'),
+                                           0))
+
+    def test_all_keys_must_be_within_budget(self):
+        """
+        A peer can't avoid the limit by changing its node ID.
+        """
+        for i in range(2):
+            self.limiter.allow('expensive', ('node', 'host'), 0)
+        self.assertFalse(self.limiter.allow('expensive', ('new', 'host'), 0))
+
+    def test_allow_cost(self):
+        """
+        A request that carries several others costs a token for each of
+        them.
+        """
+        self.assertTrue(self.limiter.allow('cheap', ('node', 'host'), 0, 3))
+        self.assertFalse(self.limiter.allow('cheap', ('node', 'host'), 0, 3))
+        self.assertTrue(self.limiter.allow('cheap', ('node', 'host'), 0, 2))
+        self.assertFalse(self.limiter.allow('cheap', ('node', 'host'), 0))
+
+    def test_shed_request_consumes_nothing(self):
+        """
+        A request that is shed doesn't use up tokens from the other buckets.
+        """
+        for i in range(2):
+            self.limiter.allow('expensive', ('node', 'host'), 0)
+        self.limiter.allow('expensive', ('other', 'host'), 0)
+        self.assertTrue(self.limiter.allow('expensive', ('other', 'host2'),
+                                           0))
+
+    def test_max_size(self):
+        """
+        Only the buckets for the most recently seen keys are remembered.
+        """
+        limiter = RateLimiter({'cheap': (1, 1)}, max_size=2)
+        limiter.allow('cheap', ('a', ), 0)
+        limiter.allow('cheap', ('b', ), 0)
+        limiter.allow('cheap', ('a', ), 0)
+        limiter.allow('cheap', ('c', ), 0)
+        self.assertEqual(2, len(limiter))
+        self.assertIn(('cheap', 'a'), limiter._buckets)
+        self.assertIn(('cheap', 'c'), limiter._buckets)
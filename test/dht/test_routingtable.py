@@ -6,6 +6,9 @@ in the DHT) works as expected.
 from drogulus.dht.routingtable import RoutingTable
 from drogulus.dht.contact import Contact
 from drogulus.dht.kbucket import KBucket
+from drogulus.dht.nodeid import NodeID
+from mock import patch
+from drogulus.net.interning import NODE_IDS
 from drogulus import constants
 from drogulus.version import get_version
 import unittest
@@ -112,6 +115,30 @@ class TestRoutingTable(unittest.TestCase):
         actual = int(r._random_key_in_bucket_range(0).encode('hex'), 16)
         self.assertEqual(expected, actual)
 
+    def test_random_key_in_bucket_range_node_id(self):
+        """
+        Ensures the returned key is a NodeID.
+        """
+        r = RoutingTable('abc')
+        r._buckets[0] = KBucket(1, 2)
+        key = r._random_key_in_bucket_range(0)
+        self.assertIsInstance(key, NodeID)
+        self.assertEqual(1, key.value)
+
+    def test_kbucket_index_node_id(self):
+        """
+        Ensures the numeric value of a NodeID isn't worked out again when
+        finding its k-bucket or its distance from another ID.
+        """
+        r = RoutingTable('abc')
+        self.assertIsInstance(r._parent_node_id, NodeID)
+        key_one = NodeID('abc')
+        key_two = NodeID('xyz')
+        with patch('drogulus.dht.nodeid.hex_to_long') as mock_convert:
+            self.assertEqual(0, r._kbucket_index(key_one))
+            self.assertEqual(1645337L, r.distance(key_one, key_two))
+        self.assertEqual(0, mock_convert.call_count)
+
     def test_random_key_in_bucket_range_long(self):
         """
         Ensures that random_key_in_bucket_range works with large numbers.
@@ -454,6 +481,32 @@ class TestRoutingTable(unittest.TestCase):
         self.assertEqual(len(r._buckets[0]), 1)
         self.assertEqual(contact1, r._buckets[0]._contacts[0])
 
+    def test_add_contact_shares_id(self):
+        """
+        Ensures the ID of a contact added to a k-bucket is shared with
+        incoming messages.
+        """
+        r = RoutingTable('abc')
+        contact = Contact('shared', '192.168.0.1', 9999, self.version, 0)
+        self.addCleanup(NODE_IDS.discard, 'shared')
+        r.add_contact(contact)
+        self.assertTrue(NODE_IDS.get(''.join(['sha', 'red'])) is contact.id)
+
+    def test_remove_contact_discards_shared_id(self):
+        """
+        Ensures the ID of a removed contact is no longer shared and the ID of
+        its replacement is.
+        """
+        r = RoutingTable('abc')
+        contact1 = Contact('shared1', '192.168.0.1', 9999, self.version, 0)
+        contact2 = Contact('shared2', '192.168.0.2', 9999, self.version, 0)
+        self.addCleanup(NODE_IDS.discard, 'shared2')
+        r.add_contact(contact1)
+        r._replacement_cache[0] = [contact2, ]
+        r.remove_contact('shared1', forced=True)
+        self.assertNotIn('shared1', NODE_IDS)
+        self.assertIn('shared2', NODE_IDS)
+
     def test_remove_contact_with_unknown_contact(self):
         """
         Ensures that attempting to remove a non-existent contact results in a
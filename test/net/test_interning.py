@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures the tables of strings shared between decoded messages work correctly.
+"""
+from drogulus.net.interning import (InternTable, StringTable, SHARED_STRINGS,
+                                    NODE_IDS)
+from drogulus.constants import (MAX_SHARED_STRING_BYTES,
+                                MAX_SHARED_STRING_LENGTH, MAX_SHARED_NODE_IDS)
+import unittest
+
+
+def copy(string):
+    """
+    Returns a new string object equal to (but not the same object as) the
+    string.
+    """
+    return ''.join(list(string))
+
+
+class TestInternTable(unittest.TestCase):
+    """
+    Ensures the InternTable class works as expected.
+    """
+
+    def test_intern(self):
+        """
+        The first copy of a value to be interned is shared by later copies.
+        """
+        table = InternTable(10)
+        first = copy('0.1')
+        self.assertTrue(table.intern(first) is first)
+        second = copy('0.1')
+        self.assertTrue(table.intern(second) is first)
+        self.assertEqual(1, len(table))
+        self.assertIn('0.1', table)
+
+    def test_intern_full(self):
+        """
+        Once the table is full values are returned as they are while existing
+        values continue to be shared.
+        """
+        table = InternTable(1)
+        first = copy('foo')
+        table.intern(first)
+        other = copy('bar')
+        self.assertTrue(table.intern(other) is other)
+        self.assertNotIn('bar', table)
+        self.assertTrue(table.intern(copy('foo')) is first)
+
+    def test_get(self):
+        """
+        Getting a value never adds it to the table.
+        """
+        table = InternTable(10)
+        value = copy('foo')
+        self.assertTrue(table.get(value) is value)
+        self.assertEqual(0, len(table))
+        table.add(value)
+        self.assertTrue(table.get(copy('foo')) is value)
+
+    def test_add(self):
+        """
+        Adding a value that is already present keeps the existing copy and
+        values aren't added once the table is full.
+        """
+        table = InternTable(2)
+        first = copy('foo')
+        table.add(first)
+        table.add(copy('foo'))
+        self.assertTrue(table.get('foo') is first)
+        table.add('bar')
+        table.add('baz')
+        self.assertEqual(2, len(table))
+        self.assertNotIn('baz', table)
+
+    def test_discard(self):
+        """
+        Discarded values are no longer shared. Discarding a value that isn't
+        present does nothing.
+        """
+        table = InternTable(10)
+        table.add('foo')
+        table.discard('foo')
+        table.discard('bar')
+        self.assertEqual(0, len(table))
+
+
+class TestStringTable(unittest.TestCase):
+    """
+    Ensures the StringTable class works as expected.
+    """
+
+    def test_intern(self):
+        """
+        The first copy of a string to be interned is shared by later copies.
+        """
+        table = StringTable(100, 10)
+        first = copy('0.1')
+        self.assertTrue(table.intern(first) is first)
+        self.assertTrue(table.intern(copy('0.1')) is first)
+        self.assertTrue(table.get(copy('0.1')) is first)
+        self.assertEqual(1, len(table))
+        self.assertEqual(3, table.size)
+        self.assertIn('0.1', table)
+
+    def test_too_long(self):
+        """
+        Strings longer than max_length (and anything that isn't a string) are
+        never added to the table.
+        """
+        table = StringTable(100, 3)
+        value = copy('abcd')
+        self.assertTrue(table.intern(value) is value)
+        table.add('abcd')
+        table.intern(frozenset(['zlib']))
+        table.intern(123)
+        self.assertEqual(0, len(table))
+        self.assertTrue(table.get(value) is value)
+        table.discard(value)
+
+    def test_evicts_least_recently_used(self):
+        """
+        Once the strings in the table exceed max_bytes the least recently
+        used strings are forgotten to make room for new ones.
+        """
+        table = StringTable(6, 3)
+        foo = copy('foo')
+        table.intern(foo)
+        table.intern('bar')
+        # Using foo makes bar the least recently used.
+        self.assertTrue(table.intern(copy('foo')) is foo)
+        baz = copy('baz')
+        self.assertTrue(table.intern(baz) is baz)
+        self.assertNotIn('bar', table)
+        self.assertIn('foo', table)
+        self.assertTrue(table.intern(copy('baz')) is baz)
+        self.assertEqual(6, table.size)
+
+    def test_get(self):
+        """
+        Getting a string never adds it to the table.
+        """
+        table = StringTable(100, 10)
+        value = copy('foo')
+        self.assertTrue(table.get(value) is value)
+        self.assertEqual(0, len(table))
+
+    def test_discard(self):
+        """
+        Discarded strings are no longer shared and no longer count towards the
+        size of the table.
+        """
+        table = StringTable(100, 10)
+        table.add('foo')
+        table.add('foo')
+        table.discard('foo')
+        table.discard('bar')
+        self.assertEqual(0, len(table))
+        self.assertEqual(0, table.size)
+
+    def test_tables(self):
+        """
+        The module level tables are bounded by the expected constants.
+        """
+        self.assertEqual(MAX_SHARED_STRING_BYTES, SHARED_STRINGS.max_bytes)
+        self.assertEqual(MAX_SHARED_STRING_LENGTH, SHARED_STRINGS.max_length)
+        self.assertEqual(MAX_SHARED_NODE_IDS, NODE_IDS.max_size)
@@ -3,10 +3,21 @@
 A set of sanity checks to ensure that the messages are defined as expected.
 """
 from drogulus.net.messages import (Error, Ping, Pong, Store, FindNode, Nodes,
-                                   FindValue, Value, to_msgpack, from_msgpack,
-                                   make_message)
-from drogulus.constants import ERRORS
-from drogulus.crypto import construct_key, generate_signature
+                                   FindValue, Value, Batch, BatchReply,
+                                   to_msgpack, from_msgpack,
+                                   decode, from_unpacked, from_dict,
+                                   from_compact, unpack_lazily, pack_lazily,
+                                   share_strings, peek,
+                                   make_message, compiled, register_message,
+                                   COMPACT_VERSION, MESSAGE_NAMES,
+                                   MESSAGE_TAGS, MESSAGE_CLASSES,
+                                   CAPABILITY_MASK, capabilities_to_mask,
+                                   mask_to_capabilities)
+from drogulus.constants import (ERRORS, CAPABILITIES, MAX_MESSAGE_SIZE,
+                                MAX_SMALL_MESSAGE_SIZE)
+from drogulus.crypto import construct_key, generate_signature, LazyValue
+from drogulus.net.interning import SHARED_STRINGS, NODE_IDS
+from collections import namedtuple
 import unittest
 import msgpack
 import time
@@ -148,6 +159,26 @@ class TestMessages(unittest.TestCase):
         self.assertEqual('sig', val.sig)
         self.assertEqual('0.1', val.version)
 
+    def test_batch(self):
+        """
+        Expected behaviour of a batch message.
+        """
+        batch = Batch(self.uuid, self.node, ('foo', 'bar'), '0.1')
+        self.assertEqual(self.uuid, batch.uuid)
+        self.assertEqual(self.node, batch.node)
+        self.assertEqual(('foo', 'bar'), batch.messages)
+        self.assertEqual('0.1', batch.version)
+
+    def test_batch_reply(self):
+        """
+        Expected behaviour of a batch reply message.
+        """
+        reply = BatchReply(self.uuid, self.node, ('foo', 'bar'), '0.1')
+        self.assertEqual(self.uuid, reply.uuid)
+        self.assertEqual(self.node, reply.node)
+        self.assertEqual(('foo', 'bar'), reply.results)
+        self.assertEqual('0.1', reply.version)
+
 
 class TestMessagePackConversion(unittest.TestCase):
     """
@@ -193,6 +224,394 @@ class TestMessagePackConversion(unittest.TestCase):
             self.assertIn(k, unpacked.keys())
             self.assertEqual(unpacked[k], getattr(self, k))
 
+    def test_to_msgpack_advertises_capabilities(self):
+        """
+        Every message advertises the optional protocol features supported by
+        the local node.
+        """
+        result = to_msgpack(self.mock_message)
+        unpacked = msgpack.unpackb(result, use_list=False)
+        self.assertEqual(CAPABILITY_MASK, unpacked['caps'])
+
+    def test_decode(self):
+        """
+        Ensures decode returns both the message and the capabilities
+        advertised by the sender.
+        """
+        message, capabilities = decode(to_msgpack(self.mock_message))
+        self.assertEqual(self.mock_message, message)
+        self.assertEqual(frozenset(CAPABILITIES), capabilities)
+
+    def test_to_msgpack_with_packer(self):
+        """
+        A long lived msgpack Packer can be used to encode messages.
+        """
+        packer = msgpack.Packer()
+        for compact in (False, True):
+            expected = to_msgpack(self.mock_message, compact)
+            result = to_msgpack(self.mock_message, compact, packer)
+            self.assertEqual(expected, result)
+            # The packer can be reused.
+            result = to_msgpack(self.mock_message, compact, packer)
+            self.assertEqual(expected, result)
+
+    def test_from_unpacked(self):
+        """
+        Ensures messages that have already been unpacked are decoded.
+        """
+        for compact in (False, True):
+            raw = to_msgpack(self.mock_message, compact)
+            unpacked = msgpack.unpackb(raw, use_list=False)
+            message, capabilities = from_unpacked(unpacked)
+            self.assertEqual(self.mock_message, message)
+            self.assertEqual(frozenset(CAPABILITIES), capabilities)
+
+    def test_decode_no_capabilities(self):
+        """
+        Messages from peers that don't advertise any capabilities result in
+        an empty set.
+        """
+        mock_message = msgpack.packb({
+            'message': 'ping',
+            'uuid': self.uuid,
+            'node': self.node,
+            'version': self.version
+        })
+        message, capabilities = decode(mock_message)
+        self.assertIsInstance(message, Ping)
+        self.assertEqual(frozenset(), capabilities)
+
+    def test_capability_mask(self):
+        """
+        Capabilities are advertised as a bitmask in which bit i is set for the
+        ith capability. Unknown capabilities and bits are ignored and peers
+        advertising the same capabilities share the same frozenset.
+        """
+        self.assertEqual(2 ** len(CAPABILITIES) - 1, CAPABILITY_MASK)
+        self.assertEqual(0b101, capabilities_to_mask(['zlib', 'compact',
+                                                     'unknown']))
+        self.assertEqual(frozenset(['zlib', 'compact']),
+                         mask_to_capabilities(0b101))
+        self.assertEqual(frozenset(CAPABILITIES),
+                         mask_to_capabilities(CAPABILITY_MASK | 1 << 60))
+        self.assertTrue(mask_to_capabilities(0b101) is
+                        mask_to_capabilities(0b101))
+
+    def test_decode_capability_tuple(self):
+        """
+        The tuple of capabilities advertised by earlier versions is still
+        understood (unknown capabilities are ignored).
+        """
+        mock_message = msgpack.packb({
+            'message': 'ping',
+            'uuid': self.uuid,
+            'node': self.node,
+            'version': self.version,
+            'caps': ('zlib', 'unknown')
+        })
+        message, capabilities = decode(mock_message)
+        self.assertEqual(frozenset(['zlib']), capabilities)
+
+    def test_compact_ping_capabilities_size(self):
+        """
+        The advertisement of capabilities takes a single byte.
+        """
+        ping = Ping(self.uuid, self.node, self.version)
+        raw = to_msgpack(ping, compact=True)
+        self.assertEqual(len(msgpack.packb((COMPACT_VERSION, 1) +
+                                           tuple(ping))) + 1, len(raw))
+
+    def test_decode_malformed_capabilities(self):
+        """
+        A malformed capabilities field is ignored.
+        """
+        mock_message = msgpack.packb({
+            'message': 'ping',
+            'uuid': self.uuid,
+            'node': self.node,
+            'version': self.version,
+            'caps': ('zlib', 1)
+        })
+        message, capabilities = decode(mock_message)
+        self.assertIsInstance(message, Ping)
+        self.assertEqual(frozenset(), capabilities)
+        for caps in (-1, True, 'zlib'):
+            mock_message = msgpack.packb({
+                'message': 'ping',
+                'uuid': self.uuid,
+                'node': self.node,
+                'version': self.version,
+                'caps': caps
+            })
+            message, capabilities = decode(mock_message)
+            self.assertEqual(frozenset(), capabilities)
+
+    def test_from_dict(self):
+        """
+        Ensures a dictionary of raw fields is turned into the correct message.
+        """
+        result = from_dict({
+            'message': 'ping',
+            'uuid': self.uuid,
+            'node': self.node,
+            'version': self.version
+        })
+        self.assertEqual(Ping(self.uuid, self.node, self.version), result)
+
+    def test_to_msgpack_compact(self):
+        """
+        The compact encoding is an array of the encoding version, type tag,
+        capabilities and then the fields in order.
+        """
+        result = to_msgpack(self.mock_message, compact=True)
+        unpacked = msgpack.unpackb(result, use_list=False)
+        self.assertEqual(COMPACT_VERSION, unpacked[0])
+        self.assertEqual(MESSAGE_CLASSES[Value].tag, unpacked[1])
+        self.assertEqual(CAPABILITY_MASK, unpacked[2])
+        self.assertEqual(tuple(self.mock_message), unpacked[3:])
+        self.assertTrue(len(result) < len(to_msgpack(self.mock_message)))
+
+    def test_message_types_registered(self):
+        """
+        Every message class is registered with its own tag and name.
+        """
+        classes = [Error, Ping, Pong, Store, FindNode, Nodes, FindValue, Value,
+                   Batch, BatchReply]
+        for tag, klass in enumerate(classes):
+            message_type = MESSAGE_CLASSES[klass]
+            self.assertEqual(klass, message_type.klass)
+            self.assertEqual(tag, message_type.tag)
+            self.assertEqual(klass.__name__.lower(), message_type.name)
+            self.assertEqual(klass._fields, message_type.fields)
+            self.assertTrue(MESSAGE_TAGS[tag] is message_type)
+            self.assertTrue(MESSAGE_NAMES[message_type.name] is message_type)
+
+    def test_decode_compact(self):
+        """
+        Ensures every message class survives a round trip through the compact
+        encoding and the capabilities are returned.
+        """
+        messages = [
+            Error(self.uuid, self.node, 1, ERRORS[1], {'key': 'value'},
+                  self.version),
+            Ping(self.uuid, self.node, self.version),
+            Pong(self.uuid, self.node, self.version),
+            Store(*self.mock_message),
+            FindNode(self.uuid, self.node, self.key, self.version),
+            Nodes(self.uuid, self.node,
+                  ((self.node, '127.0.0.1', 1908, self.version), ),
+                  self.version),
+            FindValue(self.uuid, self.node, self.key, self.version),
+            self.mock_message,
+        ]
+        for mock_message in messages:
+            raw = to_msgpack(mock_message, compact=True)
+            message, capabilities = decode(raw)
+            self.assertEqual(mock_message.__class__, message.__class__)
+            self.assertEqual(mock_message, message)
+            self.assertEqual(frozenset(CAPABILITIES), capabilities)
+
+    def test_decode_lazy(self):
+        """
+        Ensures the values of Store and Value messages are left encoded when
+        decoding lazily (in both encodings) while every other field and
+        message is decoded as usual.
+        """
+        messages = [
+            Ping(self.uuid, self.node, self.version),
+            Store(*self.mock_message),
+            Nodes(self.uuid, self.node,
+                  ((self.node, '127.0.0.1', 1908, self.version), ),
+                  self.version),
+            self.mock_message,
+        ]
+        for mock_message in messages:
+            for compact in (False, True):
+                raw = to_msgpack(mock_message, compact=compact)
+                message, capabilities = decode(raw, lazy=True)
+                self.assertEqual(mock_message.__class__, message.__class__)
+                self.assertEqual(mock_message, message)
+                self.assertEqual(frozenset(CAPABILITIES), capabilities)
+                if 'value' in message._fields:
+                    self.assertIsInstance(message.value, LazyValue)
+                    self.assertEqual(msgpack.packb(mock_message.value),
+                                     str(message.value.encoded))
+
+    def test_unpack_lazily(self):
+        """
+        Anything that isn't a message is unpacked exactly as it would be by
+        msgpack.
+        """
+        for item in ['foo', 1, (1, 2, (3, 4)), {'foo': (1, 2)}, (),
+                     {'value': {'foo': 'bar'}}]:
+            raw = msgpack.packb(item)
+            unpacked = unpack_lazily(raw)
+            self.assertEqual(msgpack.unpackb(raw, use_list=False), unpacked)
+
+    def test_unpack_lazily_extra_data(self):
+        """
+        Data after the end of the message is rejected as it would be by
+        msgpack.
+        """
+        raw = to_msgpack(self.mock_message) + 'extra'
+        self.assertRaises(msgpack.ExtraData, unpack_lazily, raw)
+
+    def test_to_msgpack_lazy(self):
+        """
+        A message with a LazyValue is encoded without unpacking the value and
+        the result is identical to encoding the original message.
+        """
+        for compact in (False, True):
+            raw = to_msgpack(self.mock_message, compact=compact)
+            message, capabilities = decode(raw, lazy=True)
+            message.value._digest = 'unused'
+            self.assertEqual(raw, to_msgpack(message, compact=compact))
+            self.assertEqual(raw, to_msgpack(message, compact=compact,
+                                             packer=msgpack.Packer()))
+
+    def test_pack_lazily(self):
+        """
+        The existing encoding of a LazyValue is copied into the result.
+        """
+        lazy = LazyValue(buffer('xx' + msgpack.packb('foo'), 2))
+        self.assertEqual(msgpack.packb((1, 'foo')), pack_lazily((1, lazy)))
+        self.assertEqual({'value': 'foo'},
+                         msgpack.unpackb(pack_lazily({'value': lazy})))
+
+    def test_share_strings(self):
+        """
+        Ensures the sender's ID (if it's in the routing table), the version
+        and the keys of the metadata of a message are replaced by their
+        shared copies.
+        """
+        node = self.mock_message.node
+        NODE_IDS.add(node)
+        self.addCleanup(NODE_IDS.discard, node)
+        version = SHARED_STRINGS.intern(self.version)
+        key = SHARED_STRINGS.intern('mime')
+        message = from_msgpack(to_msgpack(
+            self.mock_message._replace(meta={'mime': 'text/plain'})))
+        result = share_strings(message)
+        self.assertEqual(message, result)
+        self.assertEqual(Value, result.__class__)
+        self.assertTrue(result.node is node)
+        self.assertTrue(result.version is version)
+        self.assertTrue(result.meta.keys()[0] is key)
+
+    def test_share_strings_unknown_node(self):
+        """
+        Ensures IDs of nodes that aren't in the routing table aren't shared.
+        """
+        ping = from_msgpack(to_msgpack(Ping(self.uuid, 'unknown',
+                                            self.version)))
+        result = share_strings(ping)
+        self.assertEqual(ping, result)
+        self.assertNotIn('unknown', NODE_IDS)
+
+    def test_from_compact_wrong_version(self):
+        """
+        Ensures an unknown version of the compact encoding is rejected.
+        """
+        data = (COMPACT_VERSION + 1, MESSAGE_CLASSES[Ping].tag, (), self.uuid,
+                self.node, self.version)
+        with self.assertRaises(ValueError) as cm:
+            from_compact(data)
+        ex = cm.exception
+        self.assertEqual(5, ex.args[0])
+        self.assertEqual(ERRORS[5], ex.args[1])
+
+    def test_peek(self):
+        """
+        The version and tag of a compactly encoded message are read without
+        unpacking it.
+        """
+        ping = Ping(self.uuid, self.node, self.version)
+        self.assertEqual((COMPACT_VERSION, MESSAGE_CLASSES[Ping].tag),
+                         peek(to_msgpack(ping, True)))
+
+    def test_peek_long_array(self):
+        """
+        The version and tag follow the longer headers of arrays with more
+        than 15 items.
+        """
+        for items in (16, 0x10000):
+            raw = msgpack.packb((COMPACT_VERSION, 3) + (0, ) * (items - 2))
+            self.assertEqual((COMPACT_VERSION, 3), peek(raw))
+
+    def test_peek_not_compact(self):
+        """
+        Anything other than an array with at least two items isn't a
+        compactly encoded message.
+        """
+        ping = Ping(self.uuid, self.node, self.version)
+        self.assertEqual(None, peek(to_msgpack(ping)))
+        self.assertEqual(None, peek(msgpack.packb((COMPACT_VERSION, ))))
+        self.assertEqual(None, peek('garbage'))
+        self.assertEqual(None, peek(''))
+
+    def test_peek_not_fixint(self):
+        """
+        A tag that isn't a positive fixint is returned as None. If the
+        version isn't, neither item can be read.
+        """
+        raw = msgpack.packb((COMPACT_VERSION, 300, ()))
+        self.assertEqual((COMPACT_VERSION, None), peek(raw))
+        raw = msgpack.packb(('1', 1, ()))
+        self.assertEqual((None, None), peek(raw))
+
+    def test_from_compact_too_short(self):
+        """
+        Ensures a compact message without a header is rejected.
+        """
+        with self.assertRaises(ValueError) as cm:
+            from_compact((COMPACT_VERSION, ))
+        ex = cm.exception
+        self.assertEqual(2, ex.args[0])
+
+    def test_from_compact_unknown_tag(self):
+        """
+        Ensures an unknown type tag results in an error.
+        """
+        data = (COMPACT_VERSION, 99, (), self.uuid, self.node, self.version)
+        with self.assertRaises(ValueError) as cm:
+            from_compact(data)
+        ex = cm.exception
+        self.assertEqual(2, ex.args[0])
+        self.assertEqual({'context': '99 is not a valid message type.'},
+                         ex.args[2])
+
+    def test_from_compact_missing_fields(self):
+        """
+        Ensures missing fields are reported in the same way as for the
+        original encoding.
+        """
+        data = (COMPACT_VERSION, MESSAGE_CLASSES[Ping].tag, (), self.uuid)
+        with self.assertRaises(ValueError) as cm:
+            from_compact(data)
+        ex = cm.exception
+        self.assertEqual(2, ex.args[0])
+        self.assertEqual({'node': 'Missing field.',
+                          'version': 'Missing field.'}, ex.args[2])
+
+    def test_from_compact_invalid_field(self):
+        """
+        Ensures fields are validated.
+        """
+        data = (COMPACT_VERSION, MESSAGE_CLASSES[Ping].tag, (), self.uuid, 123,
+                self.version)
+        with self.assertRaises(ValueError) as cm:
+            from_compact(data)
+        ex = cm.exception
+        self.assertEqual({'node': 'Invalid value.'}, ex.args[2])
+
+    def test_from_dict_unhashable_type(self):
+        """
+        An unhashable message type results in an error 2 (Unknown request).
+        """
+        with self.assertRaises(ValueError) as cm:
+            from_dict({'message': {}})
+        self.assertEqual(2, cm.exception.args[0])
+
     def test_from_msgpack_error(self):
         """
         Ensures a valid error message is correctly parsed.
@@ -419,3 +838,118 @@ class TestMakeMessage(unittest.TestCase):
         self.assertEqual('Missing field.', details['uuid'])
         self.assertEqual('Missing field.', details['node'])
         self.assertEqual('Missing field.', details['version'])
+
+    def test_make_message_mixed_errors(self):
+        """
+        Missing and invalid fields are reported together.
+        """
+        with self.assertRaises(ValueError) as cm:
+            make_message(Ping, {'uuid': 1, 'version': '0.1'})
+        details = cm.exception.args[2]
+        self.assertEqual({'uuid': 'Invalid value.', 'node': 'Missing field.'},
+                         details)
+
+    def test_make_message_extra_fields(self):
+        """
+        Fields that are not part of the message class are ignored.
+        """
+        result = make_message(Ping, {'uuid': 'uuid', 'node': 'node',
+                                     'version': '0.1', 'message': 'ping'})
+        self.assertEqual(Ping('uuid', 'node', '0.1'), result)
+
+    def test_compiled(self):
+        """
+        The fields, getter and validator for a class are worked out once.
+        """
+        fields, getter, validator = compiled(Ping)
+        self.assertEqual(Ping._fields, fields)
+        self.assertEqual(('a', 'b', 'c'), getter({'uuid': 'a', 'node': 'b',
+                                                  'version': 'c'}))
+        self.assertTrue(validator('a', 'b', 'c'))
+        self.assertFalse(validator('a', 1, 'c'))
+        self.assertTrue(compiled(Ping) is compiled(Ping))
+
+
+class Probe(namedtuple('Probe', ['uuid', 'node', 'key', 'version'])):
+    """
+    A message type used to test the registration of new types of message.
+    """
+    pass
+
+
+class TestRegisterMessage(unittest.TestCase):
+    """
+    Ensures new types of message can be registered.
+    """
+
+    def tearDown(self):
+        for registry, key in ((MESSAGE_NAMES, 'probe'), (MESSAGE_TAGS, 100),
+                              (MESSAGE_CLASSES, Probe)):
+            registry.pop(key, None)
+
+    def test_register_message(self):
+        """
+        A registered type of message can be encoded and decoded using both
+        encodings.
+        """
+        message_type = register_message(Probe, 100)
+        self.assertEqual('probe', message_type.name)
+        self.assertEqual(100, message_type.tag)
+        self.assertTrue(MESSAGE_NAMES['probe'] is message_type)
+        self.assertTrue(MESSAGE_TAGS[100] is message_type)
+        self.assertTrue(MESSAGE_CLASSES[Probe] is message_type)
+        probe = Probe(str(uuid4()), 'node', 'key', '0.1')
+        for compact in (False, True):
+            message, capabilities = decode(to_msgpack(probe, compact))
+            self.assertIsInstance(message, Probe)
+            self.assertEqual(probe, message)
+
+    def test_register_message_with_name(self):
+        """
+        The name used in the original encoding can be given.
+        """
+        message_type = register_message(Probe, 100, 'probe')
+        self.assertEqual('probe', message_type.name)
+
+    def test_register_message_max_size(self):
+        """
+        The maximum size of a message of the new type defaults to the maximum
+        size of any message but can be given.
+        """
+        message_type = register_message(Probe, 100)
+        self.assertEqual(MAX_MESSAGE_SIZE, message_type.max_size)
+        message_type = register_message(Probe, 100, max_size=1024)
+        self.assertEqual(1024, message_type.max_size)
+
+    def test_max_sizes(self):
+        """
+        Only the types of message that carry values may be larger than
+        MAX_SMALL_MESSAGE_SIZE.
+        """
+        for klass in (Store, Value, Batch, BatchReply):
+            self.assertEqual(MAX_MESSAGE_SIZE, MESSAGE_CLASSES[klass].max_size)
+        for klass in (Error, Ping, Pong, FindNode, Nodes, FindValue):
+            self.assertEqual(MAX_SMALL_MESSAGE_SIZE,
+                             MESSAGE_CLASSES[klass].max_size)
+
+    def test_register_message_again(self):
+        """
+        Registering the same class again is harmless.
+        """
+        register_message(Probe, 100)
+        register_message(Probe, 100)
+        self.assertEqual(100, MESSAGE_CLASSES[Probe].tag)
+
+    def test_register_message_tag_in_use(self):
+        """
+        Tags already used by another type of message cannot be reused.
+        """
+        self.assertRaises(ValueError, register_message, Probe, 1)
+        self.assertFalse(Probe in MESSAGE_CLASSES)
+
+    def test_register_message_name_in_use(self):
+        """
+        Names already used by another type of message cannot be reused.
+        """
+        self.assertRaises(ValueError, register_message, Probe, 100, 'ping')
+        self.assertFalse(Probe in MESSAGE_CLASSES)
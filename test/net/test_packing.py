@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures the details of nodes are packed and unpacked correctly.
+"""
+from drogulus.net.packing import (pack_address, unpack_address, pack_nodes,
+                                  unpack_nodes, unpack_records, ID_LENGTH,
+                                  RECORD_LENGTH, IPV4_MAPPED)
+import unittest
+import struct
+
+
+class TestPacking(unittest.TestCase):
+    """
+    Ensures the packing functions work as expected.
+    """
+
+    def setUp(self):
+        self.nodes = (('a' * ID_LENGTH, '192.168.0.1', 1908, '0.1'),
+                      ('b' * ID_LENGTH, '2001:db8::1', 49151, '0.2'),
+                      ('c' * ID_LENGTH, '10.0.0.1', 0, '0.1'))
+
+    def test_pack_address(self):
+        """
+        Addresses are packed into 16 bytes with IPv4 addresses mapped into the
+        IPv6 address space.
+        """
+        self.assertEqual(IPV4_MAPPED + '\x7f\x00\x00\x01',
+                         pack_address('127.0.0.1'))
+        self.assertEqual('\x00' * 15 + '\x01', pack_address('::1'))
+
+    def test_unpack_address(self):
+        """
+        Packed addresses are returned to their original form.
+        """
+        for address in ('127.0.0.1', '::1', '2001:db8::1'):
+            self.assertEqual(address, unpack_address(pack_address(address)))
+
+    def test_pack_address_hostname(self):
+        """
+        Hostnames cannot be packed.
+        """
+        self.assertRaises(ValueError, pack_address, 'localhost')
+
+    def test_round_trip(self):
+        """
+        Unpacking packed nodes results in the original nodes.
+        """
+        self.assertEqual(self.nodes, unpack_nodes(pack_nodes(self.nodes)))
+
+    def test_no_nodes(self):
+        """
+        An empty list of nodes can be packed.
+        """
+        self.assertEqual('\x00', pack_nodes([]))
+        self.assertEqual((), unpack_nodes('\x00'))
+
+    def test_size(self):
+        """
+        Each node is a fixed size record after the version table.
+        """
+        packed = pack_nodes(self.nodes)
+        table = 1 + 2 * (1 + 3)
+        self.assertEqual(ID_LENGTH + 1 + 16 + 2, RECORD_LENGTH)
+        self.assertEqual(table + 3 * RECORD_LENGTH, len(packed))
+
+    def test_versions_interned(self):
+        """
+        Nodes with the same version share the same version string.
+        """
+        result = unpack_nodes(pack_nodes(self.nodes))
+        self.assertTrue(result[0][3] is result[2][3])
+
+    def test_unpack_records(self):
+        """
+        The version table and the raw values of each record are returned.
+        """
+        versions, values = unpack_records(pack_nodes(self.nodes))
+        self.assertEqual(['0.1', '0.2'], versions)
+        self.assertEqual(('a' * ID_LENGTH, 0, pack_address('192.168.0.1'),
+                          1908), values[:4])
+        self.assertEqual(12, len(values))
+
+    def test_pack_bad_id(self):
+        """
+        IDs must be exactly ID_LENGTH bytes.
+        """
+        nodes = (('short', '192.168.0.1', 1908, '0.1'),)
+        self.assertRaises(ValueError, pack_nodes, nodes)
+
+    def test_pack_bad_port(self):
+        """
+        Ports must be in the valid range.
+        """
+        nodes = (('a' * ID_LENGTH, '192.168.0.1', 65535, '0.1'),)
+        self.assertRaises(ValueError, pack_nodes, nodes)
+
+    def test_pack_hostname(self):
+        """
+        Nodes whose addresses are hostnames cannot be packed.
+        """
+        nodes = (('a' * ID_LENGTH, 'localhost', 1908, '0.1'),)
+        self.assertRaises(ValueError, pack_nodes, nodes)
+
+    def test_pack_bad_version(self):
+        """
+        Versions must be strings.
+        """
+        nodes = (('a' * ID_LENGTH, '192.168.0.1', 1908, 1),)
+        self.assertRaises(ValueError, pack_nodes, nodes)
+
+    def test_unpack_empty(self):
+        """
+        An empty string is malformed.
+        """
+        self.assertRaises(ValueError, unpack_nodes, '')
+
+    def test_unpack_truncated(self):
+        """
+        A truncated string is malformed.
+        """
+        packed = pack_nodes(self.nodes)
+        for i in (1, 3, 5, 20):
+            self.assertRaises(ValueError, unpack_nodes, packed[:-i])
+
+    def test_unpack_truncated_version_table(self):
+        """
+        A truncated version table is malformed.
+        """
+        self.assertRaises(ValueError, unpack_nodes, '\x02\x030.1\x03')
+
+    def test_unpack_bad_version_index(self):
+        """
+        A record referencing a version not in the table is malformed.
+        """
+        raw = ('\x01\x030.1' + 'a' * ID_LENGTH + '\x01' +
+               pack_address('127.0.0.1') + struct.pack('>H', 1908))
+        self.assertRaises(ValueError, unpack_nodes, raw)
+
+    def test_unpack_trailing_bytes(self):
+        """
+        Anything other than whole records after the version table is
+        malformed.
+        """
+        packed = pack_nodes(self.nodes)
+        self.assertRaises(ValueError, unpack_nodes, packed + '\x00')
+
+    def test_unpack_bad_port(self):
+        """
+        Ports must be in the valid range.
+        """
+        raw = ('\x01\x030.1' + 'a' * ID_LENGTH + '\x00' +
+               pack_address('127.0.0.1') + struct.pack('>H', 65535))
+        self.assertRaises(ValueError, unpack_nodes, raw)
@@ -3,16 +3,30 @@
 Ensures the low level networking functions of the DHT behave as expected.
 """
 from drogulus.version import get_version
-from drogulus.constants import ERRORS
-from drogulus.net.protocol import DHTFactory
-from drogulus.net.messages import Pong, to_msgpack, from_msgpack
+from drogulus.constants import (ERRORS, CAPABILITIES, COMPRESSION_THRESHOLD,
+                                CHUNK_SIZE, MAX_CONNECTION_QUEUE,
+                                MAX_SMALL_MESSAGE_SIZE)
+from drogulus.net.protocol import (DHTFactory, COMPRESSED_FRAME,
+                                   CHUNKED_FRAME, CHUNK_FRAME, ChunkedMessage,
+                                   BackpressureStats)
+from drogulus.crypto import PrehashedValue, LazyValue, construct_hash
+from drogulus.net.messages import (Ping, Pong, Store, to_msgpack,
+                                   from_msgpack, COMPACT_VERSION)
 from drogulus.dht.node import Node
 from twisted.trial import unittest
-from twisted.test import proto_helpers
-from mock import MagicMock
+from twisted.test import proto_helpers, iosim
+from twisted.internet import protocol
+from twisted.internet.ssl import CertificateOptions
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from OpenSSL import crypto
+from mock import MagicMock, patch
 from uuid import uuid4
 import hashlib
+import os
 import time
+import msgpack
+import struct
+import zlib
 import re
 
 
@@ -51,6 +65,18 @@ class TestDHTProtocol(unittest.TestCase):
         # remove trailing comma
         return content[:-1]
 
+    def _from_netstrings(self, raw):
+        """
+        Returns a list of the contents of the netstrings in the raw string.
+        """
+        result = []
+        while raw:
+            length, raw = raw.split(':', 1)
+            length = int(length)
+            result.append(raw[:length])
+            raw = raw[length + 1:]
+        return result
+
     def test_except_to_error_with_exception_args(self):
         """
         Ensure an exception created by drogulus (that includes meta-data in
@@ -103,8 +129,8 @@ class TestDHTProtocol(unittest.TestCase):
         """
         # Mock
         self.transport.loseConnection = MagicMock()
-        # Send bad message
-        self.protocol.dataReceived('1:a,')
+        # Send a bad message (an empty map)
+        self.protocol.dataReceived('1:\x80,')
         # Check we receive the expected error in return
         raw_response = self.transport.value()
         msgpack_response = self._from_netstring(raw_response)
@@ -190,3 +216,817 @@ class TestDHTProtocol(unittest.TestCase):
         self.assertEqual(expected, actual)
         # Ensure the loseConnection method was also called.
         self.transport.loseConnection.assert_called_once_with()
+        # The protocol is no longer the transport's producer.
+        self.assertEqual(None, self.transport.producer)
+
+    def _large_store(self):
+        """
+        Returns a Store message whose msgpack encoding is well above the
+        compression threshold.
+        """
+        value = 'A highly compressible value. ' * COMPRESSION_THRESHOLD
+        return Store(str(uuid4()), self.node_id, 'key', value, time.time(),
+                     0.0, 'public_key', 'name', {'mime': 'text/plain'},
+                     'sig', get_version())
+
+    def test_send_message_compressed(self):
+        """
+        Large messages are compressed if the peer has advertised the 'zlib'
+        capability.
+        """
+        self.protocol.peer_capabilities = frozenset(['zlib'])
+        msg = self._large_store()
+        self.protocol.sendMessage(msg)
+        payload = self._from_netstring(self.transport.value())
+        self.assertEqual(COMPRESSED_FRAME, payload[0])
+        self.assertTrue(len(payload) < len(to_msgpack(msg)))
+        self.assertEqual(msg, from_msgpack(zlib.decompress(payload[1:])))
+
+    def test_send_message_not_compressed_without_capability(self):
+        """
+        Large messages are sent as-is to peers that have not advertised the
+        'zlib' capability.
+        """
+        msg = self._large_store()
+        self.protocol.sendMessage(msg)
+        expected = self._to_netstring(to_msgpack(msg))
+        self.assertEqual(expected, self.transport.value())
+
+    def test_send_message_small_not_compressed(self):
+        """
+        Messages below the compression threshold are never compressed.
+        """
+        self.protocol.peer_capabilities = frozenset(['zlib'])
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(msg)
+        expected = self._to_netstring(to_msgpack(msg))
+        self.assertEqual(expected, self.transport.value())
+
+    def test_send_message_compact(self):
+        """
+        Messages are sent using the compact encoding if the peer has
+        advertised the 'compact' capability.
+        """
+        self.protocol.peer_capabilities = frozenset(['compact'])
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(msg)
+        expected = self._to_netstring(to_msgpack(msg, compact=True))
+        self.assertEqual(expected, self.transport.value())
+
+    def test_string_received_compact(self):
+        """
+        Compactly encoded messages are understood whether or not the
+        'compact' capability has been advertised to the peer.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.stringReceived(to_msgpack(msg, compact=True))
+        self.node.message_received.assert_called_once_with(msg, self.protocol)
+        self.assertIn('compact', self.protocol.peer_capabilities)
+
+    def test_string_received_compressed(self):
+        """
+        Compressed payloads are transparently decompressed before being passed
+        on to the local node.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._large_store()
+        raw = COMPRESSED_FRAME + zlib.compress(to_msgpack(msg))
+        self.protocol.stringReceived(raw)
+        self.node.message_received.assert_called_once_with(msg, self.protocol)
+
+    def _check_rejected(self, raw, code, stream=False):
+        """
+        Ensures the payload (or, if stream is set, the msgpack stream framed
+        data) is rejected with the given error code without being decoded.
+        """
+        self.node.message_received = MagicMock()
+        patcher = patch('drogulus.net.protocol.decode')
+        mock_decode = patcher.start()
+        self.addCleanup(patcher.stop)
+        if stream:
+            self.protocol.dataReceived(raw)
+        else:
+            self.protocol.stringReceived(raw)
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(code, err.code)
+        self.assertEqual(ERRORS[code], err.title)
+        self.assertEqual(0, mock_decode.call_count)
+        self.assertEqual(0, self.node.message_received.call_count)
+
+    def test_string_received_garbage(self):
+        """
+        A payload that isn't a msgpack encoded map or array results in an
+        error 1 (Bad request) before it is decoded.
+        """
+        self._check_rejected('garbage', 1)
+
+    def test_string_received_unknown_tag(self):
+        """
+        A compactly encoded message of an unknown type results in an error 2
+        (Unknown request) before it is decoded.
+        """
+        self._check_rejected(msgpack.packb((COMPACT_VERSION, 99, ())), 2)
+
+    def test_string_received_unsupported_version(self):
+        """
+        A compactly encoded message of an unknown version results in an error
+        5 (Unsupported protocol) before it is decoded.
+        """
+        msg = Ping(str(uuid4()), self.node_id, get_version())
+        raw = to_msgpack(msg, True)
+        raw = raw[:1] + chr(COMPACT_VERSION + 1) + raw[2:]
+        self._check_rejected(raw, 5)
+
+    def test_string_received_too_big_for_type(self):
+        """
+        A compactly encoded message that is larger than the maximum size for
+        its type results in an error 4 (Request too big) before it is
+        decoded.
+        """
+        msg = Ping(str(uuid4()), self.node_id, 'x' * MAX_SMALL_MESSAGE_SIZE)
+        self._check_rejected(to_msgpack(msg, True), 4)
+
+    def test_string_received_large_value(self):
+        """
+        Types of message that carry values may be larger than
+        MAX_SMALL_MESSAGE_SIZE.
+        """
+        self.node.message_received = MagicMock()
+        msg = Store(str(uuid4()), self.node_id, 'key',
+                    'x' * MAX_SMALL_MESSAGE_SIZE, time.time(), 0.0, 'key',
+                    'name', {}, 'sig', get_version())
+        raw = to_msgpack(msg, True)
+        self.assertEqual(raw, self.protocol.check_payload(raw))
+
+    def test_string_received_original_encoding_too_big(self):
+        """
+        A message in the original encoding that is larger than MAX_LENGTH
+        results in an error 4 (Request too big) before it is decoded.
+        """
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        raw = to_msgpack(msg)
+        self.protocol.MAX_LENGTH = len(raw) - 1
+        self._check_rejected(raw, 4)
+
+    def test_check_payload_original_encoding(self):
+        """
+        Only the header and size of a message in the original encoding are
+        checked.
+        """
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        raw = to_msgpack(msg)
+        self.assertEqual(raw, self.protocol.check_payload(raw))
+
+    def test_string_received_records_capabilities(self):
+        """
+        The capabilities advertised by the peer are recorded by the protocol.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.stringReceived(to_msgpack(msg))
+        self.assertEqual(frozenset(CAPABILITIES),
+                         self.protocol.peer_capabilities)
+
+    def test_string_received_compressed_too_big(self):
+        """
+        A compressed payload that would expand beyond MAX_LENGTH results in
+        an error 4 (Request too big).
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        value = 'x' * (self.protocol.MAX_LENGTH + 1)
+        raw = COMPRESSED_FRAME + zlib.compress(value)
+        self.protocol.stringReceived(raw)
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(4, err.code)
+        self.assertEqual(ERRORS[4], err.title)
+        self.assertEqual(0, self.node.message_received.call_count)
+
+    def test_string_received_compressed_corrupt(self):
+        """
+        A compressed payload that cannot be decompressed results in an error 1
+        (Bad request).
+        """
+        self.protocol.stringReceived(COMPRESSED_FRAME + 'not zlib')
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(1, err.code)
+        self.assertEqual(ERRORS[1], err.title)
+
+    def _chunked_store(self):
+        """
+        Returns a Store message whose value is large enough to be chunked.
+        """
+        value = os.urandom(CHUNK_SIZE * 2 + 10)
+        return Store(str(uuid4()), self.node_id, 'key', value, time.time(),
+                     0.0, 'public_key', 'name', {'mime': 'text/plain'},
+                     'sig', get_version())
+
+    def test_send_message_chunked(self):
+        """
+        Large string values are sent as a header followed by chunks if the
+        peer has advertised the 'chunked' capability.
+        """
+        self.protocol.peer_capabilities = frozenset(['chunked'])
+        msg = self._chunked_store()
+        self.protocol.sendMessage(msg)
+        frames = self._from_netstrings(self.transport.value())
+        self.assertEqual(4, len(frames))
+        header = frames[0]
+        self.assertEqual(CHUNKED_FRAME, header[0])
+        self.assertEqual(len(msg.value), struct.unpack('>I', header[1:5])[0])
+        self.assertEqual(msg._replace(value=''), from_msgpack(header[5:]))
+        for frame in frames[1:]:
+            self.assertEqual(CHUNK_FRAME, frame[0])
+            self.assertTrue(len(frame) <= CHUNK_SIZE + 1)
+        self.assertEqual(msg.value, ''.join([f[1:] for f in frames[1:]]))
+
+    def test_send_message_not_chunked_without_capability(self):
+        """
+        Large values are sent in a single message to peers that have not
+        advertised the 'chunked' capability.
+        """
+        msg = self._chunked_store()
+        self.protocol.sendMessage(msg)
+        expected = self._to_netstring(to_msgpack(msg))
+        self.assertEqual(expected, self.transport.value())
+
+    def test_string_received_chunked(self):
+        """
+        A chunked message is reassembled and passed on to the local node once
+        the final chunk arrives. The value carries its incrementally computed
+        hash.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._chunked_store()
+        self.protocol.peer_capabilities = frozenset(['chunked'])
+        self.protocol.sendMessage(msg)
+        raw = self.transport.value()
+        self.transport.clear()
+        # Feed the data in small pieces.
+        for i in xrange(0, len(raw), 1000):
+            self.protocol.dataReceived(raw[i:i + 1000])
+        self.assertEqual(1, self.node.message_received.call_count)
+        result = self.node.message_received.call_args[0][0]
+        self.assertEqual(msg, result)
+        self.assertIsInstance(result.value, PrehashedValue)
+        expected = construct_hash(msg.value, msg.timestamp, msg.expires,
+                                  msg.name, msg.meta)
+        actual = construct_hash(result.value, msg.timestamp, msg.expires,
+                                msg.name, msg.meta)
+        self.assertEqual(expected.digest(), actual.digest())
+        self.assertEqual(None, self.protocol.chunked_message)
+        self.assertEqual('', self.transport.value())
+
+    def test_string_received_chunked_header_too_big(self):
+        """
+        A header announcing a value bigger than MAX_VALUE_SIZE results in an
+        error 4 (Request too big).
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME +
+                  struct.pack('>I', self.protocol.MAX_VALUE_SIZE + 1) +
+                  to_msgpack(msg._replace(value='')))
+        self.protocol.stringReceived(header)
+        # The peer advertised the 'stream' capability in the header so the
+        # error uses msgpack stream framing.
+        err = from_msgpack(self.transport.value())
+        self.assertEqual(4, err.code)
+        self.assertEqual(msg.uuid, err.uuid)
+        self.assertEqual(None, self.protocol.chunked_message)
+
+    def test_string_received_chunked_value_size_configurable(self):
+        """
+        The limit on the size of values reassembled from chunks is separate
+        from (and larger than) the limit on the size of each netstring and can
+        be changed for each protocol.
+        """
+        self.assertTrue(self.protocol.MAX_VALUE_SIZE >
+                        self.protocol.MAX_LENGTH)
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME + struct.pack('>I', len(msg.value)) +
+                  to_msgpack(msg._replace(value='')))
+        self.protocol.stringReceived(header)
+        self.assertNotEqual(None, self.protocol.chunked_message)
+        self.protocol.chunked_message = None
+        self.protocol.MAX_VALUE_SIZE = len(msg.value) - 1
+        self.protocol.stringReceived(header)
+        self.assertEqual(None, self.protocol.chunked_message)
+        self.assertEqual(4, from_msgpack(self.transport.value()).code)
+
+    def test_string_received_chunked_header_with_value(self):
+        """
+        The header of a chunked message must have an empty value.
+        """
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME + struct.pack('>I', 100) +
+                  to_msgpack(msg._replace(value='foo')))
+        self.protocol.stringReceived(header)
+        # The peer advertised the 'stream' capability in the header so the
+        # error uses msgpack stream framing.
+        err = from_msgpack(self.transport.value())
+        self.assertEqual(1, err.code)
+        self.assertEqual(None, self.protocol.chunked_message)
+
+    def test_string_received_chunked_unexpected_frame(self):
+        """
+        Anything other than a chunk while a chunked message is being received
+        results in an error 1 (Bad request).
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME + struct.pack('>I', 100) +
+                  to_msgpack(msg._replace(value='')))
+        self.protocol.stringReceived(header)
+        self.assertIsInstance(self.protocol.chunked_message, ChunkedMessage)
+        pong = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.stringReceived(to_msgpack(pong))
+        # The peer advertised the 'stream' capability in the header so the
+        # error uses msgpack stream framing.
+        err = from_msgpack(self.transport.value())
+        self.assertEqual(1, err.code)
+        self.assertEqual(msg.uuid, err.uuid)
+        self.assertEqual(None, self.protocol.chunked_message)
+        self.assertEqual(0, self.node.message_received.call_count)
+
+    def test_string_received_chunked_too_much_data(self):
+        """
+        Receiving more data than announced in the header results in an error
+        1 (Bad request).
+        """
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME + struct.pack('>I', 10) +
+                  to_msgpack(msg._replace(value='')))
+        self.protocol.stringReceived(header)
+        self.protocol.stringReceived(CHUNK_FRAME + 'x' * 11)
+        # The peer advertised the 'stream' capability in the header so the
+        # error uses msgpack stream framing.
+        err = from_msgpack(self.transport.value())
+        self.assertEqual(1, err.code)
+        self.assertEqual(msg.uuid, err.uuid)
+
+    def test_netstring_too_big(self):
+        """
+        A netstring longer than MAX_LENGTH results in an error 4 (Request too
+        big) and the connection being dropped.
+        """
+        self.transport.loseConnection = MagicMock()
+        self.protocol.dataReceived('%d:' % (self.protocol.MAX_LENGTH + 1))
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(4, err.code)
+        self.assertEqual(ERRORS[4], err.title)
+        self.assertTrue(self.transport.loseConnection.called)
+
+    def test_send_message_stream(self):
+        """
+        Encoded messages are written without any further framing once the
+        peer has advertised the 'stream' capability.
+        """
+        self.protocol.peer_capabilities = frozenset(['stream'])
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(msg)
+        self.assertEqual(to_msgpack(msg), self.transport.value())
+
+    def test_send_message_stream_compressed(self):
+        """
+        Compressed payloads are written as msgpack strings when using msgpack
+        stream framing.
+        """
+        self.protocol.peer_capabilities = frozenset(['stream', 'zlib'])
+        msg = self._large_store()
+        self.protocol.sendMessage(msg)
+        payload = msgpack.unpackb(self.transport.value())
+        self.assertEqual(COMPRESSED_FRAME, payload[0])
+        self.assertEqual(msg, from_msgpack(zlib.decompress(payload[1:])))
+
+    def test_send_string_stream(self):
+        """
+        Strings are sent as msgpack strings when using msgpack stream framing.
+        """
+        self.protocol.peer_capabilities = frozenset(['stream'])
+        self.protocol.sendString('foo')
+        self.assertEqual(msgpack.packb('foo'), self.transport.value())
+
+    def test_data_received_switches_to_stream(self):
+        """
+        A frame that isn't a netstring means the peer has switched to msgpack
+        stream framing. Messages arriving in netstrings before the switch and
+        stream framed messages after it are all handled.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        first = Pong(str(uuid4()), self.node_id, get_version())
+        second = Pong(str(uuid4()), self.node_id, get_version())
+        third = Pong(str(uuid4()), self.node_id, get_version())
+        raw = (self._to_netstring(to_msgpack(first)) + to_msgpack(second) +
+               to_msgpack(third, compact=True))
+        # Feed the data one byte at a time.
+        for i in xrange(len(raw)):
+            self.protocol.dataReceived(raw[i])
+        self.assertIsNot(None, self.protocol._unpacker)
+        self.assertEqual([first, second, third],
+                         [call[0][0] for call in
+                          self.node.message_received.call_args_list])
+
+    def test_stream_string_payload(self):
+        """
+        Strings in a msgpack stream are handled as if they had arrived in a
+        netstring.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._large_store()
+        payload = COMPRESSED_FRAME + zlib.compress(to_msgpack(msg))
+        self.protocol.dataReceived(msgpack.packb(payload))
+        self.node.message_received.assert_called_once_with(msg, self.protocol)
+
+    def test_stream_chunked(self):
+        """
+        Chunked messages survive a round trip using msgpack stream framing.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._chunked_store()
+        self.protocol.peer_capabilities = frozenset(['stream', 'chunked'])
+        self.protocol.sendMessage(msg)
+        raw = self.transport.value()
+        self.assertNotIn(raw[0], '0123456789')
+        self.transport.clear()
+        for i in xrange(0, len(raw), 1000):
+            self.protocol.dataReceived(raw[i:i + 1000])
+        self.assertEqual(1, self.node.message_received.call_count)
+        self.assertEqual(msg, self.node.message_received.call_args[0][0])
+
+    def test_stream_expected_chunk(self):
+        """
+        A message arriving while a chunked message is being received results
+        in an error 1 (Bad request).
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        msg = self._chunked_store()
+        header = (CHUNKED_FRAME + struct.pack('>I', 100) +
+                  to_msgpack(msg._replace(value='')))
+        pong = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.dataReceived(msgpack.packb(header) + to_msgpack(pong))
+        err = from_msgpack(self.transport.value())
+        self.assertEqual(1, err.code)
+        self.assertEqual(None, self.protocol.chunked_message)
+        self.assertEqual(0, self.node.message_received.call_count)
+
+    def test_stream_corrupt(self):
+        """
+        Data that cannot be unpacked results in an error 1 (Bad request) and
+        the connection being dropped.
+        """
+        self.transport.loseConnection = MagicMock()
+        self.protocol.dataReceived('\xc1')
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(1, err.code)
+        self.assertTrue(self.transport.loseConnection.called)
+
+    def test_stream_too_big(self):
+        """
+        A stream framed message longer than MAX_LENGTH results in an error 4
+        (Request too big) and the connection being dropped.
+        """
+        self.transport.loseConnection = MagicMock()
+        self.protocol.MAX_LENGTH = 100
+        self.protocol.dataReceived(msgpack.packb('x' * 200)[:150])
+        err = from_msgpack(self._from_netstring(self.transport.value()))
+        self.assertEqual(4, err.code)
+        self.assertTrue(self.transport.loseConnection.called)
+
+    def test_stream_unknown_tag(self):
+        """
+        A stream framed message of an unknown type results in an error 2
+        (Unknown request) before it is unpacked.
+        """
+        self._check_rejected(msgpack.packb((COMPACT_VERSION, 99, ())), 2,
+                             stream=True)
+
+    def test_stream_unsupported_version(self):
+        """
+        A stream framed message of an unknown version results in an error 5
+        (Unsupported protocol) before it is unpacked.
+        """
+        msg = Ping(str(uuid4()), self.node_id, get_version())
+        raw = to_msgpack(msg, True)
+        raw = raw[:1] + chr(COMPACT_VERSION + 1) + raw[2:]
+        self._check_rejected(raw, 5, stream=True)
+
+    def test_stream_not_a_message(self):
+        """
+        A stream framed object that is neither a message nor a string results
+        in an error 1 (Bad request).
+        """
+        self._check_rejected(msgpack.packb(123), 1, stream=True)
+
+    def test_stream_too_big_for_type(self):
+        """
+        A stream framed message is rejected with an error 4 (Request too big)
+        as soon as more of it has arrived than the maximum size for its type,
+        without waiting for the rest of it.
+        """
+        self.transport.loseConnection = MagicMock()
+        msg = Ping(str(uuid4()), self.node_id, 'x' * MAX_SMALL_MESSAGE_SIZE)
+        raw = to_msgpack(msg, True)
+        self._check_rejected(raw[:MAX_SMALL_MESSAGE_SIZE + 1], 4, stream=True)
+        self.assertTrue(self.transport.loseConnection.called)
+
+    def test_stream_large_value(self):
+        """
+        Partially received stream framed messages that carry values may be
+        larger than MAX_SMALL_MESSAGE_SIZE.
+        """
+        self.node.message_received = MagicMock()
+        msg = Store(str(uuid4()), self.node_id, 'key',
+                    'x' * MAX_SMALL_MESSAGE_SIZE, time.time(), 0.0, 'key',
+                    'name', {}, 'sig', get_version())
+        raw = to_msgpack(msg, True)
+        self.protocol.dataReceived(raw[:-1])
+        self.assertEqual('', self.transport.value())
+        self.protocol.dataReceived(raw[-1:])
+        self.node.message_received.assert_called_once_with(msg, self.protocol)
+
+    def test_string_received_lazy_values(self):
+        """
+        If lazy_values is set the value of an incoming Store message is left
+        msgpack encoded. Other messages are unaffected.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        self.protocol.lazy_values = True
+        msg = self._large_store()
+        pong = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.dataReceived(self._to_netstring(to_msgpack(msg)) +
+                                   self._to_netstring(to_msgpack(pong)))
+        calls = self.node.message_received.call_args_list
+        result = calls[0][0][0]
+        self.assertIsInstance(result.value, LazyValue)
+        self.assertEqual(msg, result)
+        self.assertEqual(pong, calls[1][0][0])
+
+    def test_stream_lazy_values(self):
+        """
+        If lazy_values is set the values of Store messages arriving via
+        msgpack stream framing (in either encoding) are left msgpack encoded.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        self.protocol.lazy_values = True
+        first = self._large_store()
+        second = self._large_store()
+        pong = Pong(str(uuid4()), self.node_id, get_version())
+        raw = (to_msgpack(first) + to_msgpack(pong) +
+               to_msgpack(second, compact=True))
+        # Feed the data in small pieces.
+        for i in xrange(0, len(raw), 1000):
+            self.protocol.dataReceived(raw[i:i + 1000])
+        results = [call[0][0] for call in
+                   self.node.message_received.call_args_list]
+        self.assertEqual([first, pong, second], results)
+        self.assertIsInstance(results[0].value, LazyValue)
+        self.assertIsInstance(results[2].value, LazyValue)
+        self.assertEqual([''], self.protocol._stream_data)
+        self.assertEqual(len(raw), self.protocol._stream_offset)
+
+    def test_stream_lazy_values_string_payload(self):
+        """
+        If lazy_values is set strings in a msgpack stream are still handled as
+        if they had arrived in a netstring.
+        """
+        self.node.message_received = MagicMock(return_value=True)
+        self.protocol.lazy_values = True
+        msg = self._large_store()
+        payload = COMPRESSED_FRAME + zlib.compress(to_msgpack(msg))
+        self.protocol.dataReceived(msgpack.packb(payload))
+        result = self.node.message_received.call_args[0][0]
+        self.assertEqual(msg, result)
+        self.assertIsInstance(result.value, LazyValue)
+
+    def test_registered_as_producer(self):
+        """
+        The protocol registers itself as a streaming producer with its
+        transport.
+        """
+        self.assertEqual(self.protocol, self.transport.producer)
+        self.assertTrue(self.transport.streaming)
+
+    def test_pause_producing(self):
+        """
+        When the transport's buffer is full the protocol stops reading from
+        the peer and records the event.
+        """
+        self.protocol.pauseProducing()
+        self.assertTrue(self.protocol.paused)
+        self.assertEqual('paused', self.transport.producerState)
+        self.assertEqual(1, self.node.backpressure.pauses)
+
+    def test_send_message_while_paused_is_queued(self):
+        """
+        Messages sent while the transport's buffer is full are queued.
+        """
+        self.protocol.pauseProducing()
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(msg)
+        self.assertEqual('', self.transport.value())
+        expected = self._to_netstring(to_msgpack(msg))
+        self.assertEqual(len(expected), self.protocol.queued_bytes)
+        self.assertEqual(len(expected), self.node.backpressure.queued_bytes)
+        self.assertEqual(len(expected),
+                         self.node.backpressure.peak_queued_bytes)
+
+    def test_resume_producing_flushes_queue(self):
+        """
+        Once the transport's buffer drains the queue is written, in order, and
+        the protocol starts reading from the peer again.
+        """
+        self.protocol.pauseProducing()
+        first = Pong(str(uuid4()), self.node_id, get_version())
+        second = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(first)
+        self.protocol.sendMessage(second)
+        self.protocol.resumeProducing()
+        expected = (self._to_netstring(to_msgpack(first)) +
+                    self._to_netstring(to_msgpack(second)))
+        self.assertEqual(expected, self.transport.value())
+        self.assertFalse(self.protocol.paused)
+        self.assertEqual('producing', self.transport.producerState)
+        self.assertEqual(0, self.protocol.queued_bytes)
+        self.assertEqual(0, self.node.backpressure.queued_bytes)
+
+    def test_resume_producing_paused_again(self):
+        """
+        If the transport's buffer fills up again while the queue is being
+        written the remainder stays queued.
+        """
+        self.protocol.pauseProducing()
+        first = Pong(str(uuid4()), self.node_id, get_version())
+        second = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(first)
+        self.protocol.sendMessage(second)
+        self.transport.write = MagicMock(
+            side_effect=lambda data: self.protocol.pauseProducing())
+        self.protocol.resumeProducing()
+        self.assertEqual(1, self.transport.write.call_count)
+        self.assertTrue(self.protocol.paused)
+        expected = len(self._to_netstring(to_msgpack(second)))
+        self.assertEqual(expected, self.protocol.queued_bytes)
+        self.assertEqual('paused', self.transport.producerState)
+
+    def test_lose_connection_waits_for_queue(self):
+        """
+        A request to drop the connection waits until the queue has drained.
+        """
+        self.transport.loseConnection = MagicMock()
+        self.protocol.pauseProducing()
+        msg = Pong(str(uuid4()), self.node_id, get_version())
+        self.protocol.sendMessage(msg, True)
+        self.assertEqual(0, self.transport.loseConnection.call_count)
+        self.assertEqual(self.protocol, self.transport.producer)
+        self.protocol.resumeProducing()
+        self.transport.loseConnection.assert_called_once_with()
+        self.assertEqual(None, self.transport.producer)
+
+    def test_connection_queue_limit(self):
+        """
+        The connection is dropped if its queue grows too large.
+        """
+        self.transport.abortConnection = MagicMock()
+        self.protocol.pauseProducing()
+        self.protocol.sendString('x' * (MAX_CONNECTION_QUEUE - 100))
+        self.assertEqual(0, self.transport.abortConnection.call_count)
+        self.protocol.sendString('x' * 100)
+        self.transport.abortConnection.assert_called_once_with()
+        self.assertEqual(1, self.node.backpressure.dropped)
+        self.assertEqual(0, self.protocol.queued_bytes)
+        self.assertEqual(0, self.node.backpressure.queued_bytes)
+
+    def test_global_queue_limit(self):
+        """
+        The connection is dropped if the queues for all connections grow too
+        large.
+        """
+        self.transport.abortConnection = MagicMock()
+        self.node.backpressure.queued_bytes = 1000
+        with patch('drogulus.net.protocol.MAX_GLOBAL_QUEUE', 1050):
+            self.protocol.pauseProducing()
+            self.protocol.sendString('x' * 100)
+        self.transport.abortConnection.assert_called_once_with()
+        self.assertEqual(1000, self.node.backpressure.queued_bytes)
+
+    def test_connection_lost_discards_queue(self):
+        """
+        Anything still queued when the connection is lost is discarded.
+        """
+        self.protocol.pauseProducing()
+        self.protocol.sendString('x' * 100)
+        self.protocol.connectionLost(None)
+        self.assertEqual(0, self.protocol.queued_bytes)
+        self.assertEqual(0, self.node.backpressure.queued_bytes)
+
+
+class TestDHTProtocolOverTLS(unittest.TestCase):
+    """
+    Ensures the DHTProtocol closes connections over a real TLS transport
+    (which won't close while a producer is registered).
+    """
+
+    def setUp(self):
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 1024)
+        cert = crypto.X509()
+        cert.get_subject().CN = 'localhost'
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, 'sha256')
+        self.node = Node(hashlib.sha512('node').digest())
+        server = TLSMemoryBIOFactory(
+            CertificateOptions(privateKey=key, certificate=cert), False,
+            DHTFactory(self.node))
+        client = TLSMemoryBIOFactory(
+            CertificateOptions(), True,
+            protocol.Factory.forProtocol(protocol.Protocol))
+        server_tls = server.buildProtocol(('127.0.0.1', 1908))
+        client_tls = client.buildProtocol(('127.0.0.1', 1909))
+        self.transport = iosim.FakeTransport(server_tls, False)
+        client_transport = iosim.FakeTransport(client_tls, True)
+        server_tls.makeConnection(self.transport)
+        client_tls.makeConnection(client_transport)
+        self.pump = iosim.IOPump(client_tls, server_tls, client_transport,
+                                 self.transport, False)
+        # Complete the handshake.
+        self.pump.flush()
+        self.protocol = server_tls.wrappedProtocol
+        self.msg = Pong(str(uuid4()), self.node.id, get_version())
+
+    def test_send_message_lose_connection(self):
+        """
+        The connection is closed once the message is sent.
+        """
+        self.protocol.sendMessage(self.msg, True)
+        self.pump.flush()
+        self.assertTrue(self.transport.disconnected)
+
+    def test_send_message_lose_connection_after_queue(self):
+        """
+        The connection is closed once the queue has drained.
+        """
+        self.protocol.pauseProducing()
+        self.protocol.sendMessage(self.msg, True)
+        self.pump.flush()
+        self.assertFalse(self.transport.disconnected)
+        self.protocol.resumeProducing()
+        self.pump.flush()
+        self.assertTrue(self.transport.disconnected)
+
+
+class TestBackpressureStats(unittest.TestCase):
+    """
+    Ensures the BackpressureStats class works as expected.
+    """
+
+    def test_init(self):
+        """
+        All the counters start at zero.
+        """
+        stats = BackpressureStats()
+        self.assertEqual(0, stats.queued_bytes)
+        self.assertEqual(0, stats.peak_queued_bytes)
+        self.assertEqual(0, stats.pauses)
+        self.assertEqual(0, stats.dropped)
+
+
+class TestChunkedMessage(unittest.TestCase):
+    """
+    Ensures the ChunkedMessage class works as expected.
+    """
+
+    def setUp(self):
+        self.value = 'x' * 100
+        self.message = Store(str(uuid4()), 'node', 'key', '', time.time(),
+                             0.0, 'public_key', 'name', {}, 'sig',
+                             get_version())
+
+    def test_assemble(self):
+        """
+        The assembled message contains the complete prehashed value.
+        """
+        chunked = ChunkedMessage(self.message, len(self.value))
+        chunked.add_chunk(self.value[:60])
+        self.assertFalse(chunked.is_complete())
+        chunked.add_chunk(self.value[60:])
+        self.assertTrue(chunked.is_complete())
+        result = chunked.assemble()
+        self.assertEqual(self.message._replace(value=self.value), result)
+        self.assertIsInstance(result.value, PrehashedValue)
+        expected = hashlib.sha512(msgpack.packb(self.value)).digest()
+        self.assertEqual(expected, result.value.digest)
+
+    def test_add_chunk_too_much(self):
+        """
+        Adding more data than expected raises a ValueError.
+        """
+        chunked = ChunkedMessage(self.message, 10)
+        with self.assertRaises(ValueError) as cm:
+            chunked.add_chunk(self.value)
+        self.assertEqual(1, cm.exception.args[0])
+        self.assertEqual(self.message.uuid, cm.exception.args[3])
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures TLS connections to peers share a context and resume sessions.
+"""
+from drogulus.net.tls import (TLSSessionCache, PeerConnectionCreator,
+                              session_reused)
+from twisted.internet.endpoints import SSL4ClientEndpoint
+from twisted.internet.ssl import CertificateOptions
+from twisted.internet import reactor, protocol
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.test import iosim
+from OpenSSL import SSL, crypto
+from mock import MagicMock, patch
+import unittest
+
+
+def server_options():
+    """
+    Returns the options for a TLS server with a new self signed certificate
+    that issues session tickets.
+    """
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 1024)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(3600)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    return CertificateOptions(privateKey=key, certificate=cert,
+                              enableSessionTickets=True)
+
+
+class TestTLSSessionCache(unittest.TestCase):
+    """
+    Ensures the TLSSessionCache class works as expected.
+    """
+
+    def setUp(self):
+        self.cache = TLSSessionCache(max_size=2)
+        self.peer = ('127.0.0.1', 1908)
+
+    def handshake(self, peer, session='session', reused=False):
+        """
+        Returns a connection to the peer that has pretended to complete a
+        handshake resulting in the given session (that may have been
+        resumed).
+        """
+        connection = MagicMock()
+        connection.get_session.return_value = session
+        self.cache._connections[connection] = peer
+        with patch('drogulus.net.tls.session_reused', return_value=reused):
+            self.cache._info_callback(connection, SSL.SSL_CB_HANDSHAKE_DONE,
+                                      1)
+        return connection
+
+    def test_init(self):
+        """
+        Ensure the context is created once with session caching enabled.
+        """
+        self.assertTrue(isinstance(self.cache.context, SSL.Context))
+        self.assertEqual(SSL.SESS_CACHE_CLIENT,
+                         self.cache.context.get_session_cache_mode())
+        self.assertEqual(2, self.cache.max_size)
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(0, self.cache.misses)
+
+    def test_init_with_options(self):
+        """
+        Ensure the context is obtained from the options if they are given.
+        """
+        context = MagicMock()
+        options = MagicMock()
+        options.getContext.return_value = context
+        cache = TLSSessionCache(options)
+        self.assertEqual(context, cache.context)
+        context.set_session_cache_mode.assert_called_once_with(
+            SSL.SESS_CACHE_CLIENT)
+
+    def test_connection_for_new_peer(self):
+        """
+        Ensure a connection to an unknown peer does not attempt to resume a
+        session.
+        """
+        tls_protocol = MagicMock()
+        connection = self.cache.connection_for(self.peer, tls_protocol)
+        self.assertTrue(isinstance(connection, SSL.Connection))
+        self.assertEqual(self.cache.context, connection.get_context())
+        self.assertEqual(tls_protocol, connection.get_app_data())
+        # Nothing is counted until the handshake is done.
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(0, self.cache.misses)
+
+    def test_handshake_done_remembers_session(self):
+        """
+        Ensure the session is cached when a handshake is complete.
+        """
+        self.handshake(self.peer)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual('session', self.cache._sessions[self.peer])
+
+    def test_handshake_done_counts_hits(self):
+        """
+        Ensure a handshake is only counted as a hit if it resumed a session,
+        and each handshake is only counted once.
+        """
+        connection = self.handshake(self.peer)
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        self.handshake(self.peer, reused=True)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        # OpenSSL may report the handshake is done again (for example, after
+        # a TLS 1.3 session ticket arrives).
+        with patch('drogulus.net.tls.session_reused', return_value=True):
+            self.cache._info_callback(connection, SSL.SSL_CB_HANDSHAKE_DONE,
+                                      1)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_session_ticket_after_handshake(self):
+        """
+        Ensure the cached session is updated when a TLS 1.3 session ticket
+        arrives after the handshake is complete.
+        """
+        connection = self.handshake(self.peer)
+        connection.get_session.return_value = 'ticket'
+        self.cache._info_callback(connection, SSL.SSL_CB_CONNECT_LOOP, 1)
+        self.assertEqual('ticket', self.cache._sessions[self.peer])
+
+    def test_session_ignored_before_handshake(self):
+        """
+        Ensure sessions are not cached until the handshake is complete.
+        """
+        connection = self.cache.connection_for(self.peer, MagicMock())
+        connection.get_session = MagicMock(return_value='session')
+        self.cache._info_callback(connection, SSL.SSL_CB_CONNECT_LOOP, 1)
+        self.assertEqual(0, len(self.cache))
+
+    def test_unknown_connection_ignored(self):
+        """
+        Ensure callbacks for connections not created by the cache are
+        ignored.
+        """
+        connection = MagicMock()
+        self.cache._info_callback(connection, SSL.SSL_CB_HANDSHAKE_DONE, 1)
+        self.assertEqual(0, len(self.cache))
+
+    def test_connection_for_known_peer_resumes_session(self):
+        """
+        Ensure a connection to a peer with a cached session attempts to
+        resume it.
+        """
+        self.handshake(self.peer)
+        with patch.object(SSL.Connection, 'set_session') as mock_set:
+            connection = self.cache.connection_for(self.peer, MagicMock())
+            mock_set.assert_called_once_with('session')
+        self.assertTrue(isinstance(connection, SSL.Connection))
+        # Offering the session isn't a hit.
+        self.assertEqual(0, self.cache.hits)
+
+    def test_least_recently_used_session_forgotten(self):
+        """
+        Ensure only the sessions for the max_size most recent peers are
+        remembered.
+        """
+        self.handshake(('127.0.0.1', 1))
+        self.handshake(('127.0.0.1', 2))
+        self.handshake(('127.0.0.1', 1))
+        self.handshake(('127.0.0.1', 3))
+        self.assertEqual(2, len(self.cache))
+        self.assertTrue(('127.0.0.1', 1) in self.cache._sessions)
+        self.assertFalse(('127.0.0.1', 2) in self.cache._sessions)
+        self.assertTrue(('127.0.0.1', 3) in self.cache._sessions)
+
+    def test_forget(self):
+        """
+        Ensure the cached session for a peer can be discarded.
+        """
+        self.handshake(self.peer)
+        self.cache.forget(self.peer)
+        self.assertEqual(0, len(self.cache))
+        # Forgetting an unknown peer is harmless.
+        self.cache.forget(self.peer)
+
+    def test_endpoint(self):
+        """
+        Ensure the endpoint connects to the peer using the cache.
+        """
+        result = self.cache.endpoint(reactor, '127.0.0.1', 1908)
+        self.assertTrue(isinstance(result, SSL4ClientEndpoint))
+        creator = result._sslContextFactory
+        self.assertTrue(isinstance(creator, PeerConnectionCreator))
+        self.assertEqual(self.cache, creator.cache)
+        self.assertEqual(self.peer, creator.peer)
+
+
+class TestPeerConnectionCreator(unittest.TestCase):
+    """
+    Ensures the PeerConnectionCreator class works as expected.
+    """
+
+    def test_client_connection_for_tls(self):
+        """
+        Ensure the connection is obtained from the cache for the peer.
+        """
+        cache = MagicMock()
+        cache.connection_for.return_value = 'connection'
+        peer = ('127.0.0.1', 1908)
+        creator = PeerConnectionCreator(cache, peer)
+        tls_protocol = MagicMock()
+        result = creator.clientConnectionForTLS(tls_protocol)
+        self.assertEqual('connection', result)
+        cache.connection_for.assert_called_once_with(peer, tls_protocol)
+
+
+class TestSessionResumption(unittest.TestCase):
+    """
+    Ensures sessions are resumed (and counted) over real TLS connections.
+    """
+
+    def connect(self, cache, options):
+        """
+        Completes a handshake with a server using the given options via a
+        connection from the cache and returns the client's OpenSSL
+        connection.
+        """
+        client = TLSMemoryBIOFactory(
+            PeerConnectionCreator(cache, ('127.0.0.1', 1908)), True,
+            protocol.Factory.forProtocol(protocol.Protocol))
+        server = TLSMemoryBIOFactory(
+            options, False, protocol.Factory.forProtocol(protocol.Protocol))
+        client_tls = client.buildProtocol(('127.0.0.1', 1908))
+        server_tls = server.buildProtocol(('127.0.0.1', 1909))
+        client_transport = iosim.FakeTransport(client_tls, True)
+        server_transport = iosim.FakeTransport(server_tls, False)
+        client_tls.makeConnection(client_transport)
+        server_tls.makeConnection(server_transport)
+        iosim.IOPump(client_tls, server_tls, client_transport,
+                     server_transport, False).flush()
+        return client_tls._tlsConnection
+
+    def test_resumed(self):
+        """
+        Ensure the second connection to the same server resumes the session
+        and is counted as a hit.
+        """
+        cache = TLSSessionCache()
+        options = server_options()
+        self.assertFalse(session_reused(self.connect(cache, options)))
+        self.assertEqual((0, 1), (cache.hits, cache.misses))
+        self.assertTrue(session_reused(self.connect(cache, options)))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_not_resumed(self):
+        """
+        Ensure a session the server won't resume is counted as a miss even
+        though it was offered.
+        """
+        cache = TLSSessionCache()
+        self.connect(cache, server_options())
+        self.assertEqual(1, len(cache))
+        # A different server doesn't recognise the session.
+        self.assertFalse(session_reused(self.connect(cache,
+                                                     server_options())))
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
@@ -6,7 +6,11 @@ work correctly.
 from drogulus.net.validators import (validate_timestamp, validate_code,
                                      validate_string, validate_meta,
                                      validate_node, validate_nodes,
-                                     validate_value, VALIDATORS)
+                                     validate_value, validate_batch,
+                                     validate_batch_results,
+                                     compile_validator, VALIDATORS)
+from drogulus.constants import MAX_BATCH_SIZE
+from drogulus.net.packing import pack_nodes
 import unittest
 import time
 
@@ -46,6 +50,12 @@ class TestValidators(unittest.TestCase):
         """
         self.assertFalse(validate_code('1'))
 
+    def test_validate_code_unhashable(self):
+        """
+        Unhashable values are not error codes.
+        """
+        self.assertFalse(validate_code({}))
+
     def test_validate_string_str(self):
         """
         Regular Python strings pass.
@@ -158,6 +168,34 @@ class TestValidators(unittest.TestCase):
         """
         self.assertFalse(validate_nodes(((123, [127, 0, 0, 1], 1908, '0.1'))))
 
+    def test_validate_nodes_bad_port(self):
+        """
+        Every node in the tuple is checked in the same way as validate_node.
+        """
+        nodes = (('id', '127.0.0.1', 1908, '0.1'),
+                 ('id', '127.0.0.1', 49152, '0.1'))
+        self.assertFalse(validate_nodes(nodes))
+
+    def test_validate_nodes_short_node(self):
+        """
+        Each node must have four items.
+        """
+        self.assertFalse(validate_nodes((('id', '127.0.0.1', 1908),)))
+
+    def test_validate_nodes_packed(self):
+        """
+        A string containing packed nodes is valid.
+        """
+        packed = pack_nodes((('x' * 64, '127.0.0.1', 1908, '0.1'),))
+        self.assertTrue(validate_nodes(packed))
+
+    def test_validate_nodes_packed_malformed(self):
+        """
+        A string that doesn't contain packed nodes is not valid.
+        """
+        packed = pack_nodes((('x' * 64, '127.0.0.1', 1908, '0.1'),))
+        self.assertFalse(validate_nodes(packed[:-1]))
+
     def test_validate_value(self):
         """
         Checks the validity of values stored in the DHT. Currently always
@@ -165,12 +203,47 @@ class TestValidators(unittest.TestCase):
         """
         self.assertTrue(validate_value('foo'))
 
+    def test_validate_batch(self):
+        """
+        A tuple of between one and MAX_BATCH_SIZE strings is valid.
+        """
+        self.assertTrue(validate_batch(('foo', )))
+        self.assertTrue(validate_batch(('foo', ) * MAX_BATCH_SIZE))
+
+    def test_validate_batch_wrong_size(self):
+        """
+        Empty batches and batches of more than MAX_BATCH_SIZE messages are
+        not valid.
+        """
+        self.assertFalse(validate_batch(()))
+        self.assertFalse(validate_batch(('foo', ) * (MAX_BATCH_SIZE + 1)))
+
+    def test_validate_batch_wrong_type(self):
+        """
+        A batch can only be expressed as a tuple of strings.
+        """
+        self.assertFalse(validate_batch(['foo']))
+        self.assertFalse(validate_batch(('foo', 1)))
+        self.assertFalse(validate_batch('foo'))
+
+    def test_validate_batch_results(self):
+        """
+        The results of a batch may be empty (if every reply was too big to
+        fit) but are otherwise checked like a batch.
+        """
+        self.assertTrue(validate_batch_results(()))
+        self.assertTrue(validate_batch_results(('foo', )))
+        self.assertFalse(validate_batch_results(('foo', ) *
+                                                (MAX_BATCH_SIZE + 1)))
+        self.assertFalse(validate_batch_results(['foo']))
+        self.assertFalse(validate_batch_results(None))
+
     def test_validate_VALIDATORS(self):
         """
         Ensures that the VALIDATORS dict maps the field names to validator
         functions correctly.
         """
-        self.assertEqual(15, len(VALIDATORS))
+        self.assertEqual(17, len(VALIDATORS))
         self.assertEqual(VALIDATORS['uuid'], validate_string)
         self.assertEqual(VALIDATORS['node'], validate_string)
         self.assertEqual(VALIDATORS['code'], validate_code)
@@ -186,3 +259,29 @@ class TestValidators(unittest.TestCase):
         self.assertEqual(VALIDATORS['meta'], validate_meta)
         self.assertEqual(VALIDATORS['sig'], validate_string)
         self.assertEqual(VALIDATORS['nodes'], validate_nodes)
+        self.assertEqual(VALIDATORS['messages'], validate_batch)
+        self.assertEqual(VALIDATORS['results'], validate_batch_results)
+
+    def test_compile_validator(self):
+        """
+        The compiled validator checks each positional value with the validator
+        for the corresponding field.
+        """
+        validator = compile_validator(('uuid', 'timestamp', 'code'))
+        self.assertTrue(validator('uuid', time.time(), 1))
+        self.assertFalse(validator(1, time.time(), 1))
+        self.assertFalse(validator('uuid', 123, 1))
+        self.assertFalse(validator('uuid', time.time(), 0))
+
+    def test_compile_validator_returns_boolean(self):
+        """
+        The compiled validator always returns a boolean.
+        """
+        validator = compile_validator(('value', ))
+        self.assertTrue(validator('foo') is True)
+
+    def test_compile_validator_unknown_field(self):
+        """
+        Fields without a validator cannot be compiled.
+        """
+        self.assertRaises(KeyError, compile_validator, ('foo', ))
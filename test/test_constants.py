@@ -72,6 +72,221 @@ class TestConstants(unittest.TestCase):
         self.assertIsInstance(constants.REFRESH_INTERVAL, int,
                               "constants.REFRESH_INTERVAL must be an integer.")
 
+    def test_CAPABILITIES(self):
+        """
+        The capabilities tuple lists the optional protocol features (as
+        strings) understood by the local node.
+        """
+        self.assertIsInstance(constants.CAPABILITIES, tuple,
+                              "constants.CAPABILITIES must be a tuple.")
+        for capability in constants.CAPABILITIES:
+            self.assertIsInstance(capability, str)
+
+    def test_COMPRESSION_THRESHOLD(self):
+        """
+        The compression threshold defines the size (in bytes) above which
+        messages are compressed before being sent to a capable peer.
+        """
+        self.assertIsInstance(constants.COMPRESSION_THRESHOLD, int,
+                              "constants.COMPRESSION_THRESHOLD must be an " +
+                              "integer.")
+
+    def test_MAX_MESSAGE_SIZE(self):
+        """
+        The maximum message size defines the largest message (in bytes) a node
+        will accept from a peer. It must leave room for a chunk of a value.
+        """
+        self.assertIsInstance(constants.MAX_MESSAGE_SIZE, int,
+                              "constants.MAX_MESSAGE_SIZE must be an integer.")
+        self.assertTrue(constants.MAX_MESSAGE_SIZE > constants.CHUNK_SIZE)
+
+    def test_MAX_VALUE_SIZE(self):
+        """
+        The maximum value size defines the largest value (in bytes) a node
+        will reassemble from chunks.
+        """
+        self.assertIsInstance(constants.MAX_VALUE_SIZE, int,
+                              "constants.MAX_VALUE_SIZE must be an integer.")
+        self.assertTrue(constants.MAX_VALUE_SIZE > constants.MAX_MESSAGE_SIZE)
+
+    def test_MAX_SMALL_MESSAGE_SIZE(self):
+        """
+        The maximum size of a message that doesn't carry a value must be an
+        integer no larger than the maximum message size.
+        """
+        self.assertIsInstance(constants.MAX_SMALL_MESSAGE_SIZE, int,
+                              "constants.MAX_SMALL_MESSAGE_SIZE must be an "
+                              "integer.")
+        self.assertTrue(constants.MAX_SMALL_MESSAGE_SIZE <=
+                        constants.MAX_MESSAGE_SIZE)
+
+    def test_MAX_BATCH_SIZE(self):
+        """
+        The maximum batch size defines the largest number of messages that
+        may be sent in a single Batch message.
+        """
+        self.assertIsInstance(constants.MAX_BATCH_SIZE, int,
+                              "constants.MAX_BATCH_SIZE must be an integer.")
+
+    def test_MAX_BATCH_PAYLOAD(self):
+        """
+        The maximum batch payload defines the largest total size (in bytes)
+        of the messages in a single Batch message. It must leave room for the
+        rest of the message.
+        """
+        self.assertIsInstance(constants.MAX_BATCH_PAYLOAD, int,
+                              "constants.MAX_BATCH_PAYLOAD must be an " +
+                              "integer.")
+        self.assertTrue(0 < constants.MAX_BATCH_PAYLOAD <
+                        constants.MAX_MESSAGE_SIZE)
+
+    def test_MAX_SHARED_STRING_SIZES(self):
+        """
+        The maximum total size of the strings shared between decoded messages
+        and the maximum size of each of them.
+        """
+        self.assertIsInstance(constants.MAX_SHARED_STRING_BYTES, int,
+                              "constants.MAX_SHARED_STRING_BYTES must be " +
+                              "an integer.")
+        self.assertIsInstance(constants.MAX_SHARED_STRING_LENGTH, int,
+                              "constants.MAX_SHARED_STRING_LENGTH must be " +
+                              "an integer.")
+        self.assertTrue(constants.MAX_SHARED_STRING_LENGTH <
+                        constants.MAX_SHARED_STRING_BYTES)
+
+    def test_MAX_SHARED_NODE_IDS(self):
+        """
+        The maximum number of node IDs shared between the routing table and
+        decoded messages.
+        """
+        self.assertIsInstance(constants.MAX_SHARED_NODE_IDS, int,
+                              "constants.MAX_SHARED_NODE_IDS must be an " +
+                              "integer.")
+
+    def test_MAX_CACHED_KEYS(self):
+        """
+        The maximum number of parsed public keys and of digests that are
+        cached.
+        """
+        self.assertIsInstance(constants.MAX_CACHED_PUBLIC_KEYS, int,
+                              "constants.MAX_CACHED_PUBLIC_KEYS must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.MAX_CACHED_KEY_HASHES, int,
+                              "constants.MAX_CACHED_KEY_HASHES must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.MAX_CACHED_COMPOUND_KEYS, int,
+                              "constants.MAX_CACHED_COMPOUND_KEYS must be " +
+                              "an integer.")
+        self.assertIsInstance(constants.MAX_CACHED_KEY_LENGTH, int,
+                              "constants.MAX_CACHED_KEY_LENGTH must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.MAX_CACHED_NAME_LENGTH, int,
+                              "constants.MAX_CACHED_NAME_LENGTH must be an " +
+                              "integer.")
+
+    def test_VERIFICATION(self):
+        """
+        The number of workers used to verify messages and the maximum number
+        of messages that may await verification.
+        """
+        self.assertIsInstance(constants.VERIFICATION_WORKERS, int,
+                              "constants.VERIFICATION_WORKERS must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.MAX_VERIFICATION_QUEUE, int,
+                              "constants.MAX_VERIFICATION_QUEUE must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.VERIFICATION_BATCH_SIZE, int,
+                              "constants.VERIFICATION_BATCH_SIZE must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.VERIFICATION_BATCH_DELAY, float,
+                              "constants.VERIFICATION_BATCH_DELAY must be a " +
+                              "float.")
+        self.assertIsInstance(constants.VERIFICATION_TIMEOUT, float,
+                              "constants.VERIFICATION_TIMEOUT must be a " +
+                              "float.")
+
+    def test_PARALLEL_HASH_THRESHOLD(self):
+        """
+        Values of at least this many bytes are hashed in the reactor's pool
+        of threads before they are signed.
+        """
+        self.assertIsInstance(constants.PARALLEL_HASH_THRESHOLD, int,
+                              "constants.PARALLEL_HASH_THRESHOLD must be an " +
+                              "integer.")
+
+    def test_CHUNK_SIZE(self):
+        """
+        The chunk size defines the size (in bytes) of the chunks used to send
+        large values. It must be smaller than the maximum message size.
+        """
+        self.assertIsInstance(constants.CHUNK_SIZE, int,
+                              "constants.CHUNK_SIZE must be an integer.")
+        self.assertTrue(constants.CHUNK_SIZE < constants.MAX_MESSAGE_SIZE)
+
+    def test_QUEUE_LIMITS(self):
+        """
+        The maximum number of bytes queued for a single slow peer and for all
+        connections. A single connection must be able to queue the largest
+        possible value.
+        """
+        self.assertIsInstance(constants.MAX_CONNECTION_QUEUE, int,
+                              "constants.MAX_CONNECTION_QUEUE must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.MAX_GLOBAL_QUEUE, int,
+                              "constants.MAX_GLOBAL_QUEUE must be an integer.")
+        self.assertTrue(constants.MAX_CONNECTION_QUEUE >
+                        constants.MAX_VALUE_SIZE)
+        self.assertTrue(constants.MAX_GLOBAL_QUEUE >=
+                        constants.MAX_CONNECTION_QUEUE)
+
+    def test_CHEAP_RPC_RATE_LIMIT(self):
+        """
+        The sustained rate and burst size of cheap requests accepted from a
+        single peer.
+        """
+        self.assertIsInstance(constants.CHEAP_RPC_RATE, int,
+                              "constants.CHEAP_RPC_RATE must be an integer.")
+        self.assertIsInstance(constants.CHEAP_RPC_BURST, int,
+                              "constants.CHEAP_RPC_BURST must be an integer.")
+
+    def test_EXPENSIVE_RPC_RATE_LIMIT(self):
+        """
+        The sustained rate and burst size of expensive requests accepted from
+        a single peer.
+        """
+        self.assertIsInstance(constants.EXPENSIVE_RPC_RATE, int,
+                              "constants.EXPENSIVE_RPC_RATE must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.EXPENSIVE_RPC_BURST, int,
+                              "constants.EXPENSIVE_RPC_BURST must be an " +
+                              "integer.")
+
+    def test_RESPONSE_RATE_LIMIT(self):
+        """
+        The sustained rate and burst size of responses accepted from a single
+        peer.
+        """
+        self.assertIsInstance(constants.RESPONSE_RATE, int,
+                              "constants.RESPONSE_RATE must be an integer.")
+        self.assertIsInstance(constants.RESPONSE_BURST, int,
+                              "constants.RESPONSE_BURST must be an integer.")
+
+    def test_BATCHED_RPC_RATE_LIMIT(self):
+        """
+        The sustained rate and burst size of requests sent in Batch messages
+        by a single peer. A full batch must be within the burst size.
+        """
+        self.assertIsInstance(constants.BATCHED_RPC_RATE, int,
+                              "constants.BATCHED_RPC_RATE must be an " +
+                              "integer.")
+        self.assertIsInstance(constants.BATCHED_RPC_BURST, int,
+                              "constants.BATCHED_RPC_BURST must be an " +
+                              "integer.")
+        self.assertTrue(constants.BATCHED_RPC_BURST >=
+                        constants.MAX_BATCH_SIZE,
+                        "constants.BATCHED_RPC_BURST must allow for a full " +
+                        "batch.")
+
     def test_ERRORS(self):
         """
         The ERRORS dictionary defines the error codes (keys) and associated
@@ -4,11 +4,23 @@ A set of sanity checks to ensure that the messages are defined as expected.
 """
 from drogulus.crypto import (generate_signature, validate_signature,
                              validate_message, construct_hash,
-                             construct_key)
+                             construct_key, raw_header, PrehashedValue,
+                             LazyValue, KeyCache, PUBLIC_KEYS,
+                             validate_messages, verify_hash, hash_stream,
+                             StreamedValue, LRUCache, PUBLIC_KEY_HASHES,
+                             COMPOUND_KEYS, precompute_keys, Signer,
+                             value_digest, prehash_value)
+from Crypto.PublicKey import RSA
+from drogulus.constants import MAX_CACHED_KEY_LENGTH, MAX_CACHED_NAME_LENGTH
+from mock import patch, MagicMock
+from twisted.internet import defer
 from drogulus.net.messages import Value
+from StringIO import StringIO
 import unittest
 import hashlib
 import msgpack
+import os
+import pickle
 import time
 
 
@@ -266,6 +278,35 @@ class TestMessageCryptoFunctions(unittest.TestCase):
         actual = validate_message(val)
         self.assertEqual(expected, actual)
 
+    def test_validate_messages(self):
+        """
+        Ensures each message results in the same result as validate_message.
+        """
+        good = Value('uuid', 'node', self.key, self.value, self.timestamp,
+                     self.expires, PUBLIC_KEY, self.name, self.meta,
+                     self.signature, self.version)
+        bad_sig = good._replace(value='wrong')
+        bad_key = good._replace(key='wrong')
+        messages = [good, bad_sig, bad_key]
+        self.assertEqual([validate_message(m) for m in messages],
+                         validate_messages(messages))
+        self.assertEqual([(True, None), (False, 6), (False, 7)],
+                         validate_messages(messages))
+
+    def test_validate_messages_checks_signatures_once(self):
+        """
+        Ensures each distinct signature is only checked once.
+        """
+        good = Value('uuid', 'node', self.key, self.value, self.timestamp,
+                     self.expires, PUBLIC_KEY, self.name, self.meta,
+                     self.signature, self.version)
+        other = good._replace(value='wrong')
+        with patch('drogulus.crypto.verify_hash',
+                   side_effect=verify_hash) as mock_verify:
+            results = validate_messages([good, other, good, other])
+        self.assertEqual([(True, None), (False, 6)] * 2, results)
+        self.assertEqual(2, mock_verify.call_count)
+
     def test_construct_hash(self):
         """
         Ensures that the hash is correctly generated.
@@ -288,6 +329,188 @@ class TestMessageCryptoFunctions(unittest.TestCase):
         actual = construct_hash(value, timestamp, expires, name, meta)
         self.assertEqual(expected, actual.digest())
 
+    def test_construct_hash_large_string(self):
+        """
+        Ensures strings that need each size of msgpack header are hashed
+        exactly as their encoding.
+        """
+        for length in (0, 31, 32, 2 ** 16 - 1, 2 ** 16):
+            value = 'x' * length
+            hashes = [hashlib.sha512(msgpack.packb(item)).digest() for item
+                      in (value, self.timestamp, self.expires, self.name,
+                          self.meta)]
+            expected = hashlib.sha512(''.join(hashes)).digest()
+            actual = construct_hash(value, self.timestamp, self.expires,
+                                    self.name, self.meta)
+            self.assertEqual(expected, actual.digest())
+
+    def test_hash_stream_file(self):
+        """
+        Ensures the remainder of a file-like object is hashed exactly as its
+        msgpack encoding.
+        """
+        value = os.urandom(1000)
+        expected = hashlib.sha512(msgpack.packb(value)).digest()
+        self.assertEqual(expected, hash_stream(StringIO(value), chunk_size=7))
+        source = StringIO('header' + value)
+        source.seek(6)
+        self.assertEqual(expected, hash_stream(source))
+        source.seek(6)
+        self.assertEqual(expected, hash_stream(source, len(value)))
+
+    def test_hash_stream_part_of_file(self):
+        """
+        Ensures only length bytes of a file-like object are read (so a value
+        can be followed by other data) and no more than chunk_size at a time.
+        """
+        value = os.urandom(1000)
+        expected = hashlib.sha512(msgpack.packb(value)).digest()
+        source = StringIO(value + 'trailer')
+        source.read = MagicMock(side_effect=source.read)
+        self.assertEqual(expected, hash_stream(source, len(value), 300))
+        self.assertEqual([((300, ), {}), ((300, ), {}), ((300, ), {}),
+                          ((100, ), {})], source.read.call_args_list)
+        self.assertEqual('trailer', source.getvalue()[source.tell():])
+        streamed = StreamedValue(StringIO(value + 'trailer'), len(value))
+        self.assertEqual(value, streamed.load())
+
+    def test_hash_stream_iterable(self):
+        """
+        Ensures an iterable of strings is hashed exactly as the msgpack
+        encoding of the strings joined together.
+        """
+        chunks = [os.urandom(100) for i in range(700)]
+        value = ''.join(chunks)
+        expected = hashlib.sha512(msgpack.packb(value)).digest()
+        self.assertEqual(expected, hash_stream(iter(chunks), len(value)))
+
+    def test_hash_stream_wrong_length(self):
+        """
+        Ensures a source with more or fewer bytes than its given length, or
+        an iterable without a length, results in a ValueError.
+        """
+        self.assertRaises(ValueError, hash_stream, ['abc'])
+        self.assertRaises(ValueError, hash_stream, ['abc'], 2)
+        self.assertRaises(ValueError, hash_stream, ['abc'], 4)
+        self.assertRaises(ValueError, hash_stream, StringIO('abc'), 4)
+
+    def test_construct_hash_streamed_value(self):
+        """
+        Ensures a StreamedValue results in the same hash as the string it
+        reads and that the source is only read once.
+        """
+        value = 'foo' * 10000
+        expected = construct_hash(value, self.timestamp, self.expires,
+                                  self.name, self.meta)
+        streamed = StreamedValue(StringIO(value))
+        for i in range(2):
+            actual = construct_hash(streamed, self.timestamp, self.expires,
+                                    self.name, self.meta)
+            self.assertEqual(expected.digest(), actual.digest())
+
+    def test_streamed_value_signature(self):
+        """
+        Ensures a StreamedValue is signed exactly as the string it reads.
+        """
+        streamed = StreamedValue(iter(['va', 'lue']), 5)
+        actual = generate_signature(streamed, self.timestamp, self.expires,
+                                    self.name, self.meta, PRIVATE_KEY)
+        self.assertEqual(self.signature, actual)
+
+    def test_streamed_value_load(self):
+        """
+        Ensures a StreamedValue from a file-like source can be loaded into
+        memory (along with its digest) but one from an iterable can't.
+        """
+        source = StringIO('header' + 'value')
+        source.seek(6)
+        streamed = StreamedValue(source)
+        loaded = streamed.load()
+        self.assertIsInstance(loaded, PrehashedValue)
+        self.assertEqual('value', loaded)
+        self.assertEqual(hashlib.sha512(msgpack.packb('value')).digest(),
+                         loaded.digest)
+        self.assertTrue(streamed.loadable)
+        streamed = StreamedValue(iter(['value']), 5)
+        self.assertFalse(streamed.loadable)
+        self.assertRaises(TypeError, streamed.load)
+
+    def test_construct_hash_prehashed_value(self):
+        """
+        Ensures that the existing digest of a PrehashedValue is used in place
+        of hashing the value again.
+        """
+        value = 'foo' * 100
+        digest = hashlib.sha512(msgpack.packb(value)).digest()
+        expected = construct_hash(value, self.timestamp, self.expires,
+                                  self.name, self.meta)
+        prehashed = PrehashedValue(value, digest)
+        actual = construct_hash(prehashed, self.timestamp, self.expires,
+                                self.name, self.meta)
+        self.assertEqual(expected.digest(), actual.digest())
+        # The digest really is used.
+        bogus = PrehashedValue(value, 'bogus')
+        actual = construct_hash(bogus, self.timestamp, self.expires,
+                                self.name, self.meta)
+        self.assertNotEqual(expected.digest(), actual.digest())
+
+    def test_prehashed_value(self):
+        """
+        A PrehashedValue behaves like the string it wraps.
+        """
+        value = PrehashedValue('foo', 'digest')
+        self.assertEqual('foo', value)
+        self.assertEqual('digest', value.digest)
+        self.assertEqual(msgpack.packb('foo'), msgpack.packb(value))
+
+    def test_prehashed_value_pickles(self):
+        """
+        A PrehashedValue (and its digest) survives pickling, for example when
+        it is sent to a worker process.
+        """
+        value = PrehashedValue('foo', 'digest')
+        for protocol in range(3):
+            unpickled = pickle.loads(pickle.dumps(value, protocol))
+            self.assertIsInstance(unpickled, PrehashedValue)
+            self.assertEqual('foo', unpickled)
+            self.assertEqual('digest', unpickled.digest)
+
+    def test_construct_hash_lazy_value(self):
+        """
+        The hash of a LazyValue is the hash of its existing encoding.
+        """
+        value = {'foo': 'bar' * 100}
+        expected = construct_hash(value, self.timestamp, self.expires,
+                                  self.name, self.meta)
+        raw = 'xx' + msgpack.packb(value)
+        lazy = LazyValue(buffer(raw, 2))
+        actual = construct_hash(lazy, self.timestamp, self.expires,
+                                self.name, self.meta)
+        self.assertEqual(expected.digest(), actual.digest())
+
+    def test_lazy_value(self):
+        """
+        A LazyValue unpacks its encoding on demand and compares equal to the
+        value it encodes.
+        """
+        lazy = LazyValue(msgpack.packb([1, 'foo']))
+        self.assertEqual((1, 'foo'), lazy.value)
+        self.assertEqual(lazy, (1, 'foo'))
+        self.assertEqual(lazy, LazyValue(msgpack.packb((1, 'foo'))))
+        self.assertNotEqual(lazy, (1, 'bar'))
+        self.assertNotEqual(lazy, LazyValue(msgpack.packb('foo')))
+        self.assertEqual(hashlib.sha512(msgpack.packb([1, 'foo'])).digest(),
+                         lazy.digest)
+
+    def test_raw_header(self):
+        """
+        Ensures the header matches that generated by msgpack for strings of
+        various lengths.
+        """
+        for length in (0, 31, 32, 65535, 65536, 100000):
+            value = 'x' * length
+            self.assertEqual(msgpack.packb(value), raw_header(length) + value)
+
     def test_construct_key(self):
         """
         Ensures that a DHT key is constructed correctly given correct inputs.
@@ -314,3 +537,316 @@ class TestMessageCryptoFunctions(unittest.TestCase):
         expected = pk_hasher.digest()
         actual = construct_key(PUBLIC_KEY)
         self.assertEqual(expected, actual)
+
+
+class TestKeyCache(unittest.TestCase):
+    """
+    Ensures parsed keys are cached as expected.
+    """
+
+    def setUp(self):
+        self.cache = KeyCache(2)
+
+    def test_get(self):
+        """
+        A key is parsed the first time it is asked for and then cached.
+        """
+        with patch('drogulus.schemes.RSA.importKey',
+                   side_effect=RSA.importKey) as mock_import:
+            scheme = self.cache.get(PUBLIC_KEY)
+            self.assertTrue(scheme is self.cache.get(PUBLIC_KEY))
+        self.assertEqual(1, mock_import.call_count)
+        self.assertTrue(PUBLIC_KEY in self.cache)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+        self.assertEqual(0.5, self.cache.hit_rate)
+
+    def test_hit_rate_empty(self):
+        """
+        The hit rate of an unused cache is zero.
+        """
+        self.assertEqual(0.0, self.cache.hit_rate)
+
+    def test_least_recently_used(self):
+        """
+        Once the cache is full the least recently used key is discarded.
+        """
+        self.cache.get(PUBLIC_KEY)
+        self.cache.get(ALT_PUBLIC_KEY)
+        self.cache.get(PUBLIC_KEY)
+        self.cache.get(PRIVATE_KEY)
+        self.assertEqual(2, len(self.cache))
+        self.assertTrue(PUBLIC_KEY in self.cache)
+        self.assertFalse(ALT_PUBLIC_KEY in self.cache)
+        self.assertTrue(PRIVATE_KEY in self.cache)
+
+    def test_malformed_key(self):
+        """
+        A malformed key results in a ValueError and isn't cached.
+        """
+        self.assertRaises(ValueError, self.cache.get, BAD_PUBLIC_KEY)
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(1, self.cache.misses)
+
+    def test_clear(self):
+        """
+        Clearing the cache discards every key and resets the statistics.
+        """
+        self.cache.get(PUBLIC_KEY)
+        self.cache.get(PUBLIC_KEY)
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual(0, self.cache.hits)
+        self.assertEqual(0, self.cache.misses)
+
+    def test_validate_signature_uses_cache(self):
+        """
+        Public keys used to validate signatures are cached (without the
+        surrounding whitespace).
+        """
+        PUBLIC_KEYS.clear()
+        self.addCleanup(PUBLIC_KEYS.clear)
+        validate_signature('value', 1.0, 0.0, 'name', {}, 'sig',
+                           '\n' + PUBLIC_KEY + '\n')
+        self.assertTrue(PUBLIC_KEY in PUBLIC_KEYS)
+
+    def test_generate_signature_parses_key(self):
+        """
+        Private keys given as strings are parsed every time rather than held
+        in a cache for the life of the process.
+        """
+        with patch('drogulus.crypto.scheme_for') as mock_scheme_for:
+            mock_scheme_for.return_value.load_key.return_value.sign.\
+                return_value = 'signature'
+            for i in range(2):
+                self.assertEqual('signature', generate_signature(
+                    'value', 1.0, 0.0, 'name', {}, PRIVATE_KEY))
+        load_key = mock_scheme_for.return_value.load_key
+        self.assertEqual(2, load_key.call_count)
+        load_key.assert_called_with(PRIVATE_KEY)
+
+    def test_generate_signature_key_object(self):
+        """
+        An RSA key object that has already been parsed can be used to
+        generate a signature.
+        """
+        key = RSA.importKey(PRIVATE_KEY)
+        expected = generate_signature('value', 1.0, 0.0, 'name', {},
+                                      PRIVATE_KEY)
+        actual = generate_signature('value', 1.0, 0.0, 'name', {}, key)
+        self.assertEqual(expected, actual)
+
+
+class TestLRUCache(unittest.TestCase):
+    """
+    Ensures the generic cache and the caches used by construct_key work as
+    expected.
+    """
+
+    def setUp(self):
+        self.cache = LRUCache(2, lambda key: key.upper())
+        PUBLIC_KEY_HASHES.clear()
+        COMPOUND_KEYS.clear()
+        self.addCleanup(PUBLIC_KEY_HASHES.clear)
+        self.addCleanup(COMPOUND_KEYS.clear)
+
+    def test_get(self):
+        """
+        The value for a key is created once and then cached.
+        """
+        self.assertEqual('A', self.cache.get('a'))
+        self.assertEqual('A', self.cache.get('a'))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_pin(self):
+        """
+        Pinned keys are never forgotten (and don't count towards max_size).
+        """
+        self.assertEqual('A', self.cache.pin('a'))
+        for key in 'bcde':
+            self.cache.get(key)
+        self.assertTrue('a' in self.cache)
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual('A', self.cache.get('a'))
+        self.cache.clear()
+        self.assertFalse('a' in self.cache)
+
+    def test_construct_key_cached(self):
+        """
+        The digests of public keys and compound keys are cached and the
+        result is the same as when nothing is cached.
+        """
+        key_hash = hashlib.sha512(PUBLIC_KEY).digest()
+        name_hash = hashlib.sha512('name').digest()
+        expected = hashlib.sha512(key_hash + name_hash).digest()
+        self.assertEqual(expected, construct_key(PUBLIC_KEY, 'name'))
+        self.assertEqual(expected, construct_key(PUBLIC_KEY + '\n', 'name'))
+        self.assertEqual(key_hash, construct_key(PUBLIC_KEY))
+        self.assertEqual(1, PUBLIC_KEY_HASHES.misses)
+        self.assertEqual(2, PUBLIC_KEY_HASHES.hits)
+        self.assertEqual(1, COMPOUND_KEYS.misses)
+        self.assertEqual(1, COMPOUND_KEYS.hits)
+
+    def test_construct_key_bounded(self):
+        """
+        No more than the maximum number of digests are cached.
+        """
+        with patch('drogulus.crypto.COMPOUND_KEYS', LRUCache(
+                2, COMPOUND_KEYS.create)) as cache:
+            for name in ('a', 'b', 'c'):
+                construct_key(PUBLIC_KEY, name)
+            self.assertEqual(2, len(cache))
+
+    def test_construct_key_long_inputs_not_cached(self):
+        """
+        The digests of public keys and names that are too long to cache are
+        worked out every time.
+        """
+        public_key = 'x' * (MAX_CACHED_KEY_LENGTH + 1)
+        name = 'n' * (MAX_CACHED_NAME_LENGTH + 1)
+        key_hash = hashlib.sha512(public_key).digest()
+        name_hash = hashlib.sha512(name).digest()
+        expected = hashlib.sha512(key_hash + name_hash).digest()
+        self.assertEqual(expected, construct_key(public_key, name))
+        self.assertEqual(key_hash, construct_key(public_key))
+        self.assertEqual(0, len(PUBLIC_KEY_HASHES))
+        self.assertEqual(0, len(COMPOUND_KEYS))
+        construct_key(PUBLIC_KEY, name)
+        self.assertEqual(1, len(PUBLIC_KEY_HASHES))
+        self.assertEqual(0, len(COMPOUND_KEYS))
+
+    def test_precompute_keys(self):
+        """
+        The keys for a public key and its names are pinned in the caches.
+        """
+        precompute_keys(PUBLIC_KEY + '\n', ['name', ''])
+        key_hash = hashlib.sha512(PUBLIC_KEY).digest()
+        self.assertTrue(PUBLIC_KEY in PUBLIC_KEY_HASHES._pinned)
+        self.assertTrue((key_hash, 'name') in COMPOUND_KEYS._pinned)
+        self.assertEqual(1, len(COMPOUND_KEYS))
+        construct_key(PUBLIC_KEY, 'name')
+        self.assertEqual(1, COMPOUND_KEYS.hits)
+
+
+class TestSigner(unittest.TestCase):
+    """
+    Ensures the Signer class works as expected.
+    """
+
+    def setUp(self):
+        PUBLIC_KEY_HASHES.clear()
+        COMPOUND_KEYS.clear()
+        self.addCleanup(PUBLIC_KEY_HASHES.clear)
+        self.addCleanup(COMPOUND_KEYS.clear)
+
+    def test_init(self):
+        """
+        The public key defaults to the one belonging to the private key and
+        its digest is precomputed.
+        """
+        signer = Signer(PRIVATE_KEY)
+        self.assertEqual(PUBLIC_KEY, signer.public_key)
+        self.assertTrue(PUBLIC_KEY in PUBLIC_KEY_HASHES._pinned)
+
+    def test_init_key_object(self):
+        """
+        The private key may be an RSA key object and the public key may be
+        given explicitly.
+        """
+        signer = Signer(RSA.importKey(PRIVATE_KEY), ALT_PUBLIC_KEY)
+        self.assertEqual(ALT_PUBLIC_KEY, signer.public_key)
+
+    def test_sign(self):
+        """
+        The signature is the same as the one from generate_signature and the
+        key is only parsed once.
+        """
+        with patch('drogulus.schemes.RSA.importKey',
+                   side_effect=RSA.importKey) as mock_import:
+            signer = Signer(PRIVATE_KEY, PUBLIC_KEY)
+            signatures = [signer.sign('value', 1.0, 0.0, 'name', {})
+                          for i in range(3)]
+        self.assertEqual(1, mock_import.call_count)
+        expected = generate_signature('value', 1.0, 0.0, 'name', {},
+                                      PRIVATE_KEY)
+        self.assertEqual([expected] * 3, signatures)
+        self.assertTrue(validate_signature('value', 1.0, 0.0, 'name', {},
+                                           expected, PUBLIC_KEY))
+
+    def test_generate_signature_with_signer(self):
+        """
+        A Signer can be used with generate_signature.
+        """
+        signer = Signer(PRIVATE_KEY)
+        self.assertEqual(signer.sign('value', 1.0, 0.0, 'name', {}),
+                         generate_signature('value', 1.0, 0.0, 'name', {},
+                                            signer))
+
+    def test_key(self):
+        """
+        The keys in the DHT are derived from the public key.
+        """
+        signer = Signer(PRIVATE_KEY)
+        self.assertEqual(construct_key(PUBLIC_KEY, 'name'),
+                         signer.key('name'))
+        self.assertEqual(construct_key(PUBLIC_KEY), signer.key())
+
+
+class TestParallelHashing(unittest.TestCase):
+    """
+    Ensures large values are hashed in the reactor's pool of threads as
+    expected.
+    """
+
+    def setUp(self):
+        self.value = os.urandom(1024)
+        self.expected = construct_hash(self.value, 1.0, 0.0, 'name', {})
+
+    def test_value_digest(self):
+        """
+        The digest of the value is that of its msgpack encoding.
+        """
+        packed = msgpack.packb(self.value)
+        self.assertEqual(hashlib.sha512(packed).digest(),
+                         value_digest(self.value))
+        self.assertEqual(hashlib.sha512(msgpack.packb(1)).digest(),
+                         value_digest(1))
+        self.assertEqual('digest',
+                         value_digest(PrehashedValue(self.value, 'digest')))
+
+    @patch('drogulus.crypto.PARALLEL_HASH_THRESHOLD', 1024)
+    def test_construct_hash_large(self):
+        """
+        A value at the threshold is hashed by construct_hash itself, without
+        starting a thread.
+        """
+        with patch('drogulus.crypto.threading.Thread') as mock_thread:
+            result = construct_hash(self.value, 1.0, 0.0, 'name', {})
+        self.assertEqual(self.expected.digest(), result.digest())
+        self.assertEqual(0, mock_thread.call_count)
+
+    def test_prehash_value_small(self):
+        """
+        A value below the threshold is returned as it is.
+        """
+        d = prehash_value(self.value)
+        self.assertTrue(d.called)
+        self.assertTrue(d.result is self.value)
+
+    @patch('drogulus.crypto.PARALLEL_HASH_THRESHOLD', 1024)
+    def test_prehash_value_large(self):
+        """
+        A value at the threshold is hashed in a thread and returned as a
+        PrehashedValue with the same hash.
+        """
+        with patch('drogulus.crypto.threads.deferToThread',
+                   side_effect=defer.maybeDeferred) as mock_defer:
+            d = prehash_value(self.value)
+        self.assertEqual(1, mock_defer.call_count)
+        result = d.result
+        self.assertIsInstance(result, PrehashedValue)
+        self.assertEqual(self.value, result)
+        self.assertEqual(self.expected.digest(), construct_hash(
+            result, 1.0, 0.0, 'name', {}).digest())
@@ -3,13 +3,42 @@
 Tests for the core Drogulus class
 """
 from drogulus.drogulus import Drogulus
+from drogulus.crypto import PUBLIC_KEY_HASHES, COMPOUND_KEYS
 import unittest
 
 
+# Only the digest of the public key is needed so it needn't be a real key.
+PUBLIC_KEY = """-----BEGIN PUBLIC KEY-----
+MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC+n3Au1cbSkjCVsrfnTbmA0SwQ
+-----END PUBLIC KEY-----"""
+
+
 class TestDrogulus(unittest.TestCase):
     """
     Ensures the core Drogulus class works as expected.
     """
 
-    def __init__(self):
-        self.drogulus = Drogulus()
+    def setUp(self):
+        PUBLIC_KEY_HASHES.clear()
+        COMPOUND_KEYS.clear()
+        self.addCleanup(PUBLIC_KEY_HASHES.clear)
+        self.addCleanup(COMPOUND_KEYS.clear)
+
+    def test_init(self):
+        """
+        Without a public key no keys are precomputed.
+        """
+        drogulus = Drogulus()
+        self.assertEqual({}, drogulus.alias)
+        self.assertEqual(None, drogulus.public_key)
+        self.assertEqual(0, len(PUBLIC_KEY_HASHES))
+
+    def test_init_precomputes_keys(self):
+        """
+        The hash of the node's own public key is worked out at startup and
+        is never forgotten.
+        """
+        drogulus = Drogulus(public_key=PUBLIC_KEY)
+        self.assertEqual(PUBLIC_KEY, drogulus.public_key)
+        self.assertTrue(PUBLIC_KEY in PUBLIC_KEY_HASHES)
+        self.assertEqual(1, PUBLIC_KEY_HASHES.misses)
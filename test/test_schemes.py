@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Ensures the signature schemes work as expected.
+"""
+from drogulus.schemes import (SCHEMES, DEFAULT_SCHEME, SignatureScheme,
+                              RSAScheme, register_scheme, scheme_for)
+from drogulus.crypto import (construct_hash, construct_key, Signer,
+                             generate_signature, validate_signature,
+                             validate_message, PUBLIC_KEYS)
+from drogulus.net.messages import Store
+from drogulus.version import get_version
+from Crypto.PublicKey import RSA
+import unittest
+
+
+# A 1024 bit RSA key is quick to generate.
+RSA_KEY = RSA.generate(1024)
+PRIVATE_KEY = RSA_KEY.exportKey()
+PUBLIC_KEY = RSA_KEY.publickey().exportKey()
+
+
+class FakeScheme(SignatureScheme):
+    """
+    A signature scheme that implements the interface but does nothing.
+    """
+
+    name = 'fake'
+    prefix = 'fake:'
+
+    def load_key(self, key):
+        return None
+
+    def public_key(self, private_key):
+        return private_key
+
+    def generate(self):
+        return self.prefix
+
+
+class TestRegistry(unittest.TestCase):
+    """
+    Ensures signature schemes are registered and found as expected.
+    """
+
+    def test_default_scheme(self):
+        """
+        RSA is the default scheme for keys without a known prefix.
+        """
+        self.assertIsInstance(DEFAULT_SCHEME, RSAScheme)
+        self.assertEqual(DEFAULT_SCHEME, SCHEMES['rsa'])
+        self.assertEqual(DEFAULT_SCHEME, scheme_for(PUBLIC_KEY))
+        self.assertEqual(DEFAULT_SCHEME, scheme_for('nonsense'))
+
+    def test_register_scheme(self):
+        """
+        A registered scheme is used for keys with its prefix.
+        """
+        self.addCleanup(SCHEMES.pop, 'fake')
+        scheme = register_scheme(FakeScheme())
+        self.assertEqual(scheme, SCHEMES['fake'])
+        self.assertEqual(scheme, scheme_for('fake:key'))
+
+    def test_register_scheme_prefix_in_use(self):
+        """
+        A scheme may not use the prefix of another scheme.
+        """
+        class Fake(FakeScheme):
+            prefix = ''
+
+        self.assertRaises(ValueError, register_scheme, Fake())
+        self.assertFalse('fake' in SCHEMES)
+
+    def test_base_class(self):
+        """
+        The base class is abstract: a scheme must implement load_key,
+        public_key and generate.
+        """
+        self.assertRaises(TypeError, SignatureScheme)
+
+        class Partial(SignatureScheme):
+            name = 'partial'
+
+            def load_key(self, key):
+                return None
+
+        self.assertRaises(TypeError, Partial)
+
+
+class TestRSAScheme(unittest.TestCase):
+    """
+    Ensures RSA keys work as they always have.
+    """
+
+    def test_sign_and_verify(self):
+        """
+        A signature from a loaded private key is verified with the loaded
+        public key.
+        """
+        scheme = RSAScheme()
+        compound_hash = construct_hash('value', 1.0, 0.0, 'name', {})
+        signature = scheme.load_key(PRIVATE_KEY).sign(compound_hash)
+        self.assertTrue(scheme.load_key(PUBLIC_KEY).verify(compound_hash,
+                                                           signature))
+        self.assertEqual(signature, generate_signature(
+            'value', 1.0, 0.0, 'name', {}, RSA_KEY))
+
+    def test_public_key(self):
+        """
+        The public key belonging to a private key is exported.
+        """
+        self.assertEqual(PUBLIC_KEY, RSAScheme().public_key(PRIVATE_KEY))
+
+    def test_generate(self):
+        """
+        A new private key of the given size is generated.
+        """
+        key = RSA.importKey(RSAScheme(1024).generate())
+        self.assertEqual(1023, key.size())
+
+
+@unittest.skipUnless('ed25519' in SCHEMES, 'Ed25519 is not supported.')
+class TestEd25519Scheme(unittest.TestCase):
+    """
+    Ensures Ed25519 keys can be used to sign and verify messages.
+    """
+
+    def setUp(self):
+        self.scheme = SCHEMES['ed25519']
+        self.private_key = self.scheme.generate()
+        self.public_key = self.scheme.public_key(self.private_key)
+
+    def test_keys(self):
+        """
+        Keys have the scheme's prefix and are found with scheme_for.
+        """
+        self.assertTrue(self.private_key.startswith('ed25519:'))
+        self.assertTrue(self.public_key.startswith('ed25519:'))
+        self.assertEqual(self.scheme, scheme_for(self.private_key))
+        self.assertEqual(self.scheme, scheme_for(self.public_key))
+        self.assertNotEqual(self.private_key, self.scheme.generate())
+
+    def test_sign_and_verify(self):
+        """
+        A signature from the private key is verified with the public key.
+        Tampered hashes and signatures are not.
+        """
+        compound_hash = construct_hash('value', 1.0, 0.0, 'name', {})
+        signature = self.scheme.load_key(self.private_key).sign(compound_hash)
+        self.assertEqual(64, len(signature))
+        key = self.scheme.load_key(self.public_key)
+        self.assertTrue(key.verify(compound_hash, signature))
+        self.assertFalse(key.verify(compound_hash, signature[::-1]))
+        self.assertFalse(key.verify(
+            construct_hash('value', 1.0, 0.0, 'other', {}), signature))
+
+    def test_public_key_cannot_sign(self):
+        """
+        A public key can't be used to sign.
+        """
+        key = self.scheme.load_key(self.public_key)
+        self.assertRaises(TypeError, key.sign,
+                          construct_hash('value', 1.0, 0.0, 'name', {}))
+        self.assertRaises(ValueError, self.scheme.public_key,
+                          self.public_key)
+
+    def test_malformed_key(self):
+        """
+        Malformed keys result in a ValueError and don't validate.
+        """
+        self.assertRaises(ValueError, self.scheme.load_key, 'ed25519:$')
+        self.assertRaises(ValueError, self.scheme.load_key, 'ed25519:YWJj')
+        self.assertFalse(validate_signature('value', 1.0, 0.0, 'name', {},
+                                            'sig', 'ed25519:YWJj'))
+
+    def test_message(self):
+        """
+        A message signed with an Ed25519 key is valid (and its key is cached)
+        alongside RSA messages.
+        """
+        self.addCleanup(PUBLIC_KEYS.clear)
+        messages = []
+        for private_key, public_key in ((self.private_key, self.public_key),
+                                        (PRIVATE_KEY, PUBLIC_KEY)):
+            signer = Signer(private_key)
+            self.assertEqual(public_key, signer.public_key)
+            signature = signer.sign('value', 1.0, 0.0, 'name', {})
+            messages.append(Store('uuid', 'node',
+                                  construct_key(public_key, 'name'), 'value',
+                                  1.0, 0.0, public_key, 'name', {},
+                                  signature, get_version()))
+        for message in messages:
+            self.assertEqual((True, None), validate_message(message))
+        self.assertTrue(self.public_key in PUBLIC_KEYS)